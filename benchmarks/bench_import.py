@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+Import time regression benchmark.
+
+The command line tools are started thousands of times a day from job scripts
+so start up time matters.  Each module is imported in a fresh interpreter
+several times and the median time is reported, along with any heavy modules
+(numpy, numcodecs, dask) that the import pulled in.  The time of the --help
+command line is measured the same way.
+
+python benchmarks/bench_import.py --repeats 10 --max_ms 150
+
+Exits with status 1 if a median exceeds --max_ms or a heavy module is
+imported, so it can be used as a regression check.
+"""
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+
+MODULES = (
+    'compression_tools.compress_dir',
+    'compression_tools.compress_file',
+    'compression_tools.decompress_file',
+    'compression_tools.alt_zip',
+    'compression_tools.chunked_file',
+    )
+
+# Modules with a command line (console scripts)
+CLI_MODULES = MODULES[:3]
+
+HEAVY_MODULES = ('numpy', 'numcodecs', 'dask', 'psutil')
+
+IMPORT_SCRIPT = '''
+import json, sys, time
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+print(json.dumps({{'seconds': seconds, 'heavy': [x for x in {heavy!r} if x in sys.modules]}}))
+'''
+
+
+def time_import(module, repeats):
+    '''
+    Returns (median import ms, heavy modules imported)
+    '''
+    times = []
+    for _ in range(repeats):
+        out = subprocess.run([sys.executable, '-c', IMPORT_SCRIPT.format(module=module, heavy=HEAVY_MODULES)],
+                             check=True, capture_output=True, text=True).stdout
+        result = json.loads(out)
+        times.append(result['seconds'] * 1000)
+    return statistics.median(times), result['heavy']
+
+
+def time_help(module, repeats):
+    '''
+    Median wall time (ms) of python -m module --help, including interpreter
+    start up
+    '''
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-m', module, '--help'], check=True, capture_output=True)
+        times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Import time regression benchmark')
+    parser.add_argument('--repeats', type=int, default=5, help='Number of fresh interpreters per measurement')
+    parser.add_argument('--max_ms', type=float, default=None, help='Fail if any median import time exceeds this')
+    args = parser.parse_args()
+
+    failed = False
+    print(f'{"module":<36} {"import ms":>10} {"--help ms":>10}  heavy imports')
+    for module in MODULES:
+        import_ms, heavy = time_import(module, args.repeats)
+        help_ms = f'{time_help(module, args.repeats):.1f}' if module in CLI_MODULES else '-'
+        print(f'{module:<36} {import_ms:>10.1f} {help_ms:>10}  {", ".join(heavy) or "-"}')
+        if heavy or (args.max_ms is not None and import_ms > args.max_ms):
+            failed = True
+    sys.exit(1 if failed else 0)
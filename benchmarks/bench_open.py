@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""
+Time to open an archive with many entries and to read entries at random,
+with and without its entry index (<archive>.idx).
+
+The archives are written by compress_dir from a directory of small files
+(with a manifest, and with --pack their files packed into blocks) so that
+opening them includes everything a real archive needs.
+
+python benchmarks/bench_open.py --entries 10000 100000 --pack 4194304 --out open.json
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from numcodecs import Blosc
+
+from compression_tools.alt_zip import alt_zip
+from compression_tools.compress_dir import compress_dir
+from compression_tools.entry_index import index_location, write_index
+
+
+def make_archive(location, directory, entries, pack_size=None, workers=None):
+    '''
+    Write entries small files to directory and compress them with
+    compress_dir.  Returns (names, seconds to write the entry index).
+    '''
+    names = [f'dir_{idx % 1000:03d}/file_{idx:08d}.txt' for idx in range(entries)]
+    for name in names:
+        path = os.path.join(directory, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(name.encode() * 4)
+    compressor = Blosc(cname='lz4', clevel=1)
+    with contextlib.redirect_stdout(io.StringIO()):
+        compress_dir(directory, location, compressor, pack_size=pack_size, checksum='xxh64', cpu=workers,
+                     workers=workers)
+    # compress_dir already wrote the index, time writing it again
+    start = time.perf_counter()
+    write_index(location)
+    return names, time.perf_counter() - start
+
+
+def run_case(location, names, lookups, indexed):
+    '''
+    Open the archive and read lookups random entries.  Returns (open
+    seconds, lookups per second)
+    '''
+    backup = index_location(location) + '.bak'
+    if not indexed:
+        os.rename(index_location(location), backup)
+    try:
+        start = time.perf_counter()
+        archive = alt_zip(location, cache_bytes=0)
+        opened = time.perf_counter() - start
+
+        sample = random.Random(0).sample(names, min(lookups, len(names)))
+        start = time.perf_counter()
+        for name in sample:
+            assert name in archive
+            archive[name]
+        seconds = time.perf_counter() - start
+        archive.close()
+    finally:
+        if not indexed:
+            os.rename(backup, index_location(location))
+    return opened, len(sample) / seconds
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Archive open and random lookup benchmark')
+    parser.add_argument('--entries', type=int, nargs='+', default=[10000, 100000], help='Number of entries of each archive')
+    parser.add_argument('--lookups', type=int, default=10000, help='Random entries read from each archive')
+    parser.add_argument('--pack', type=int, default=None, help='compress_dir pack size in bytes (default files are not packed)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='compress_dir workers')
+    parser.add_argument('--workdir', type=str, default=None, help='Where the archives are written (default a temporary directory)')
+    parser.add_argument('--out', type=str, default=None, help='Optional JSON results file')
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='compression_tools_open_')
+    os.makedirs(workdir, exist_ok=True)
+    results = []
+    try:
+        print(f'{"entries":>10} {"index s":>8} {"open zip s":>10} {"open idx s":>10} {"zip get/s":>10} {"idx get/s":>10}')
+        for entries in args.entries:
+            location = os.path.join(workdir, f'{entries}.zip')
+            directory = os.path.join(workdir, f'{entries}_files')
+            names, index_seconds = make_archive(location, directory, entries, args.pack, args.workers)
+            shutil.rmtree(directory)
+            zip_open, zip_rate = run_case(location, names, args.lookups, indexed=False)
+            index_open, index_rate = run_case(location, names, args.lookups, indexed=True)
+            results.append({'entries': entries, 'write_index_seconds': index_seconds,
+                            'zip_open_seconds': zip_open, 'index_open_seconds': index_open,
+                            'zip_lookups_per_second': zip_rate, 'index_lookups_per_second': index_rate})
+            print(f'{entries:>10} {index_seconds:>8.2f} {zip_open:>10.3f} {index_open:>10.4f} {zip_rate:>10.0f} {index_rate:>10.0f}')
+            os.remove(location)
+            os.remove(index_location(location))
+            os.remove(location + '.xxh64.json')
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(json.dumps({'args': vars(args), 'results': results}, indent=4))
+        print(f'Results written to {args.out}')
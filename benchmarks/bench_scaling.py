@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""
+Scaling benchmark for the parallel execution layer.
+
+Compresses a synthetic 16-bit volume, split into fixed size pieces, with each
+executor type at 1, 2, 4, ... N workers and reports throughput in MB/s.
+
+python benchmarks/bench_scaling.py --size_mb 512 --piece_mb 8 -cpu 16
+"""
+
+import argparse
+import os
+import time
+
+import numpy as np
+from numcodecs import Blosc
+
+from compression_tools.parallel import EXECUTORS, bounded_as_completed, get_executor
+from compression_tools.workers import compress_bytes
+
+
+def make_volume(size_mb, seed=0):
+    '''
+    Microscopy-like uint16 data: smooth background, sparse bright objects
+    and shot noise
+    '''
+    rng = np.random.default_rng(seed)
+    n = size_mb * 2**20 // 2
+    background = np.linspace(100, 400, n) % 300
+    signal = (rng.random(n) > 0.995) * rng.integers(1000, 40000, n)
+    noise = rng.poisson(20, n)
+    return (background + signal + noise).astype('uint16').tobytes()
+
+
+def worker_counts(cpu):
+    counts = []
+    n = 1
+    while n < cpu:
+        counts.append(n)
+        n *= 2
+    counts.append(cpu)
+    return counts
+
+
+def run(data, piece_bytes, compressor, executor, workers, cpu):
+    pieces = [data[i:i + piece_bytes] for i in range(0, len(data), piece_bytes)]
+    pool, workers = get_executor(executor, cpu=cpu, workers=workers)
+    with pool:
+        start = time.perf_counter()
+        out = 0
+        items = ((idx, (piece, compressor)) for idx, piece in enumerate(pieces))
+        for _, compressed in bounded_as_completed(pool, compress_bytes, items, 2 * workers):
+            out += len(compressed)
+        elapsed = time.perf_counter() - start
+    return len(data) / 2**20 / elapsed, len(data) / out
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Executor scaling benchmark')
+    parser.add_argument('--size_mb', type=int, default=256, help='Size of synthetic dataset in MB')
+    parser.add_argument('--piece_mb', type=int, default=8, help='Size of each compressed piece in MB')
+    parser.add_argument('-cpu', type=int, default=os.cpu_count(), help='Maximum number of workers')
+    parser.add_argument('-cmp', '--compression', type=str, default='zstd')
+    parser.add_argument('-cl', '--clevel', type=int, default=5)
+    parser.add_argument('-ex', '--executor', type=str, nargs='+', default=[x for x in EXECUTORS if x != 'distributed'])
+    args = parser.parse_args()
+
+    data = make_volume(args.size_mb)
+    compressor = Blosc(cname=args.compression, clevel=args.clevel, shuffle=Blosc.SHUFFLE)
+
+    print(f'{"executor":<10} {"workers":>7} {"MB/s":>10} {"ratio":>7}')
+    for executor in args.executor:
+        counts = [1] if executor == 'sync' else worker_counts(args.cpu)
+        for workers in counts:
+            # In sync mode the whole cpu budget goes to Blosc threads
+            mbs, ratio = run(data, args.piece_mb * 2**20, compressor, executor, workers, args.cpu)
+            print(f'{executor:<10} {workers:>7} {mbs:>10.1f} {ratio:>7.2f}')
@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+"""
+Throughput benchmark suite for the compress and extract paths.
+
+Synthetic datasets are generated locally from a fixed seed:
+
+    volume:         16-bit microscopy-like planes (.raw) and one large volume
+    text:           log-like text files
+    random:         incompressible random bytes
+    small_files:    a tree of many 1-16KB files
+
+For each dataset, codec, clevel and worker count the suite times
+compress_dir, compress_file (single file datasets only), alt_zip.extract and
+alt_zip.__getitem__ and reports MB/s, compression ratio and peak RSS.  Every
+case runs in a fresh process so peak RSS belongs to that case alone.
+
+Results are written as JSON.  --compare prints the change in MB/s against a
+previous results file.
+
+python benchmarks/bench_suite.py --size_mb 64 -cmp lz4 zstd -cl 1 5 --workers 1 8 --out results.json
+python benchmarks/bench_suite.py --size_mb 64 --compare results.json
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from bench_scaling import make_volume
+
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+DATASETS = ('volume', 'text', 'random', 'small_files')
+
+WORDS = ('acquisition', 'tile', 'channel', 'stage', 'laser', 'exposure', 'z', 'x', 'y', 'ok',
+         'warning', 'frame', 'camera', 'objective', 'filter', 'mm', 'ms', 'nm', 'gain', 'offset')
+
+
+def make_text(size, rng):
+    lines = []
+    total = 0
+    while total < size:
+        line = f'{int(rng.integers(0, 2**31)):010d} ' + ' '.join(WORDS[x] for x in rng.integers(0, len(WORDS), 12)) + '\n'
+        lines.append(line)
+        total += len(line)
+    return ''.join(lines).encode()[:size]
+
+
+def make_dataset(name, location, size_mb, seed=0):
+    '''
+    Write dataset name (about size_mb MB) to location/name.  Returns
+    (directory, large single file or None)
+    '''
+    rng = np.random.default_rng(seed)
+    directory = os.path.join(location, name)
+    os.makedirs(directory, exist_ok=True)
+    size = size_mb * 2**20
+
+    if name == 'volume':
+        data = make_volume(size_mb, seed=seed)
+        plane = 2**21
+        for idx, offset in enumerate(range(0, len(data), plane)):
+            with open(os.path.join(directory, f'plane_{idx:04d}.raw'), 'wb') as f:
+                f.write(data[offset:offset + plane])
+        single = os.path.join(location, 'volume.raw')
+        with open(single, 'wb') as f:
+            f.write(data)
+        return directory, single
+
+    if name == 'text':
+        data = make_text(size, rng)
+        piece = 2**20
+        for idx, offset in enumerate(range(0, len(data), piece)):
+            with open(os.path.join(directory, f'log_{idx:04d}.txt'), 'wb') as f:
+                f.write(data[offset:offset + piece])
+        single = os.path.join(location, 'text.txt')
+        with open(single, 'wb') as f:
+            f.write(data)
+        return directory, single
+
+    if name == 'random':
+        data = rng.bytes(size)
+        piece = 2**22
+        for idx, offset in enumerate(range(0, len(data), piece)):
+            with open(os.path.join(directory, f'random_{idx:04d}.bin'), 'wb') as f:
+                f.write(data[offset:offset + piece])
+        single = os.path.join(location, 'random.bin')
+        with open(single, 'wb') as f:
+            f.write(data)
+        return directory, single
+
+    if name == 'small_files':
+        total = 0
+        idx = 0
+        while total < size:
+            length = int(rng.integers(2**10, 2**14))
+            sub = os.path.join(directory, f'dir_{idx // 256:03d}')
+            os.makedirs(sub, exist_ok=True)
+            # Half text, half 16-bit data so the files are compressible
+            data = make_text(length, rng) if idx % 2 else make_volume(1, seed=idx)[:length]
+            with open(os.path.join(sub, f'file_{idx:06d}.dat'), 'wb') as f:
+                f.write(data)
+            total += length
+            idx += 1
+        return directory, None
+
+    raise ValueError(f'Unknown dataset {name}, options are: {", ".join(DATASETS)}')
+
+
+def dir_size(directory):
+    return sum(os.path.getsize(os.path.join(root, x)) for root, _, files in os.walk(directory) for x in files)
+
+
+def peak_rss_mb():
+    '''
+    Peak resident memory of this process and its finished children in MB
+    '''
+    if resource is None:
+        return None
+    scale = 2**20 if sys.platform == 'darwin' else 2**10
+    self_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(self_rss, children) * scale / 2**20
+
+
+def run_case(case, directory, single, scratch):
+    '''
+    Run one benchmark case in this (fresh) process and return its results
+    '''
+    from numcodecs import Blosc
+    from compression_tools.alt_zip import alt_zip
+    from compression_tools.compress_dir import compress_dir
+    from compression_tools.compress_file import compress_file
+
+    compressor = Blosc(cname=case['cname'], clevel=case['clevel'], shuffle=Blosc.SHUFFLE)
+    workers = case['workers']
+    os.makedirs(scratch, exist_ok=True)
+    baseline_rss = peak_rss_mb()
+    result = dict(case)
+
+    # Library functions print progress, keep the report readable
+    with contextlib.redirect_stdout(io.StringIO()):
+        if case['operation'] in ('compress_dir', 'extract', 'getitem'):
+            out_zip = os.path.join(scratch, 'out.zip')
+            bytes_in = dir_size(directory)
+            start = time.perf_counter()
+            compress_dir(directory, out_zip, compressor, cpu=workers, workers=workers)
+            seconds = time.perf_counter() - start
+            result['ratio'] = bytes_in / os.path.getsize(out_zip)
+
+            if case['operation'] == 'extract':
+                with alt_zip(out_zip, cache_bytes=0) as archive:
+                    start = time.perf_counter()
+                    archive.extract(os.path.join(scratch, 'extracted'), workers=workers)
+                    seconds = time.perf_counter() - start
+
+            elif case['operation'] == 'getitem':
+                with alt_zip(out_zip, cache_bytes=0) as archive:
+                    entries = [x for x in archive if x not in archive.uncompressed_metadata_files]
+                    random.Random(0).shuffle(entries)
+                    start = time.perf_counter()
+                    for entry in entries:
+                        archive[entry]
+                    seconds = time.perf_counter() - start
+
+        elif case['operation'] == 'compress_file':
+            bytes_in = os.path.getsize(single)
+            out_dir = os.path.join(scratch, 'out.compressed')
+            start = time.perf_counter()
+            compress_file(single, out_dir, compressor, chunk_size_bytes=2**24, cpu=workers, workers=workers)
+            seconds = time.perf_counter() - start
+            result['ratio'] = bytes_in / dir_size(out_dir)
+
+    result['seconds'] = seconds
+    result['MB'] = bytes_in / 2**20
+    result['MB_per_second'] = bytes_in / 2**20 / seconds if seconds > 0 else 0
+    result['peak_rss_mb'] = peak_rss_mb()
+    result['baseline_rss_mb'] = baseline_rss
+    return result
+
+
+def cases(datasets, cnames, clevels, workers_list):
+    for dataset in datasets:
+        for cname in cnames:
+            for clevel in clevels:
+                for workers in workers_list:
+                    operations = ['compress_dir', 'extract', 'getitem']
+                    if dataset != 'small_files':
+                        operations.append('compress_file')
+                    for operation in operations:
+                        yield {'dataset': dataset, 'operation': operation, 'cname': cname,
+                               'clevel': clevel, 'workers': workers}
+
+
+def case_key(case):
+    return '|'.join(str(case[x]) for x in ('dataset', 'operation', 'cname', 'clevel', 'workers'))
+
+
+def metadata(args):
+    import numcodecs
+    commit = None
+    try:
+        import subprocess
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        pass
+    return {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'numcodecs': numcodecs.__version__,
+        'args': vars(args)
+        }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compress / extract throughput benchmark suite')
+    parser.add_argument('--size_mb', type=int, default=64, help='Approximate size of each dataset in MB')
+    parser.add_argument('--datasets', type=str, nargs='+', default=list(DATASETS), help=f'Datasets: {", ".join(DATASETS)}')
+    parser.add_argument('-cmp', '--compression', type=str, nargs='+', default=['lz4', 'zstd'])
+    parser.add_argument('-cl', '--clevel', type=int, nargs='+', default=[1, 5])
+    parser.add_argument('--workers', type=int, nargs='+', default=sorted({1, os.cpu_count() or 1}))
+    parser.add_argument('--workdir', type=str, default=None, help='Where datasets are generated (default a temporary directory)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', type=str, default='bench_results.json', help='JSON results file')
+    parser.add_argument('--compare', type=str, default=None, help='Previous JSON results to compare MB/s against')
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='compression_tools_bench_')
+    os.makedirs(workdir, exist_ok=True)
+
+    previous = {}
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            previous = {case_key(x): x for x in json.load(f)['results']}
+
+    results = []
+    spawn = multiprocessing.get_context('spawn')
+    try:
+        # Generated in another process: peak RSS is inherited by the processes
+        # that this one starts, it would hide the RSS of the cases
+        generated = {}
+        with ProcessPoolExecutor(max_workers=1, mp_context=spawn) as pool:
+            for dataset in args.datasets:
+                generated[dataset] = pool.submit(make_dataset, dataset, workdir, args.size_mb, seed=args.seed).result()
+
+        print(f'{"dataset":<12} {"operation":<14} {"codec":<10} {"workers":>7} {"MB/s":>9} {"ratio":>7} {"RSS MB":>8} {"change":>8}')
+        for case in cases(args.datasets, args.compression, args.clevel, args.workers):
+            directory, single = generated[case['dataset']]
+            scratch = os.path.join(workdir, 'scratch')
+            with ProcessPoolExecutor(max_workers=1, mp_context=spawn) as pool:
+                result = pool.submit(run_case, case, directory, single, scratch).result()
+            shutil.rmtree(scratch, ignore_errors=True)
+            results.append(result)
+
+            change = ''
+            old = previous.get(case_key(case))
+            if old is not None and old['MB_per_second'] > 0:
+                change = f'{100 * (result["MB_per_second"] / old["MB_per_second"] - 1):+.1f}%'
+            rss = f'{result["peak_rss_mb"]:.0f}' if result['peak_rss_mb'] is not None else '-'
+            print(f'{case["dataset"]:<12} {case["operation"]:<14} {case["cname"] + "-" + str(case["clevel"]):<10} {case["workers"]:>7} '
+                  f'{result["MB_per_second"]:>9.1f} {result["ratio"]:>7.2f} {rss:>8} {change:>8}')
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    with open(args.out, 'w') as f:
+        f.write(json.dumps({'metadata': metadata(args), 'results': results}, indent=4))
+    print(f'Results written to {args.out}')
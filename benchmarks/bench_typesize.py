@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""
+Blosc typesize benchmark.
+
+Compresses a synthetic 16-bit volume with typesize 1, 2 and 4 for each
+shuffle mode and reports compression ratio and MB/s for compression and
+decompression.  With typesize 1 SHUFFLE / BITSHUFFLE have no effect.
+
+python benchmarks/bench_typesize.py --size_mb 256 -cmp zstd -cl 5
+"""
+
+import argparse
+import os
+import sys
+import time
+
+from numcodecs import Blosc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from bench_scaling import make_volume
+
+from compression_tools.parallel import set_blosc_threads
+from compression_tools.workers import compress_bytes
+
+SHUFFLES = {'noshuffle': Blosc.NOSHUFFLE, 'shuffle': Blosc.SHUFFLE, 'bitshuffle': Blosc.BITSHUFFLE}
+
+
+def run(data, compressor, typesize, repeats=3):
+    '''
+    Returns (ratio, compress MB/s, decompress MB/s), best of repeats
+    '''
+    compress_seconds = decompress_seconds = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        compressed = compress_bytes(data, compressor, typesize)
+        compress_seconds = min(compress_seconds, time.perf_counter() - start)
+
+        start = time.perf_counter()
+        decoded = compressor.decode(compressed)
+        decompress_seconds = min(decompress_seconds, time.perf_counter() - start)
+    assert decoded == data
+    mb = len(data) / 2**20
+    return len(data) / len(compressed), mb / compress_seconds, mb / decompress_seconds
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Blosc typesize benchmark')
+    parser.add_argument('--size_mb', type=int, default=128, help='Size of synthetic 16-bit volume in MB')
+    parser.add_argument('-cpu', type=int, default=os.cpu_count(), help='Number of Blosc threads')
+    parser.add_argument('-cmp', '--compression', type=str, default='zstd')
+    parser.add_argument('-cl', '--clevel', type=int, default=5)
+    parser.add_argument('-ts', '--typesize', type=int, nargs='+', default=[1, 2, 4])
+    args = parser.parse_args()
+
+    set_blosc_threads(args.cpu)
+    data = make_volume(args.size_mb)
+
+    print(f'{"shuffle":<11} {"typesize":>8} {"ratio":>7} {"comp MB/s":>10} {"decomp MB/s":>12}')
+    for name, shuffle in SHUFFLES.items():
+        compressor = Blosc(cname=args.compression, clevel=args.clevel, shuffle=shuffle)
+        for typesize in args.typesize:
+            ratio, compress_mbs, decompress_mbs = run(data, compressor, typesize)
+            print(f'{name:<11} {typesize:>8} {ratio:>7.2f} {compress_mbs:>10.1f} {decompress_mbs:>12.1f}')
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+Peak RSS and throughput with and without the zero-copy buffer paths.
+
+Each operation runs in a fresh process, once with workers.ZERO_COPY off (data
+is read and decoded through intermediate bytes objects) and once with it on
+(reads go into reusable per-thread buffers, stored bytes are memoryviews of
+the archive and decoding writes straight into a memory map of the output).
+
+    compress_dir:       volume planes plus one large file split into parts
+    compress_file:      the large file
+    extract:            alt_zip.extract of the compress_dir archive
+    decompress_file:    decompress_file of the compress_file directory
+
+python benchmarks/bench_zero_copy.py --size_mb 512 --workers 4 --out zero_copy.json
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from bench_suite import dir_size, make_dataset, peak_rss_mb
+
+OPERATIONS = ('compress_dir', 'compress_file', 'extract', 'decompress_file')
+
+
+def prepare(workdir, size_mb, part_size):
+    '''
+    Generate the dataset and the inputs of extract and decompress_file.
+    Returns (directory, large file, {'zip': archive, 'chunks': directory}).
+    '''
+    from numcodecs import Blosc
+    from compression_tools.compress_dir import compress_dir
+    from compression_tools.compress_file import compress_file
+
+    directory, single = make_dataset('volume', workdir, size_mb)
+    # The large file is stored in the directory too so that compress_dir and
+    # extract go through the split part paths
+    shutil.copy(single, os.path.join(directory, 'volume.raw'))
+
+    prepared = {'zip': os.path.join(workdir, 'prepared.zip'), 'chunks': os.path.join(workdir, 'prepared.compressed')}
+    compressor = Blosc(cname='lz4', clevel=1, shuffle=Blosc.SHUFFLE)
+    with contextlib.redirect_stdout(io.StringIO()):
+        compress_dir(directory, prepared['zip'], compressor, part_size=part_size)
+        compress_file(single, prepared['chunks'], compressor, chunk_size_bytes=part_size)
+    return directory, single, prepared
+
+
+def run_case(operation, zero_copy, directory, single, prepared, scratch, workers, part_size):
+    '''
+    Run one operation in this (fresh) process and return (MB/s, peak RSS MB)
+    '''
+    from numcodecs import Blosc
+    from compression_tools import workers as worker_functions
+    from compression_tools.alt_zip import alt_zip
+    from compression_tools.compress_dir import compress_dir
+    from compression_tools.compress_file import compress_file
+    from compression_tools.decompress_file import decompress_file
+
+    worker_functions.ZERO_COPY = zero_copy
+    compressor = Blosc(cname='lz4', clevel=1, shuffle=Blosc.SHUFFLE)
+    os.makedirs(scratch, exist_ok=True)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        if operation == 'compress_dir':
+            nbytes = dir_size(directory)
+            compress_dir(directory, os.path.join(scratch, 'out.zip'), compressor, cpu=workers,
+                         workers=workers, part_size=part_size)
+        elif operation == 'compress_file':
+            nbytes = os.path.getsize(single)
+            compress_file(single, os.path.join(scratch, 'out.compressed'), compressor,
+                          chunk_size_bytes=part_size, cpu=workers, workers=workers)
+        elif operation == 'extract':
+            nbytes = dir_size(directory)
+            with alt_zip(prepared['zip'], cache_bytes=0) as archive:
+                archive.extract(os.path.join(scratch, 'extracted'), workers=workers)
+        else:
+            nbytes = os.path.getsize(single)
+            decompress_file(prepared['chunks'], os.path.join(scratch, 'out.raw'), cpu=workers, workers=workers)
+        seconds = time.perf_counter() - start
+
+    return nbytes / 2**20 / seconds, peak_rss_mb()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Zero-copy buffer handling benchmark')
+    parser.add_argument('--size_mb', type=int, default=256, help='Approximate size of the dataset in MB')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--part_size', type=int, default=2**25, help='Part / chunk size in bytes')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per case, the best MB/s is reported')
+    parser.add_argument('--operations', type=str, nargs='+', default=list(OPERATIONS), help=f'Operations: {", ".join(OPERATIONS)}')
+    parser.add_argument('--workdir', type=str, default=None, help='Where the dataset is generated (default a temporary directory)')
+    parser.add_argument('--out', type=str, default=None, help='Optional JSON results file')
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='compression_tools_zero_copy_')
+    os.makedirs(workdir, exist_ok=True)
+    spawn = multiprocessing.get_context('spawn')
+    results = []
+    try:
+        # Generated in another process: peak RSS is inherited by the processes
+        # that this one starts, it would hide the RSS of the cases
+        with ProcessPoolExecutor(max_workers=1, mp_context=spawn) as pool:
+            directory, single, prepared = pool.submit(prepare, workdir, args.size_mb, args.part_size).result()
+
+        print(f'{"operation":<16} {"copy MB/s":>10} {"zero MB/s":>10} {"change":>8} {"copy RSS":>9} {"zero RSS":>9} {"change":>8}')
+        for operation in args.operations:
+            result = {'operation': operation}
+            for zero_copy in (False, True):
+                speeds = []
+                rss = []
+                for _ in range(args.repeat):
+                    scratch = os.path.join(workdir, 'scratch')
+                    with ProcessPoolExecutor(max_workers=1, mp_context=spawn) as pool:
+                        speed, peak = pool.submit(run_case, operation, zero_copy, directory, single, prepared,
+                                                  scratch, args.workers, args.part_size).result()
+                    shutil.rmtree(scratch, ignore_errors=True)
+                    speeds.append(speed)
+                    rss.append(peak)
+                label = 'zero_copy' if zero_copy else 'copy'
+                result[label + '_MB_per_second'] = max(speeds)
+                result[label + '_peak_rss_mb'] = min(rss) if None not in rss else None
+            results.append(result)
+
+            speed_change = f'{100 * (result["zero_copy_MB_per_second"] / result["copy_MB_per_second"] - 1):+.1f}%'
+            if result['copy_peak_rss_mb'] is not None:
+                rss_columns = (f'{result["copy_peak_rss_mb"]:>9.0f} {result["zero_copy_peak_rss_mb"]:>9.0f} '
+                               f'{100 * (result["zero_copy_peak_rss_mb"] / result["copy_peak_rss_mb"] - 1):>+7.1f}%')
+            else:
+                rss_columns = f'{"-":>9} {"-":>9} {"":>8}'
+            print(f'{operation:<16} {result["copy_MB_per_second"]:>10.1f} {result["zero_copy_MB_per_second"]:>10.1f} '
+                  f'{speed_change:>8} {rss_columns}')
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(json.dumps({'args': vars(args), 'results': results}, indent=4))
+        print(f'Results written to {args.out}')
@@ -5,95 +5,263 @@ Created on Thu Jun 15 16:02:10 2023
 @author: awatson
 """
 
-import dask
-from dask import delayed
-import hashlib
+import builtins
 import json
+import mmap
 import time
-import glob
 import os
-from zipfile import ZipFile
-from numcodecs import Blosc
-from io import BytesIO
+import zlib
+from zipfile import ZIP_STORED, BadZipFile, ZipFile
+import struct
+# Listings are pretty printed, messages use builtins.print
 from pprint import pprint as print
-
-import argparse
-import psutil
-psutil.virtual_memory()
-
-# parser = argparse.ArgumentParser(description='''
-#                                  Recursively combine a directory into a ZIP
-#                                  file using configurable compression
-#                                  ''')
-
-# positional = [
-#     ('input_dir',str,'+','One input directorory.'),
-#     ]
-
-# optional = [
+import threading
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+
+from compression_tools.cache import LRUCache
+from compression_tools.checksum import hash_bytes
+from compression_tools.entry_index import load_index
+from compression_tools.memory import buffer_limit
+from compression_tools.parallel import SyncExecutor, bounded_as_completed, call
+from compression_tools import workers
+from compression_tools.workers import REUSE_LIMIT, decode_to_range, release_buffers, release_file, thread_buffer, write_range
+
+
+# Members used internally by compress_dir (ie blocks of packed small files)
+# are stored under this prefix and are not listed as entries
+INTERNAL_PREFIX = '.compression_tools/'
+BLOCK_PREFIX = INTERNAL_PREFIX + 'blocks/'
+PART_PREFIX = INTERNAL_PREFIX + 'parts/'
+
+# Member of the index archive of a sharded archive that lists its shards and
+# the shard that holds each entry
+SHARD_INDEX_NAME = 'shards.json'
+
+# Stored members smaller than this are read with one pread rather than
+# memory mapped: creating and tearing down a map costs more than copying
+# small members (mapping pays off from about 1MB)
+MAP_THRESHOLD = 2**20
+
+
+def compressor_from_config(config):
+    '''
+    Form a compressor from a json config (ie compressor.json)
+    '''
+    # numcodecs (and numpy) are only imported when data is decoded
+    import numcodecs
+    from numcodecs import Blosc
+    if config['id'] == 'blosc':
+        return Blosc(
+            cname=config['cname'], 
+            clevel=config['clevel'], 
+            shuffle=config['shuffle'], 
+            blocksize=config['blocksize']
+            )
+    return numcodecs.get_codec(config)
+
+def part_name(entry, idx):
+    '''
+    Member name of part idx of a large file that compress_dir split into parts
+    '''
+    return PART_PREFIX + entry + '/' + str(idx).zfill(5)
+
+def shard_name(archive_location, idx):
+    '''
+    File name of shard idx of a sharded archive, next to its index archive
+    (ie out.zip -> out.00000.zip)
+    '''
+    root, ext = os.path.splitext(archive_location)
+    return root + '.' + str(idx).zfill(5) + (ext or '.zip')
+
+def blosc_nbytes(buf):
+    '''
+    Return the decompressed size of a Blosc buffer from its 16 byte header
+    '''
+    assert len(buf) >= 16, 'Buffer is too small to be a Blosc frame'
+    return struct.unpack_from('<I', buf, 4)[0]
+
+
+class _ThreadHandles:
+    '''
+    One open ZipFile handle per thread
+    '''
+    def __init__(self, archive_location):
+        self.archive_location = archive_location
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.opened = []
     
-#     (['-out','--output_zip'],str,1,'OUT',None,'store','Output ZIP file name'),
-#     (['-cpu'],int,1,'C',os.cpu_count(),'store','Number of cpus which are available'),
-
-#     # Compression options
-#     (['-cmp','--compression'],str,1,'CMP','zstd','store','Compression method from Blosc library (zstd (default),blosclz, lz4, lz4hc, zlib or snappy)'),
-#     (['-cl','--clevel'],int,1,'CLV',5,'store','Compression level : Integer 0-9 (default 5)'),
-#     (['-sh','--shuffle'],int,1,'SHF',1,'store','Shuffle option integer: NOSHUFFLE (0), SHUFFLE (1), BITSHUFFLE (2) or AUTOSHUFFLE (-1) (default 1)'),
-#     (['-bk','--blocksize'],int,1,'BLK',0,'store','The requested size of the compressed blocks. If 0 (default), an automatic blocksize will be used'),
-#     ]
-
-# switch = [
-#     (['-v', '--verbose'], 0,'count','Verbose output : additive more v = greater level of verbosity'),
-#     (['-md5'], False,'store_true','Calculate MD5 checksum of archive and save to txt file'),
-#     (['-md5_verify'], False,'store_true','After calculating the MD5 checksum, read saved file and verify the match'),
-#     ]
-
-# for var,v_type,nargs,v_help in positional:
-#     parser.add_argument(var, type=v_type, nargs=nargs,help=v_help)
-
-# for var,v_type,nargs,metavar,default,action,v_help in optional:
-#     parser.add_argument(*var,type=v_type,nargs=nargs,metavar=metavar,default=default,action=action,help=v_help)
-
-# for var,default,action,v_help in switch:
-#     parser.add_argument(*var,default=default,action=action,help=v_help)
-
-# args = parser.parse_args()
-
-# in_dir = args.input_dir[0]
-# out_zip = args.output_zip
-# if out_zip is None:
-#     out_zip = in_dir + '.zip'
-# else:
-#     out_zip = out_zip[0]
-# cpu = args.cpu
-
-# compressor = Blosc(
-#     cname=args.compression, 
-#     clevel=args.clevel, 
-#     shuffle=args.shuffle, 
-#     blocksize=args.blocksize
-#     )
-
-# verbose = args.verbose
-# md5 = args.md5
-# md5_verify = args.md5_verify
-# if md5_verify:
-#     md5 = True
-
-# verbose = args.verbose
-
-# if verbose > 2:
-#     print(args)
+    def get(self):
+        myzip = getattr(self.local, 'zip', None)
+        if myzip is None:
+            myzip = self.local.zip = ZipFile(self.archive_location, 'r')
+            with self.lock:
+                self.opened.append(myzip)
+        return myzip
+    
+    def close(self):
+        for myzip in self.opened:
+            myzip.close()
+        self.opened = []
+
+
+class _ArchiveMap:
+    '''
+    Stored (uncompressed by ZIP) members of an archive read as memoryviews of
+    a memory map of the member, so their bytes are not copied before they are
+    decoded, or with one pread when they are smaller than MAP_THRESHOLD.  A
+    map is closed when the last view of it is released.
+    '''
+    def __init__(self, archive_location):
+        self.archive_location = archive_location
+        self.lock = threading.Lock()
+        self.file = None
+    
+    def read(self, zinfo):
+        '''
+        Data of member zinfo after checking its CRC (see get_range), None if
+        the member can not be mapped (compressed or encrypted by ZIP)
+        '''
+        if zinfo.compress_type != ZIP_STORED or zinfo.flag_bits & 0x1:
+            return None
+        
+        # The data follows the local header (30 bytes + name + extra field)
+        header = os.pread(self.fileno(), 30, zinfo.header_offset)
+        if header[:4] != b'PK\x03\x04':
+            raise BadZipFile(f'Bad magic number for file header of {zinfo.filename!r}')
+        name_length, extra_length = struct.unpack_from('<HH', header, 26)
+        offset = zinfo.header_offset + 30 + name_length + extra_length
+        return self.get_range(zinfo.filename, offset, zinfo.compress_size, zinfo.CRC)
+    
+    def fileno(self):
+        if self.file is None:
+            with self.lock:
+                if self.file is None:
+                    self.file = open(self.archive_location, 'rb', buffering=0)
+        return self.file.fileno()
+    
+    def map_range(self, name, offset, size, crc):
+        '''
+        memoryview of the size bytes of member name stored at offset, after
+        checking their CRC
+        '''
+        if size == 0:
+            return memoryview(b'')
+        start = offset - offset % mmap.ALLOCATIONGRANULARITY
+        mapped = mmap.mmap(self.fileno(), offset - start + size, access=mmap.ACCESS_READ, offset=start)
+        view = memoryview(mapped)[offset - start:]
+        if zlib.crc32(view) != crc:
+            raise BadZipFile(f'Bad CRC-32 for file {name!r}')
+        return view
+    
+    def read_range(self, name, offset, size, crc):
+        '''
+        The size bytes of member name stored at offset (one pread), after
+        checking their CRC
+        '''
+        data = os.pread(self.fileno(), size, offset)
+        if len(data) != size:
+            raise BadZipFile(f'Truncated data for file {name!r}')
+        if zlib.crc32(data) != crc:
+            raise BadZipFile(f'Bad CRC-32 for file {name!r}')
+        return data
+    
+    def get_range(self, name, offset, size, crc):
+        '''
+        map_range for members of at least MAP_THRESHOLD bytes, read_range for
+        smaller ones
+        '''
+        if size >= MAP_THRESHOLD:
+            return self.map_range(name, offset, size, crc)
+        return self.read_range(name, offset, size, crc)
+    
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class _IndexedRecords(Mapping):
+    '''
+    Entries of the manifest that have field, their records decoded from the
+    entry index one at a time: name -> record[field] (or the whole record)
+    '''
+    def __init__(self, index, field, whole=False):
+        self.index = index
+        self.field = field
+        self.whole = whole
+    
+    def __getitem__(self, name):
+        record = self.index.entry(name)
+        if record is None or self.field not in record:
+            raise KeyError(name)
+        return record if self.whole else record[self.field]
+    
+    def get(self, name, default=None):
+        record = self.index.entry(name)
+        if record is None or self.field not in record:
+            return default
+        return record if self.whole else record[self.field]
+    
+    def __contains__(self, name):
+        record = self.index.entry(name)
+        return record is not None and self.field in record
+    
+    def __iter__(self):
+        for name, record in self.index.entries():
+            if self.field in record:
+                yield name
+    
+    def __len__(self):
+        return sum(1 for _ in self)
 
 
-class alt_zip:
+class alt_zip(Mapping):
+    '''
+    Read only Mapping of entry name -> decompressed bytes over a compress_dir
+    archive
+    
+    Stored bytes are read from a memory map of the archive (or one ZipFile
+    handle per thread) for random access and decoded
+    entries are held in a LRU cache of up to cache_bytes (default 256MB,
+    0 disables the cache).  Cache hits / misses are available in cache_info.
+    
+    Small files that compress_dir packed into blocks are read by decoding
+    their block, decoded blocks are held in a separate LRU cache of up to
+    block_cache_bytes (default 64MB) so neighbouring files are cheap to read.
     
-    uncompressed_metadata_files = ('compressor.json',)
+    Large files that compress_dir split into parts are reassembled.  extract
+    decodes the parts in parallel and writes each one straight to its offset
+    in the output file so the whole file is never held in RAM.
     
-    def __init__(self, archive_location, output_location = None, compressor=None, list_all=None):
+    If the archive has an entry index (<archive>.idx, see entry_index) it is
+    opened without zipfile and without loading manifest.json: members and
+    entries are found through the hash table of the memory mapped index, the
+    manifest record of an entry is decoded when it is used and stored bytes
+    are read straight from their offset in the archive.  entries is then a
+    lazy sequence over the index (in name order) and manifest is only loaded
+    if it is accessed.
+    
+    The index archive of a sharded archive (compress_dir -shards) is opened
+    the same way: entries are read from the shard that holds them, each shard
+    is opened (as an alt_zip without its own cache) the first time it is
+    needed.
+    '''
+    
+    uncompressed_metadata_files = ('compressor.json', 'manifest.json')
+    
+    def __init__(self, archive_location, output_location = None, compressor=None, list_all=None, cache_bytes=2**28,
+                 block_cache_bytes=2**26):
         
         self.archive_location = archive_location
+        self._opened_shards = {}
+        self._shard_lock = threading.Lock()
+        self._handles = _ThreadHandles(archive_location)
+        self._map = _ArchiveMap(archive_location)
         self.list_entries_in_archive()
+        self.cache = LRUCache(cache_bytes)
+        self.block_cache = LRUCache(block_cache_bytes)
         
         if list_all:
             print(self.entries)
@@ -103,31 +271,316 @@ class alt_zip:
             self.form_compressor_from_metadata()
         else:
             self.compressor = compressor
+            self._compressors = {}
+        self.get_manifest()
         
         self.output_location = output_location
     
     def get_compression_metadata(self):
         
-        if 'compressor.json' in self.entries:
-            with ZipFile(self.archive_location, 'r') as myzip:
-                    with myzip.open('compressor.json') as myfile:
-                        self.compressor_json = json.load(myfile)
+        if self._has_member('compressor.json'):
+            self.compressor_json = json.loads(bytes(self._read_member('compressor.json', self._handles)))
+    
+    @property
+    def manifest(self):
+        '''
+        manifest.json (per entry size and checksum) or None if the archive
+        does not have one.  With an entry index it is loaded on first use.
+        '''
+        if self._manifest is None and self._index is not None and self._index.settings is not None:
+            self._manifest = json.loads(bytes(self._read_member('manifest.json', self._handles)))
+        return self._manifest
     
-    def form_compressor_from_metadata(self):
+    def get_manifest(self):
+        '''
+        Load manifest.json (per entry size and checksum) if it is present
+        '''
+        self._manifest = None
+        self.refs = {}
+        self.packed = {}
+        self.split = {}
+        self.codecs = {}
+        if self._index is not None:
+            # Records are decoded from the index when an entry is used
+            self.refs = _IndexedRecords(self._index, 'ref')
+            self.codecs = _IndexedRecords(self._index, 'codec')
+            self.packed = _IndexedRecords(self._index, 'block', whole=True)
+            self.split = _IndexedRecords(self._index, 'parts', whole=True)
+        elif 'manifest.json' in self._entry_set:
+            self._manifest = json.loads(bytes(self._read_member('manifest.json', self._handles)))
+            
+            # Deduplicated files are not stored as members, they refer to the
+            # member holding identical content
+            self.refs = {
+                name:record['ref'] for name, record in self.manifest['entries'].items() if 'ref' in record
+                }
+            # Entries compressed with settings chosen by compress_dir -auto
+            # record their own codec
+            self.codecs = {
+                name:record['codec'] for name, record in self.manifest['entries'].items() if 'codec' in record
+                }
+            
+            # Packed files are stored at an offset within a block member
+            self.packed = {
+                name:record for name, record in self.manifest['entries'].items() if 'block' in record
+                }
+            # Large files are stored as numbered part members
+            self.split = {
+                name:record for name, record in self.manifest['entries'].items() if 'parts' in record
+                }
+            if self.refs or self.packed or self.split:
+                self.entries = self.entries + tuple(
+                    x for x in self.manifest['entries']
+                    if x not in self._entry_set and (x in self.refs or x in self.packed or x in self.split)
+                    )
+                self._entry_set = frozenset(self.entries)
+    
+    def form_compressor_from_metadata(self, entry=None):
+        '''
+        Form the archive compressor from compressor.json.  With entry, return
+        the compressor for that member: its own codec from the manifest if it
+        has one (mixed-codec archives), otherwise the archive compressor.
+        '''
+        if entry is None:
+            self.compressor = compressor_from_config(self.compressor_json)
+            self._compressors = {}
+            return self.compressor
         
-        if self.compressor_json['id'] == 'blosc':
-            self.compressor = Blosc(
-                cname=self.compressor_json['cname'], 
-                clevel=self.compressor_json['clevel'], 
-                shuffle=self.compressor_json['shuffle'], 
-                blocksize=self.compressor_json['blocksize']
-                )
+        codec = self.codecs.get(entry)
+        if codec is None:
+            return self.compressor
+        key = json.dumps(codec, sort_keys=True)
+        compressor = self._compressors.get(key)
+        if compressor is None:
+            compressor = self._compressors.setdefault(key, compressor_from_config(codec))
+        return compressor
         
     def list_entries_in_archive(self):
-        with ZipFile(self.archive_location, 'r') as myzip:
-            self.entries = tuple(myzip.namelist())
+        # Direct reads need pread
+        self._index = load_index(self.archive_location) if hasattr(os, 'pread') else None
+        if self._index is not None:
+            self._infos = None
+            self.entries = self._index.names(exclude_prefix=INTERNAL_PREFIX)
+            self._entry_set = self.entries
+        else:
+            # The ZipFile handle of this thread is kept for reading
+            self._infos = {x.filename:x for x in self._handles.get().infolist()}
+            self.entries = tuple(x for x in self._infos if not x.startswith(INTERNAL_PREFIX))
+            self._entry_set = frozenset(self.entries)
+        
+        # Index of a sharded archive: the entries are in the shards
+        self.shards = None
+        self.shard_of = {}
+        if self._has_member(SHARD_INDEX_NAME):
+            index = json.loads(bytes(self._read_member(SHARD_INDEX_NAME, self._handles)))
+            directory = os.path.dirname(self.archive_location)
+            self.shards = [os.path.join(directory, x) for x in index['shards']]
+            self.shard_of = index['entries']
+            self.entries = tuple(self.shard_of)
+            self._entry_set = frozenset(self.entries)
+    
+    def _has_member(self, member):
+        if self._index is not None:
+            return self._index.is_member(member)
+        return member in self._infos
+    
+    def _stored_size(self, member):
+        '''
+        Size of the stored (compressed) bytes of a ZIP member
+        '''
+        if self._index is not None:
+            return self._index.get(member).compress_size
+        return self._infos[member].compress_size
+    
+    def _shard(self, idx):
+        '''
+        alt_zip of shard idx of a sharded archive, opened once
+        '''
+        shard = self._opened_shards.get(idx)
+        if shard is None:
+            with self._shard_lock:
+                shard = self._opened_shards.get(idx)
+                if shard is None:
+                    shard = self._opened_shards[idx] = alt_zip(
+                        self.shards[idx], compressor=self.compressor, cache_bytes=0,
+                        block_cache_bytes=self.block_cache.max_bytes
+                        )
+        return shard
+    
+    def _extract_shards(self, output_location, to_get, workers, max_in_flight_bytes):
+        '''
+        extract for a sharded archive: the entries of each shard are extracted
+        by that shard, one shard after the other with all workers
+        '''
+        groups = {}
+        for entry in to_get:
+            groups.setdefault(self.shard_of[entry], []).append(entry)
+        
+        buffers = {}
+        totals = {'entries': 0, 'bytes_in': 0, 'bytes_out': 0}
+        start = time.time()
+        for idx, group in sorted(groups.items()):
+            shard = self._shard(idx)
+            data = shard.extract(output_location, files=group, workers=workers, max_in_flight_bytes=max_in_flight_bytes)
+            if output_location is None:
+                buffers.update(data if len(group) > 1 else {group[0]: data})
+            for key in totals:
+                totals[key] += shard.last_extract[key]
+        seconds = time.time() - start
+        
+        self.last_extract = dict(totals, seconds=seconds,
+                                 MB_per_second=totals['bytes_out'] / 2**20 / seconds if seconds > 0 else 0)
+        return buffers
+        
+    def _member(self, entry):
+        '''
+        Name of the ZIP member that stores entry
+        '''
+        return self.refs.get(entry, entry)
+    
+    def _read_stored(self, entry, handles):
+        '''
+        Read the stored (compressed) bytes of entry, a memoryview of the
+        archive map or bytes read using handles
+        '''
+        return self._read_member(self._member(entry), handles)
+    
+    def _read_member(self, member, handles):
+        '''
+        Read the stored bytes of a ZIP member: at its offset from the entry
+        index (memory mapped from MAP_THRESHOLD bytes), from a memory map of
+        the member or using handles
+        '''
+        if self._index is not None:
+            record = self._index.get(member)
+            if record is None:
+                raise KeyError(f"There is no item named {member!r} in the archive")
+            if record.compress_type == ZIP_STORED and not record.flag_bits & 0x1:
+                if workers.ZERO_COPY:
+                    return self._map.get_range(member, record.data_offset, record.compress_size, record.CRC)
+                return self._map.read_range(member, record.data_offset, record.compress_size, record.CRC)
+        elif workers.ZERO_COPY and hasattr(os, 'pread'):
+            data = self._map.read(self._infos[member])
+            if data is not None:
+                return data
+        with handles.get().open(member) as myfile:
+            return myfile.read()
+    
+    def _decode(self, entry, data, buffer=None):
+        '''
+        Decompress the stored bytes of an entry
+        
+        buffer:     optional function that returns a writable buffer of n
+                    bytes, Blosc data is decoded straight into it
+        '''
+        if entry in self.uncompressed_metadata_files:
+            return bytes(data)
+        compressor = self.form_compressor_from_metadata(entry)
+        if compressor.codec_id == 'blosc':
+            nbytes = blosc_nbytes(data)
+            if nbytes == 0:
+                # Blosc refuses to decompress a frame for an empty file
+                return b''
+            if buffer is not None:
+                return compressor.decode(data, out=buffer(nbytes))
+        return compressor.decode(data)
+    
+    def _load(self, entry, handles):
+        '''
+        Read and decode an entry, following references and slicing packed
+        files out of their block
+        
+        Returns (stored bytes read from the archive, decoded data).  A packed
+        file whose block is already cached reads 0 stored bytes.
+        '''
+        member = self._member(entry)
+        if member in self.split:
+            stored = 0
+            pieces = []
+            for idx in range(len(self.split[member]['parts'])):
+                data = self._read_stored(part_name(member, idx), handles)
+                stored += len(data)
+                pieces.append(self._decode(member, data))
+            return stored, b''.join(pieces)
+        
+        record = self.packed.get(member)
+        if record is None:
+            data = self._read_stored(member, handles)
+            return len(data), self._decode(member, data)
+        
+        block_name = record['block']
+        stored = 0
+        block = self.block_cache.get(block_name)
+        if block is None:
+            block = self._read_stored(block_name, handles)
+            stored = len(block)
+            block = self._decode(block_name, block)
+            self.block_cache.put(block_name, block)
+        offset = record['offset']
+        return stored, bytes(block[offset:offset + record['size']])
+    
+    def _extract_entry(self, entry, output_location, handles, reuse_limit=REUSE_LIMIT):
+        '''
+        Read, decode and (optionally) write one entry.  Runs on a worker thread
+        using that thread's own ZipFile handle, the thread keeps a decode
+        buffer of at most reuse_limit bytes (see workers.thread_buffer).
+        
+        Returns (stored bytes, decoded bytes, data) where data is None when the
+        entry was written to output_location
+        '''
+        member = self._member(entry)
+        if output_location is not None and workers.ZERO_COPY and member not in self.packed and member not in self.split:
+            # The decoded data is only written, decode it into the reusable
+            # buffer of this thread
+            data = self._read_stored(member, handles)
+            stored = len(data)
+            tmp_file = self._decode(member, data, lambda nbytes: thread_buffer(nbytes, reuse_limit))
+        else:
+            # Read and decompress entry
+            stored, tmp_file = self._load(entry, handles)
+        decoded = len(tmp_file)
+        
+        # Return bytes object if file location is not specified
+        if output_location is None:
+            return stored, decoded, tmp_file
+        
+        # Write decompressed file to disk
+        with open(os.path.join(output_location,entry),'wb') as f:
+            f.write(tmp_file)
+        return stored, decoded, None
+    
+    def _extract_part(self, entry, idx, out_file, offset, handles):
+        '''
+        Read and decode one part of a split entry and write it at offset in
+        out_file (which must already exist)
+        
+        Returns (stored bytes, decoded bytes, None)
+        '''
+        member = self._member(entry)
+        data = self._read_stored(part_name(member, idx), handles)
+        stored = len(data)
+        compressor = self.form_compressor_from_metadata(member)
+        if workers.ZERO_COPY and compressor.codec_id == 'blosc':
+            # Decode straight into a memory map of the range of out_file
+            size = self.split[member]['parts'][idx]['size']
+            return stored, decode_to_range(data, compressor, out_file, offset, size), None
+        data = self._decode(member, data)
+        write_range(out_file, offset, data)
+        return stored, len(data), None
+    
+    def extract(self, output_location=None, files='*', workers=None, max_in_flight_bytes=None):
+        '''
+        Extract entries to output_location or return them as bytes
         
-    def extract(self, output_location=None, files='*'):
+        Entries are read and decoded on a pool of threads (Blosc releases the
+        GIL), each thread using its own ZipFile handle.  workers=1 extracts
+        sequentially in the calling thread.  At most max_in_flight_bytes of
+        stored data (default 1GB) is being read / decoded at any time, the
+        decode buffers that the threads keep between entries use at most a
+        quarter of max_in_flight_bytes and are released when it returns.
+        
+        Throughput for the run is stored in self.last_extract
+        '''
         
         if output_location is None:
             buffers = {}
@@ -141,51 +594,115 @@ class alt_zip:
         
         # assert output_location is not None and isinstance(output_location,str), 'Output location must be defined when extracting archive'
         
-        if isinstance(files, str):
+        if files == '*':
+            to_get = self.entries
+        elif isinstance(files, str):
             to_get = [files]
         elif isinstance(files, (list,tuple)):
             to_get = files
-        elif files == '*':
-            to_get = self.entries
         
-        print(to_get)
-        assert all([x in self.entries for x in to_get]), 'A file is not located in the zip archive'
+        if files != '*':
+            assert all([x in self._entry_set for x in to_get]), 'A file is not located in the zip archive'
+        
+        if self.shards is not None:
+            buffers = self._extract_shards(output_location, to_get, workers, max_in_flight_bytes)
+            if output_location is not None or len(buffers) == 0:
+                return None
+            return buffers[to_get[0]] if len(buffers) == 1 else {x:buffers[x] for x in to_get}
+        
+        builtins.print(f'Extracting {len(to_get)} files from archive to location: {output_location}')
+        
+        if output_location is not None:
+            # Ensure that directories exist, each is created only once
+            directories = {os.path.dirname(os.path.join(output_location,entry)) for entry in to_get}
+            for directory in sorted(directories):
+                os.makedirs(directory, exist_ok=True)
+        
+        if workers is None:
+            workers = os.cpu_count() or 1
+        if max_in_flight_bytes is None:
+            max_in_flight_bytes = 2**30
+        # Decode buffers kept by the worker threads
+        reuse_limit = buffer_limit(max_in_flight_bytes, workers)
+        
+        stored_size = self._stored_size
         
-        print(f'Extracting files from archive to location: {output_location}')
+        def item_bytes(key, args):
+            if isinstance(key, tuple):
+                # Part of a split entry
+                return stored_size(part_name(self._member(key[0]), key[1]))
+            member = self._member(key)
+            if member in self.split:
+                return sum(stored_size(part_name(member, idx)) for idx in range(len(self.split[member]['parts'])))
+            if member in self.packed:
+                return stored_size(self.packed[member]['block'])
+            return stored_size(member)
         
-        with ZipFile(self.archive_location, 'r') as myzip:
+        # Number of parts still to be written for each split entry
+        parts_left = {}
+        
+        def tasks():
             for entry in to_get:
+                member = self._member(entry)
+                if output_location is None or member not in self.split:
+                    yield entry, (self._extract_entry, entry, output_location, handles, reuse_limit)
+                    continue
                 
-                # Read entry
-                with myzip.open(entry) as myfile:
-                    tmp_file = myfile.read()
-                
-                # Decompress entry
-                print(f'Decompressing {entry}')
-                if entry not in self.uncompressed_metadata_files:
-                    if self.compressor_json['id'] == 'blosc':
-                        tmp_file = self.compressor.decode(tmp_file)
-                
-                # Return bytes object if file location is not specified
-                if output_location is None:
-                    buffers[entry] = tmp_file
-                else:
-                    # Make output file name
-                    output_file_name = os.path.join(output_location,entry)
-                    
-                    # Ensure that directories exist
-                    os.makedirs(os.path.split(output_file_name)[0], exist_ok=True)
-                    
-                    # Write decompressed file to disk
-                    with open(output_file_name,'wb') as f:
-                        f.write(tmp_file)
+                # Parts are written straight to their offset in the output
+                out_file = os.path.join(output_location, entry)
+                parts = self.split[member]['parts']
+                with open(out_file, 'wb') as f:
+                    f.truncate(sum(x['size'] for x in parts))
+                parts_left[entry] = len(parts)
+                offset = 0
+                for idx, part in enumerate(parts):
+                    yield (entry, idx), (self._extract_part, entry, idx, out_file, offset, handles)
+                    offset += part['size']
+        
+        handles = _ThreadHandles(self.archive_location)
+        start = time.time()
+        bytes_in = 0
+        bytes_out = 0
+        try:
+            pool = ThreadPoolExecutor(max_workers=workers) if workers > 1 else SyncExecutor()
+            with pool:
+                for key, (stored, decoded, data) in bounded_as_completed(
+                        pool, call, tasks(), 2 * workers,
+                        max_bytes=max_in_flight_bytes, item_bytes=item_bytes
+                        ):
+                    bytes_in += stored
+                    bytes_out += decoded
+                    if isinstance(key, tuple):
+                        parts_left[key[0]] -= 1
+                        if parts_left[key[0]] == 0:
+                            release_file(os.path.join(output_location, key[0]), 'r+b')
+                    elif output_location is None:
+                        buffers[key] = data
+        finally:
+            handles.close()
+            # Decode buffers (kept by this thread when workers=1)
+            release_buffers()
+            for entry in parts_left:
+                release_file(os.path.join(output_location, entry), 'r+b')
+        
+        seconds = time.time() - start
+        self.last_extract = {
+            'entries': len(to_get),
+            'bytes_in': bytes_in,
+            'bytes_out': bytes_out,
+            'seconds': seconds,
+            'MB_per_second': bytes_out / 2**20 / seconds if seconds > 0 else 0
+            }
+        builtins.print(f'Extracted {len(to_get)} files ({round(bytes_out / 2**20, 2)} MB) in {round(seconds, 2)} seconds: '
+                       f'{round(self.last_extract["MB_per_second"], 2)} MB/s')
         
         if output_location is None:
             if len(buffers) == 1:
                 for key, value in buffers.items():
                     return value
             elif len(buffers) > 1:
-                return buffers
+                # Return in the order requested
+                return {x:buffers[x] for x in to_get}
             elif len(buffers) == 0:
                 return None
     
@@ -193,7 +710,112 @@ class alt_zip:
         '''
         Retrieves an item from zip archive and return bytes
         '''
-        return self.extract(output_location=None, files=entry_name)
+        if entry_name not in self._entry_set:
+            raise KeyError(entry_name)
+        
+        data = self.cache.get(entry_name)
+        if data is None and self.shards is not None:
+            data = self._shard(self.shard_of[entry_name])[entry_name]
+            self.cache.put(entry_name, data)
+        elif data is None:
+            _, data = self._load(entry_name, self._handles)
+            self.cache.put(entry_name, data)
+        return data
+    
+    def _verify_entry(self, entry, checksum, expected, handles):
+        try:
+            _, data = self._load(entry, handles)
+        except Exception:
+            # CRC or decompression errors
+            return False
+        return len(data) == expected['size'] and hash_bytes(data, checksum) == expected['digest']
+    
+    def _verify_part(self, entry, idx, checksum, expected, handles):
+        try:
+            data = self._decode(entry, self._read_stored(part_name(entry, idx), handles))
+        except Exception:
+            return False
+        return len(data) == expected['size'] and hash_bytes(data, checksum) == expected['digest']
+    
+    def verify(self, workers=None):
+        '''
+        Decode every entry listed in the manifest in parallel and check its
+        size and checksum.  The parts of split entries are checked in
+        parallel.  Returns a list of entries that failed.
+        
+        The shards of a sharded archive are verified one after the other.
+        '''
+        if self.shards is not None:
+            failed = []
+            for idx in range(len(self.shards)):
+                failed.extend(self._shard(idx).verify(workers=workers))
+            return sorted(failed)
+        
+        settings = self._index.settings if self._index is not None else self.manifest
+        assert settings is not None, 'Archive does not contain a manifest with checksums'
+        checksum = settings.get('checksum')
+        if checksum is None:
+            raise ValueError(f'{self.archive_location} was written without per-entry checksums (compress_dir -hash), '
+                             'it can not be verified')
+        # Records of the entries, from the index without loading the manifest
+        records = self._index.entries() if self._index is not None else self.manifest['entries'].items()
+        
+        if workers is None:
+            workers = os.cpu_count() or 1
+        
+        def tasks():
+            for entry, expected in records:
+                if 'parts' not in expected:
+                    yield entry, (self._verify_entry, entry, checksum, expected, handles)
+                    continue
+                for idx, part in enumerate(expected['parts']):
+                    yield (entry, idx), (self._verify_part, entry, idx, checksum, part, handles)
+        
+        failed = set()
+        handles = _ThreadHandles(self.archive_location)
+        try:
+            pool = ThreadPoolExecutor(max_workers=workers) if workers > 1 else SyncExecutor()
+            with pool:
+                for key, passed in bounded_as_completed(pool, call, tasks(), 2 * workers):
+                    if not passed:
+                        failed.add(key[0] if isinstance(key, tuple) else key)
+        finally:
+            handles.close()
+        return sorted(failed)
+    
+    def __contains__(self, entry_name):
+        return entry_name in self._entry_set
+    
+    def __iter__(self):
+        return iter(self.entries)
+    
+    def __len__(self):
+        return len(self.entries)
+    
+    @property
+    def cache_info(self):
+        return self.cache.stats
+    
+    def close(self):
+        '''
+        Close all open ZipFile handles, the archive map and the opened shards
+        and empty the cache
+        '''
+        self._handles.close()
+        self._map.close()
+        if self._index is not None:
+            self._index.close()
+        for shard in self._opened_shards.values():
+            shard.close()
+        self._opened_shards = {}
+        self.cache.clear()
+        self.block_cache.clear()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *args):
+        self.close()
     
     # def __setitem__(self,entry_name, value):
     #     '''
@@ -207,33 +829,3 @@ class alt_zip:
     #         value_type = 'file'
     #     elif value_type is None:
     #         assert False, 'bytes object or filename is required'
-
-
-# if __name__ == '__main__':
-#     start = time.time()
-#     # run()
-#     compress_dir(in_dir, out_zip, compressor, verbose=verbose, md5=md5, md5_verify=md5_verify)
-#     finished = round(time.time()-start,2)
-#     print(f'Completed in {finished} seconds')
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+"""
+Sample based selection of Blosc settings.
+
+A small sample of a file is compressed with every combination of cname,
+clevel, shuffle and blocksize in a grid and the best setting is chosen for an
+objective:
+
+    ratio:  highest compression ratio that compresses at least min_speed MB/s
+    speed:  fastest compression that reaches at least min_ratio
+
+Files are tuned in groups (by extension and typesize): the first file of a
+group large enough to sample decides for the whole group.  Decisions are
+saved to a json cache (default ~/.cache/compression_tools/autotune.json) and
+reused by later runs with the same objective.
+
+Speeds are measured for a single encode call on the calling thread, ie the
+throughput of one worker.
+"""
+
+import json
+import os
+import threading
+import time
+
+from compression_tools.typesize import typed_view
+
+OBJECTIVES = ('ratio', 'speed')
+
+DEFAULT_GRID = {
+    'cname': ('lz4', 'zstd', 'zlib'),
+    'clevel': (1, 5, 9),
+    # NOSHUFFLE, SHUFFLE, BITSHUFFLE
+    'shuffle': (0, 1, 2),
+    'blocksize': (0, 2**17),
+    }
+
+DEFAULT_SAMPLE_BYTES = 2**20
+# Files smaller than this are not sampled, their group uses the default
+# compressor until a larger file is seen
+MIN_SAMPLE_BYTES = 2**12
+
+DEFAULT_CACHE = os.path.join(os.path.expanduser('~'), '.cache', 'compression_tools', 'autotune.json')
+
+# Tuners of one process (ie the jobs of compress_dirs) save the cache one at a
+# time
+_SAVE_LOCK = threading.Lock()
+
+
+def load_cache(cache_location):
+    '''
+    Decisions of the json cache, empty if it does not exist or can not be
+    read (ie a file truncated by a run that was killed)
+    '''
+    if cache_location is None or not os.path.exists(cache_location):
+        return {}
+    try:
+        with open(cache_location, 'r') as f:
+            cache = json.load(f)
+    except (ValueError, OSError):
+        return {}
+    return cache if isinstance(cache, dict) else {}
+
+
+def grid_configs(grid=None):
+    '''
+    Every Blosc config in grid (a dict of option -> values)
+    '''
+    grid = DEFAULT_GRID if grid is None else grid
+    configs = [{'id': 'blosc'}]
+    for option in ('cname', 'clevel', 'shuffle', 'blocksize'):
+        configs = [dict(config, **{option: value}) for config in configs for value in grid[option]]
+    return configs
+
+
+def read_sample(filename, sample_bytes=DEFAULT_SAMPLE_BYTES, pieces=4, typesize=1):
+    '''
+    Read about sample_bytes from pieces evenly spaced ranges of filename so
+    that the sample represents the whole file.  Ranges start and end on
+    element boundaries.
+    '''
+    # Opened here rather than through the shared handles of workers.py, which
+    # stay open until released
+    with open(filename, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size <= sample_bytes:
+            return f.read()
+        length = sample_bytes // pieces // typesize * typesize
+        step = (size - length) // (pieces - 1) // typesize * typesize
+        pieces_read = []
+        for idx in range(pieces):
+            f.seek(idx * step)
+            pieces_read.append(f.read(length))
+        return b''.join(pieces_read)
+
+
+def measure(sample, config, typesize=1):
+    '''
+    Returns (compression ratio, compression MB/s) of config on sample
+    '''
+    from numcodecs import Blosc
+    compressor = Blosc(
+        cname=config['cname'],
+        clevel=config['clevel'],
+        shuffle=config['shuffle'],
+        blocksize=config['blocksize']
+        )
+    data = typed_view(sample, typesize)[0]
+    start = time.perf_counter()
+    compressed = compressor.encode(data)
+    seconds = max(time.perf_counter() - start, 1e-9)
+    return len(sample) / len(compressed), len(sample) / 2**20 / seconds
+
+
+def search(sample, configs, typesize=1, objective='ratio', min_speed=None, min_ratio=None):
+    '''
+    Measure configs on sample, returns [(config, ratio, MB/s)]
+
+    Higher clevels are slower and compress more, so for each cname / shuffle /
+    blocksize clevels are tried in increasing order and the remaining levels
+    are skipped once they can no longer be chosen: for 'ratio' when a level is
+    slower than min_speed, for 'speed' when a level already reaches min_ratio.
+    '''
+    groups = {}
+    for config in configs:
+        key = (config['cname'], config['shuffle'], config['blocksize'])
+        groups.setdefault(key, []).append(config)
+
+    results = []
+    for group in groups.values():
+        for config in sorted(group, key=lambda x: x['clevel']):
+            ratio, speed = measure(sample, config, typesize)
+            results.append((config, ratio, speed))
+            if objective == 'ratio' and min_speed is not None and speed < min_speed:
+                break
+            if objective == 'speed' and min_ratio is not None and ratio >= min_ratio:
+                break
+    return results
+
+
+def choose(results, objective='ratio', min_speed=None, min_ratio=None):
+    '''
+    Pick the best config from results [(config, ratio, MB/s)] for objective
+
+    If no config meets the constraint, the one closest to meeting it is
+    returned (fastest for 'ratio', highest ratio for 'speed').
+    '''
+    assert objective in OBJECTIVES, f'objective must be one of {OBJECTIVES}'
+    if objective == 'ratio':
+        passing = [x for x in results if min_speed is None or x[2] >= min_speed]
+        if not passing:
+            return max(results, key=lambda x: x[2])[0]
+        return max(passing, key=lambda x: (x[1], x[2]))[0]
+    passing = [x for x in results if min_ratio is None or x[1] >= min_ratio]
+    if not passing:
+        return max(results, key=lambda x: x[1])[0]
+    return max(passing, key=lambda x: (x[2], x[1]))[0]
+
+
+class AutoTuner:
+    '''
+    Chooses and caches a Blosc config for each group of files
+
+    objective:      'ratio' (subject to min_speed MB/s) or 'speed' (subject
+                    to min_ratio)
+    grid:           dict of option -> values to try (default DEFAULT_GRID)
+    cache_location: json file of previous decisions, None disables the cache
+    '''
+
+    def __init__(self, objective='ratio', min_speed=100, min_ratio=None, grid=None,
+                 sample_bytes=DEFAULT_SAMPLE_BYTES, cache_location=DEFAULT_CACHE, verbose=0):
+        assert objective in OBJECTIVES, f'objective must be one of {OBJECTIVES}'
+        self.objective = objective
+        self.min_speed = min_speed
+        self.min_ratio = min_ratio
+        self.configs = grid_configs(grid)
+        self.sample_bytes = sample_bytes
+        self.cache_location = cache_location
+        self.verbose = verbose
+        self.decisions = {}
+        self._lock = threading.Lock()
+        self._cache = load_cache(cache_location)
+
+    def group(self, filename, typesize=1):
+        '''
+        Key of the group that filename belongs to
+        '''
+        extension = os.path.splitext(filename)[1].lower()
+        return f'{extension}|{typesize}'
+
+    def _cache_key(self, group):
+        constraint = self.min_speed if self.objective == 'ratio' else self.min_ratio
+        return f'{group}|{self.objective}|{constraint}'
+
+    def tune(self, filename, typesize=1):
+        '''
+        Returns the Blosc config for filename, or None if its group has not
+        been decided yet and the file is too small to sample
+        '''
+        group = self.group(filename, typesize)
+        with self._lock:
+            if group in self.decisions:
+                return self.decisions[group]
+            config = self._cache.get(self._cache_key(group))
+            if config is None:
+                if os.path.getsize(filename) < MIN_SAMPLE_BYTES:
+                    return None
+                sample = read_sample(filename, self.sample_bytes, typesize=typesize)
+                results = search(sample, self.configs, typesize, self.objective, self.min_speed, self.min_ratio)
+                config = choose(results, self.objective, self.min_speed, self.min_ratio)
+                self._cache[self._cache_key(group)] = config
+                if self.verbose > 0:
+                    ratio, speed = [x[1:] for x in results if x[0] is config][0]
+                    print(f'Autotune {group}: {config} (ratio {ratio:.2f}, {speed:.1f} MB/s)')
+            self.decisions[group] = config
+            return config
+
+    def save(self):
+        '''
+        Write decisions to the json cache
+        
+        Decisions saved by other tuners since this one loaded the cache are
+        kept, and the cache is replaced atomically so a reader never sees a
+        partly written file.
+        '''
+        if self.cache_location is None:
+            return
+        with _SAVE_LOCK, self._lock:
+            os.makedirs(os.path.dirname(os.path.abspath(self.cache_location)), exist_ok=True)
+            cache = load_cache(self.cache_location)
+            cache.update(self._cache)
+            partial = f'{self.cache_location}.{os.getpid()}.partial'
+            with open(partial, 'w') as f:
+                f.write(json.dumps(cache, indent=4))
+            os.replace(partial, self.cache_location)
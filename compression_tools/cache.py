@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+Size bounded least-recently-used cache for decoded data.
+"""
+
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+    '''
+    Thread safe LRU cache that is bounded by the total size (in bytes) of the
+    cached values rather than by the number of items.
+
+    Values larger than max_bytes are never cached.  hits and misses are
+    counted on each call to get.
+    '''
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        size = len(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._data:
+                self.current_bytes -= len(self._data.pop(key))
+            while self._data and self.current_bytes + size > self.max_bytes:
+                _, evicted = self._data.popitem(last=False)
+                self.current_bytes -= len(evicted)
+            self._data[key] = value
+            self.current_bytes += size
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.current_bytes = 0
+
+    @property
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'items': len(self),
+            'bytes': self.current_bytes,
+            'max_bytes': self.max_bytes
+            }
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+Checksums for archives and their entries.
+
+Hashes are computed while data is produced rather than in extra passes: each
+entry is hashed by the worker that reads it, and the archive is hashed as it
+is written by wrapping the output file in a StreamWriter.
+
+MD5 is supported for compatibility, but blake2b (or xxhash when installed) is
+considerably faster.
+"""
+
+import hashlib
+
+from compression_tools.metrics import stage
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+HASHLIB_ALGORITHMS = ('md5', 'sha1', 'sha256', 'blake2b')
+XXHASH_ALGORITHMS = ('xxh64', 'xxh3_64', 'xxh3_128')
+
+
+def available_algorithms():
+    if xxhash is None:
+        return HASHLIB_ALGORITHMS
+    return HASHLIB_ALGORITHMS + XXHASH_ALGORITHMS
+
+
+def get_hasher(name):
+    '''
+    Return a new hash object (with update / hexdigest) for algorithm name
+    '''
+    if name in HASHLIB_ALGORITHMS:
+        return hashlib.new(name)
+    if name in XXHASH_ALGORITHMS:
+        if xxhash is None:
+            raise ValueError(f'{name} requires the xxhash package (pip install xxhash)')
+        return getattr(xxhash, name)()
+    raise ValueError(f'Unknown checksum algorithm {name}, options are: {", ".join(available_algorithms())}')
+
+
+def hash_bytes(data, name):
+    hasher = get_hasher(name)
+    hasher.update(data)
+    return hasher.hexdigest()
+
+
+class StreamWriter:
+    '''
+    Minimal write-only file wrapper used as the target of ZipFile.
+
+    The wrapper does not support seek so ZipFile writes every entry strictly
+    sequentially (using data descriptors) and never revisits earlier bytes.
+    This allows a checksum of the archive to be computed as it is written.
+    '''
+
+    def __init__(self, fileobj, hasher=None):
+        self.fileobj = fileobj
+        self.hasher = hasher
+        self.position = 0
+
+    def write(self, data):
+        if self.hasher is not None:
+            with stage('hash_archive') as s:
+                self.hasher.update(data)
+                s.add(len(data))
+        self.position += len(data)
+        with stage('write') as s:
+            s.add(len(data))
+            return self.fileobj.write(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        self.fileobj.flush()
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+Random access, file-like reader over a directory written by compress_file.
+
+Byte offsets in the original file are mapped to chunk files using the layout
+in metadata.json.  Only chunks touched by a read are decoded and they are kept
+in a size bounded LRU cache.  Optionally, when reads are sequential, the next
+chunk is decoded ahead of time on a background thread.
+
+with ChunkedFile('/output/acquisition.raw.compressed') as f:
+    f.seek(plane * plane_bytes + header_length)
+    plane = f.read(plane_bytes)
+"""
+
+import io
+import os
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor
+
+from compression_tools.alt_zip import compressor_from_config
+from compression_tools.cache import LRUCache
+from compression_tools.decompress_file import get_layout
+from compression_tools import workers
+from compression_tools.workers import read_bytes, read_bytes_into
+
+
+class ChunkedFile(io.RawIOBase):
+    '''
+    Read only io.RawIOBase over a compress_file chunk directory
+
+    in_dir:         directory written by compress_file
+    cache_bytes:    maximum size of decoded chunks held in the LRU cache
+                    (default: 2 chunks)
+    prefetch:       decode the next chunk on a background thread when reads
+                    are sequential
+    '''
+
+    def __init__(self, in_dir, cache_bytes=None, prefetch=False):
+        super().__init__()
+        self.in_dir = in_dir
+        self.name = in_dir
+        layout = get_layout(in_dir)
+        self.compressor = compressor_from_config(layout['compressor'])
+        self.size = layout['file_size']
+        self.header_length = layout['header_length']
+        self.chunk_size = layout['chunk_size']
+        self.segments = layout['segments']
+        self._starts = [x[1] for x in self.segments]
+
+        if cache_bytes is None:
+            cache_bytes = 2 * max([x[2] for x in self.segments], default=0)
+        self.cache = LRUCache(cache_bytes)
+
+        self.prefetch = prefetch
+        self._prefetcher = ThreadPoolExecutor(max_workers=1) if prefetch else None
+        self._prefetching = {}
+        self._last_segment = None
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self._position + offset
+        elif whence == io.SEEK_END:
+            position = self.size + offset
+        else:
+            raise ValueError(f'Invalid whence ({whence})')
+        if position < 0:
+            raise ValueError(f'Negative seek position {position}')
+        self._position = position
+        return position
+
+    def _segment_index(self, position):
+        '''
+        Index of the segment (header or chunk) that holds byte position
+        '''
+        return bisect_right(self._starts, position) - 1
+
+    def _decode(self, idx):
+        name = self.segments[idx][0]
+        # The compressed chunk is only needed until it is decoded, read it
+        # into the reusable buffer of this thread
+        read = read_bytes_into if workers.ZERO_COPY else read_bytes
+        return self.compressor.decode(read(os.path.join(self.in_dir, name)))
+
+    def _get_segment(self, idx):
+        data = self.cache.get(idx)
+        if data is not None:
+            return data
+
+        future = self._prefetching.pop(idx, None)
+        if future is not None:
+            data = future.result()
+        else:
+            data = self._decode(idx)
+        self.cache.put(idx, data)
+        return data
+
+    def _prefetch(self, idx):
+        if idx >= len(self.segments) or idx in self._prefetching or idx in self.cache:
+            return
+        # Forget prefetches for chunks that have already been passed
+        self._prefetching = {k: v for k, v in self._prefetching.items() if k >= idx - 1}
+        self._prefetching[idx] = self._prefetcher.submit(self._decode, idx)
+
+    def readinto(self, b):
+        self._checkClosed()
+        view = memoryview(b).cast('B')
+        wanted = len(view)
+        done = 0
+        while done < wanted and self._position < self.size:
+            idx = self._segment_index(self._position)
+            name, start, length = self.segments[idx]
+            data = self._get_segment(idx)
+
+            if self.prefetch and self._last_segment in (idx - 1, idx):
+                self._prefetch(idx + 1)
+            self._last_segment = idx
+
+            in_segment = self._position - start
+            n = min(wanted - done, length - in_segment)
+            view[done:done + n] = data[in_segment:in_segment + n]
+            done += n
+            self._position += n
+        return done
+
+    def close(self):
+        if self._prefetcher is not None:
+            self._prefetcher.shutdown(wait=True)
+            self._prefetcher = None
+        self._prefetching = {}
+        self.cache.clear()
+        super().close()
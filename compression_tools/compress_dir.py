@@ -10,211 +10,1071 @@ ZIP file and is independently compressed using a configurable compression codec
 only Blosc is implemented and ZSTD, clevel 5, SHUFFLE is default
 """
 
-import dask
-from dask import delayed
-import hashlib
 import json
 import time
 import glob
 import os
+from contextlib import nullcontext
+from itertools import chain
 from zipfile import ZipFile
-from numcodecs import Blosc
-from io import BytesIO
 
-import argparse
-import psutil
-psutil.virtual_memory()
+from compression_tools.alt_zip import BLOCK_PREFIX, SHARD_INDEX_NAME, alt_zip, compressor_from_config, part_name, shard_name
+from compression_tools.autotune import DEFAULT_CACHE, OBJECTIVES, AutoTuner
+from compression_tools.checksum import StreamWriter, available_algorithms, get_hasher
+from compression_tools.entry_index import write_index
+from compression_tools.memory import DEFAULT_MEMORY_FRACTION, fit_chunk_size, memory_budget, reserve_buffers, task_memory
+from compression_tools.manifest import Journal, load_manifest, member_data_offset, restore_entries, unchanged
+from compression_tools.metrics import Metrics, Progress, stage, timed_call
+from compression_tools.scan import DEFAULT_SCAN_THREADS, scan_dir
+from compression_tools.typesize import TYPESIZES, resolve_typesize
+from compression_tools.parallel import EXECUTORS, bounded_as_completed, call, get_executor, pipelined_as_completed, plan_workers
+from compression_tools.workers import (
+    DedupClaims, compress_data, compress_part, pack_and_compress, read_bytes, read_files, read_member, read_part,
+    release_buffers, release_file, run_task
+    )
 
-parser = argparse.ArgumentParser(description='''
-                                 Recursively combine a directory into a ZIP
-                                 file using configurable compression
-                                 ''')
+# Default size of the parts that large files are split into
+DEFAULT_PART_SIZE = 2**30
 
 positional = [
-    ('input_dir',str,'+','One input directorory.'),
+    ('input_dir',str,'+','One input directorory, or several directories / glob patterns to write one archive per directory (batch mode).'),
     ]
 
 optional = [
     
-    (['-out','--output_zip'],str,1,'OUT',None,'store','Output ZIP file name'),
+    (['-out','--output_zip'],str,1,'OUT',None,'store','Output ZIP file name.  In batch mode the directory that the archives are written to (default next to each input directory)'),
+    (['-jobs'],int,1,'N',4,'store','In batch mode, number of archives written at the same time through the shared worker pool (default 4)'),
+    (['-shards'],int,1,'N',1,'store','Write a sharded archive: N shard ZIP files written in parallel and OUT as the index of their entries (default 1: one archive)'),
+    (['-shard_size'],int,1,'BYTES',None,'store','With -shards, start a new shard once a shard holds this many input bytes (default: files are spread over the N shards)'),
     (['-cpu'],int,1,'C',os.cpu_count(),'store','Number of cpus which are available'),
+    (['-ex','--executor'],str,1,'EX','threads','store',f'Parallel execution method: {", ".join(EXECUTORS)} (default threads)'),
+    (['-scheduler'],str,1,'ADDR',None,'store','With -ex distributed, address of the dask.distributed scheduler, ie tcp://head-node:8786 (default start a LocalCluster on this machine)'),
+    (['-hash','--checksum'],str,1,'ALG',None,'store',f'Checksum the archive and each entry with this algorithm: {", ".join(available_algorithms())}'),
+    (['-ts','--typesize'],int,1,'TS',0,'store','Blosc typesize 1, 2, 4 or 8. 0 detects it per file from TIFF / npy headers or .raw extension (default 0)'),
+    (['-part','--part_size'],int,1,'BYTES',None,'store',f'Files larger than this are split into parts of this many bytes that are compressed in parallel (default {DEFAULT_PART_SIZE} or less to fit the memory budget, Blosc is limited to about 2GB)'),
+    (['-pack','--pack_size'],int,1,'BYTES',None,'store','Pack small files into blocks of about this many bytes that are compressed together (default off)'),
+    (['-pack_threshold'],int,1,'BYTES',65536,'store','Files smaller than this are packed when -pack is used (default 65536)'),
+    (['-inflight','--max_in_flight'],int,1,'N',None,'store','Maximum number of compressed files held in RAM waiting to be written (default 2x number of workers)'),
+    (['-readers'],int,1,'N',0,'store','I/O threads that read files ahead of the compression workers, ie for network filesystems (default 0: workers read their own files)'),
+    (['-read_ahead'],int,1,'N',None,'store','With -readers, maximum number of files read ahead of compression (default 2x readers)'),
+    (['-include'],str,'+','PAT',None,'store','Only compress files whose relative path or name matches one of these patterns, ie "*.tif" "raw/*" (default all files)'),
+    (['-exclude'],str,'+','PAT',None,'store','Skip files and directories whose relative path or name matches one of these patterns, ie "*.tmp" "scratch"'),
+    (['-scan_threads'],int,1,'N',DEFAULT_SCAN_THREADS,'store',f'Number of directories listed at the same time while scanning (default {DEFAULT_SCAN_THREADS})'),
+    (['-metrics','--metrics'],str,1,'JSON',None,'store','Write per stage wall / CPU time, bytes and latency histograms to this json file'),
+    (['-mem','--max-memory'],str,1,'BYTES',None,'store','Memory budget for data being compressed, ie 8G or 512M (default -mem_fraction of the available RAM)'),
+    (['-mem_fraction','--memory-fraction'],float,1,'F',DEFAULT_MEMORY_FRACTION,'store',f'Fraction of the available RAM to use when -mem is not given (default {DEFAULT_MEMORY_FRACTION})'),
 
     # Compression options
     (['-cmp','--compression'],str,1,'CMP','zstd','store','Compression method from Blosc library (zstd (default),blosclz, lz4, lz4hc, zlib or snappy)'),
     (['-cl','--clevel'],int,1,'CLV',5,'store','Compression level : Integer 0-9 (default 5)'),
     (['-sh','--shuffle'],int,1,'SHF',1,'store','Shuffle option integer: NOSHUFFLE (0), SHUFFLE (1), BITSHUFFLE (2) or AUTOSHUFFLE (-1) (default 1)'),
     (['-bk','--blocksize'],int,1,'BLK',0,'store','The requested size of the compressed blocks. If 0 (default), an automatic blocksize will be used'),
+    
+    # Autotune options
+    (['-objective'],str,1,'OBJ','ratio','store',f'With -auto, optimize {" or ".join(OBJECTIVES)}: ratio subject to -min_speed, speed subject to -min_ratio (default ratio)'),
+    (['-min_speed'],float,1,'MBS',100,'store','With -auto -objective ratio, minimum compression MB/s of one worker (default 100)'),
+    (['-min_ratio'],float,1,'R',None,'store','With -auto -objective speed, minimum compression ratio'),
+    (['-auto_cache'],str,1,'JSON',DEFAULT_CACHE,'store',f'File where -auto decisions are cached per file type (default {DEFAULT_CACHE})'),
     ]
 
 switch = [
     (['-v', '--verbose'], 0,'count','Verbose output : additive more v = greater level of verbosity'),
-    (['-md5'], False,'store_true','Calculate MD5 checksum of archive and save to txt file'),
-    (['-md5_verify'], False,'store_true','After calculating the MD5 checksum, read saved file and verify the match'),
+    (['-md5'], False,'store_true','Calculate MD5 checksum of archive and save to txt file (same as -hash md5)'),
+    (['-md5_verify'], False,'store_true','After calculating the MD5 checksum, verify every entry (same as -hash md5 -verify)'),
+    (['-verify'], False,'store_true','After writing the archive, decode every entry in parallel and verify it against its checksum'),
+    (['-update'], False,'store_true','Update an existing archive: only new or changed files are compressed, unchanged files are copied'),
+    (['-dedup'], False,'store_true','Store files with identical content only once (duplicates are references in the manifest)'),
+    (['-resume'], False,'store_true','Continue a previous run that did not finish (OUT.partial and OUT.journal)'),
+    (['-hidden'], False,'store_true','Include hidden files and directories (names starting with .), skipped by default'),
+    (['-auto'], False,'store_true','Choose Blosc settings per file type by compressing a sample with a grid of settings (-cmp/-cl/-sh/-bk are the fallback)'),
     ]
 
-for var,v_type,nargs,v_help in positional:
-    parser.add_argument(var, type=v_type, nargs=nargs,help=v_help)
-
-for var,v_type,nargs,metavar,default,action,v_help in optional:
-    parser.add_argument(*var,type=v_type,nargs=nargs,metavar=metavar,default=default,action=action,help=v_help)
-
-for var,default,action,v_help in switch:
-    parser.add_argument(*var,default=default,action=action,help=v_help)
-
-args = parser.parse_args()
-
-in_dir = args.input_dir[0]
-out_zip = args.output_zip
-if out_zip is None:
-    out_zip = in_dir + '.zip'
-else:
-    out_zip = out_zip[0]
-cpu = args.cpu
 
-compressor = Blosc(
-    cname=args.compression, 
-    clevel=args.clevel, 
-    shuffle=args.shuffle, 
-    blocksize=args.blocksize
-    )
-
-verbose = args.verbose
-md5 = args.md5
-md5_verify = args.md5_verify
-if md5_verify:
-    md5 = True
+def build_parser():
+    '''
+    argparse parser for the compress_dir command line
+    '''
+    import argparse
+    parser = argparse.ArgumentParser(description='''
+                                     Recursively combine a directory into a ZIP
+                                     file using configurable compression
+                                     ''')
+    
+    for var,v_type,nargs,v_help in positional:
+        parser.add_argument(var, type=v_type, nargs=nargs,help=v_help)
 
-verbose = args.verbose
+    for var,v_type,nargs,metavar,default,action,v_help in optional:
+        parser.add_argument(*var,type=v_type,nargs=nargs,metavar=metavar,default=default,action=action,help=v_help)
 
-if verbose > 2:
-    print(args)
+    for var,default,action,v_help in switch:
+        parser.add_argument(*var,default=default,action=action,help=v_help)
+    
+    return parser
 
 
-def compress_dir(in_dir, out_zip, compressor, verbose=0, md5=False, md5_verify=False):
+def compress_dir(in_dir, out_zip, compressor, verbose=0, md5=False, md5_verify=False, max_in_flight=None,
+                 cpu=None, executor='threads', workers=None, checksum=None, verify=False, update=False, resume=False,
+                 dedup=False, pack_size=None, pack_threshold=65536, typesize=0,
+                 auto=False, objective='ratio', min_speed=100, min_ratio=None, auto_cache=DEFAULT_CACHE,
+                 part_size=None, metrics=None, max_memory=None, memory_fraction=DEFAULT_MEMORY_FRACTION,
+                 readers=0, read_ahead=None, include=None, exclude=None, hidden=False, scan_threads=DEFAULT_SCAN_THREADS,
+                 pool=None, scheduler=None, files=None):
+    '''
+    Compress every file in in_dir into out_zip
+    
+    Files are found by a scanner that lists directories in parallel
+    (scan_threads) and feeds them to the workers as they are found, see
+    scan.py.  include / exclude are fnmatch patterns matched against the path
+    relative to in_dir and the name of each file (and directory for exclude),
+    hidden includes names that start with .
+    
+    checksum:   hash algorithm (see checksum.available_algorithms).  The
+                archive digest is computed while the archive is written and is
+                saved to out_zip.<checksum>.json.  A digest of each file is
+                stored in manifest.json inside the archive.
+    verify:     after writing, decode every entry in parallel and check it
+                against the manifest
+    update:     if out_zip already exists, only compress files that are new or
+                whose size / mtime changed.  Unchanged files are copied from
+                the existing archive without recompressing, blocks of packed
+                files when all of their files are unchanged (otherwise the
+                unchanged files are packed again) and with dedup, references
+                whose content is still stored are kept.
+    resume:     continue a previous run that did not finish, appending to its
+                out_zip.partial file
+    dedup:      store files with identical content once.  Duplicates are
+                recorded in the manifest as references to the stored entry.
+                Files are identified by checksum (blake2b if not given).
+    pack_size:  pack files smaller than pack_threshold bytes into blocks of
+                about pack_size bytes that are compressed as one unit.  The
+                manifest records the block and offset of each packed file so
+                it can be read by decoding only its block.
+    typesize:   Blosc typesize (1, 2, 4 or 8) so that shuffle works on
+                multi-byte data.  0 detects it for each file from its header
+                or extension (see typesize.py).  The typesize used is recorded
+                in the manifest.
+    auto:       choose Blosc settings for each group of files (by extension)
+                by compressing a sample with a grid of settings, see
+                autotune.py.  objective is 'ratio' (subject to min_speed MB/s)
+                or 'speed' (subject to min_ratio).  Decisions are cached in
+                auto_cache and the codec of each entry is recorded in the
+                manifest.  compressor is used for packed blocks and for files
+                too small to sample.
+    part_size:  files larger than part_size bytes are split into parts of
+                part_size bytes that are compressed in parallel and stored as
+                separate members (Blosc is limited to about 2GB per call).
+                The manifest lists the size and digest of each part.  None
+                uses DEFAULT_PART_SIZE, halved until a part for every worker
+                fits in the memory budget.
+    max_memory: memory budget (bytes or a string like 8G) for files being
+                read, compressed and written.  Files are admitted by size:
+                small files keep flowing while a large file waits for memory.
+                None uses memory_fraction of the available RAM (see
+                memory.py).
+    readers:    number of I/O threads that read files (with posix_fadvise
+                read ahead hints) and hand them to the compression workers,
+                so that reading, compressing and writing overlap.  Hides the
+                latency of network filesystems.  0 reads each file in the
+                worker that compresses it.
+    read_ahead: with readers, maximum number of files being read or read and
+                waiting for a worker (default 2x readers).  max_in_flight is
+                the depth of the compress / write queue.
+    metrics:    json file to write the wall / CPU time and bytes of each
+                stage (scan, read, hash, compress, write, ...) and latency
+                histograms of the tasks to (see metrics.py)
+    executor:   'threads', 'processes', 'sync' or 'distributed' (see
+                parallel.py).  With 'distributed' the tasks run on the
+                dask.distributed scheduler at address scheduler (default a
+                LocalCluster started on this machine): each worker reads and
+                compresses its files and only the compressed bytes are sent
+                back to the writer, which streams them into the archive as
+                they arrive.  Files must be on a filesystem that every
+                worker can see at the same path.  readers is ignored.
+    files:      iterable of (path, path relative to in_dir, os.stat_result)
+                to compress instead of scanning in_dir (see compress_shards)
+    pool:       executor shared with other archives (see compress_dirs) that
+                is used instead of creating one and is not shut down.
+                workers must be its number of workers.
+    md5 / md5_verify are equivalent to checksum='md5' / verify=True
+    '''
     
     compressor = compressor
     compressor_config = compressor.get_config()
     
-    directory_to_compress = glob.glob(in_dir)
-    directory_to_compress = [x for x in directory_to_compress if os.path.isdir(x)]
-    assert len(directory_to_compress) == 1, 'Only 1 directory can be compressed at a time'
+    if md5 and checksum is None:
+        checksum = 'md5'
+    if md5_verify:
+        verify = True
+    if verify and checksum is None:
+        checksum = 'md5'
+    # Algorithm used for per entry digests (in the manifest)
+    entry_checksum = checksum
+    if dedup and entry_checksum is None:
+        entry_checksum = 'blake2b'
+    
+    # Stages run by this thread (scan, write, ...) are recorded directly,
+    # worker tasks return their timings with their results
+    collector = Metrics() if metrics else None
+    if collector is not None:
+        collector.start()
+    
+    if files is None:
+        with stage('scan'):
+            directory_to_compress = glob.glob(in_dir)
+            directory_to_compress = [x for x in directory_to_compress if os.path.isdir(x)]
+            assert len(directory_to_compress) == 1, 'Only 1 directory can be compressed at a time'
+        
+        # Files are streamed from the scanner into the compression queue
+        all_files = scan_dir(directory_to_compress[0], include, exclude, hidden, scan_threads)
+    else:
+        all_files = iter(files)
+    
+    # Data in flight is bounded by a memory budget.  Every worker can be
+    # compressing a part of a large file at once, so parts are made small
+    # enough to fit.  The read buffers that the workers keep between tasks
+    # are taken from the budget first.
+    budget = memory_budget(max_memory, memory_fraction)
+    slots = plan_workers(cpu, executor, workers)[0]
+    budget, buffer_limit = reserve_buffers(budget, slots)
+    auto_part = part_size is None
+    if auto_part:
+        part_size = fit_chunk_size(DEFAULT_PART_SIZE, budget, slots)
+    if verbose > 1 and budget is not None:
+        print(f'Memory budget {budget / 2**20:.0f} MB, part size {part_size / 2**20:.0f} MB, '
+              f'read buffers {buffer_limit / 2**20:.0f} MB per worker')
+    
+    # The archive is written to a .partial file and entries are recorded in a
+    # journal as they are written.  The .partial is renamed when complete.
+    partial_zip = out_zip + '.partial'
+    settings = {'compressor': compressor_config, 'checksum': entry_checksum, 'dedup': dedup, 'pack_size': pack_size,
+                'typesize': typesize, 'auto': [objective, min_speed, min_ratio] if auto else None, 'part_size': part_size}
+    journal = Journal(out_zip + '.journal', settings)
+    
+    # Entries already written to the .partial file by a previous run
+    done = []
+    resume_at = 0
+    if resume and os.path.exists(partial_zip) and os.path.exists(journal.journal_location):
+        previous_settings, done, resume_at = journal.load(os.path.getsize(partial_zip))
+        if auto_part and dict(previous_settings, part_size=part_size) == settings:
+            # The part size depends on the memory available, keep the one
+            # that the run being resumed used
+            part_size = settings['part_size'] = previous_settings['part_size']
+        if previous_settings != settings:
+            raise ValueError(f'{partial_zip} was written with different compression / checksum settings, it can not be resumed')
+        if verbose > 0:
+            print(f'Resuming {partial_zip} with {len(done)} entries already written')
+    done_names = {name for name, _, _ in done}
+    # Parts of split files already written: file name -> {index: record}
+    resumed_parts = {}
+    for name, zinfo, record in done:
+        if record is not None and 'part_of' in record:
+            resumed_parts.setdefault(record['part_of'], {})[record['index']] = record
+    
+    # Files in an existing archive that can be copied instead of recompressed:
+    # members, split files, blocks of packed files (copied once all of their
+    # files are found unchanged) and references to duplicate content
+    previous = {}
+    previous_split = {}
+    previous_blocks = {}
+    previous_packed = {}
+    previous_refs = {}
+    if update and os.path.exists(out_zip):
+        previous_manifest = load_manifest(out_zip)
+        with ZipFile(out_zip, 'r') as myzip, open(out_zip, 'rb') as f:
+            previous_config = json.loads(myzip.read('compressor.json'))
+            if previous_manifest is not None and previous_manifest.get('checksum') == entry_checksum and previous_config == compressor_config:
+                for zinfo in myzip.infolist():
+                    record = previous_manifest['entries'].get(zinfo.filename)
+                    if record is not None and 'ref' not in record:
+                        previous[zinfo.filename] = (member_data_offset(f, zinfo), zinfo.compress_size, record)
+                for name, record in previous_manifest['entries'].items():
+                    if 'parts' in record:
+                        parts = [myzip.getinfo(part_name(name, idx)) for idx in range(len(record['parts']))]
+                        previous_split[name] = (record, [(member_data_offset(f, x), x.compress_size) for x in parts])
+                    elif 'block' in record:
+                        if record['block'] not in previous_blocks:
+                            zinfo = myzip.getinfo(record['block'])
+                            previous_blocks[record['block']] = (member_data_offset(f, zinfo), zinfo.compress_size, {})
+                        previous_blocks[record['block']][2][name] = record
+                        previous_packed[name] = record['block']
+                    elif 'ref' in record and dedup:
+                        previous_refs[name] = record
+            elif verbose > 0:
+                print(f'{out_zip} was written with different settings, all files will be recompressed')
+    
+    # Number new blocks after those already written and those that can be
+    # copied from the existing archive
+    block_idx = 1 + max([int(x[len(BLOCK_PREFIX):]) for x in chain(done_names, previous_blocks)
+                         if x.startswith(BLOCK_PREFIX)], default=-1)
+    
+    # Content already stored in the archive: (size, digest) -> entry name
+    stored = {}
+    def add_stored(name, record):
+        if dedup and 'ref' not in record:
+            stored.setdefault((record['size'], record['digest']), name)
+    for name, zinfo, record in done:
+        # Parts and whole split files (which have no digest of their own) are
+        # not deduplicated
+        if record is not None and 'part_of' not in record and 'parts' not in record:
+            add_stored(name, record)
     
-    all_files = glob.glob(directory_to_compress[0] + '/**/*', recursive=True)
-    all_files = [x for x in all_files if os.path.isfile(x)]
+    # Thread workers can skip compressing content that another worker has
+    # already claimed
+    claims = DedupClaims() if dedup and executor in ('threads', 'sync') else None
     
+    # Codec chosen for each file by the autotuner (if it differs from
+    # compressor) and the compressor formed for each chosen codec
+    tuner = AutoTuner(objective, min_speed, min_ratio, cache_location=auto_cache, verbose=verbose) if auto else None
+    codecs = {}
+    compressors = {}
+    def tuned(file, rel_path):
+        '''
+        Returns (compressor, typesize) for a file
+        '''
+        if tuner is None:
+            return compressor, typesize
+        file_typesize = resolve_typesize(typesize, file)
+        with stage('tune'):
+            codec = tuner.tune(file, file_typesize)
+        if codec is None or codec == compressor_config:
+            return compressor, file_typesize
+        codecs[rel_path] = codec
+        key = json.dumps(codec, sort_keys=True)
+        if key not in compressors:
+            compressors[key] = compressor_from_config(codec)
+        return compressors[key], file_typesize
     
-    def read_bytes(filename):
-        with open(filename, 'rb') as f:
-            return f.read()
+    # Split files waiting for their parts: file name -> {'mtime', 'count',
+    # 'parts': {index: record}} and part member name -> (file name, index)
+    splits = {}
+    parts_of = {}
+    # Memory needed by each queued task: entry / member name -> bytes
+    task_bytes = {}
+    def split_tasks(file, rel_path, stat):
+        '''
+        Tasks that compress (or copy) each part of a large file that is not
+        already in the archive
+        '''
+        count = -(-stat.st_size // part_size)
+        splits[rel_path] = {'mtime': stat.st_mtime_ns, 'count': count, 'parts': resumed_parts.get(rel_path, {})}
+        
+        if rel_path in previous_split and unchanged(previous_split[rel_path][0], stat.st_size, stat.st_mtime_ns):
+            record, members = previous_split[rel_path]
+            for idx, (offset, length) in enumerate(members):
+                if idx not in splits[rel_path]['parts']:
+                    parts_of[part_name(rel_path, idx)] = (rel_path, idx)
+                    task_bytes[part_name(rel_path, idx)] = length
+                    yield (part_name(rel_path, idx), None), (read_member, (out_zip, offset, length, dict(record['parts'][idx])), None)
+            if 'codec' in record:
+                codecs[rel_path] = record['codec']
+            return
+        
+        file_compressor, file_typesize = tuned(file, rel_path)
+        file_typesize = resolve_typesize(file_typesize, file)
+        if part_size % file_typesize != 0:
+            file_typesize = 1
+        for idx in range(count):
+            if idx not in splits[rel_path]['parts']:
+                parts_of[part_name(rel_path, idx)] = (rel_path, idx)
+                offset = idx * part_size
+                length = min(part_size, stat.st_size - offset)
+                task_bytes[part_name(rel_path, idx)] = task_memory(length)
+                yield (part_name(rel_path, idx), None), (read_part, (file, offset, length), (compress_part, file_compressor, entry_checksum, file_typesize))
+    
+    copied = 0
+    queued = 0
+    pack = []
+    pack_bytes = 0
+    def pack_task():
+        '''
+        Task that reads, packs and compresses the current group of small files
+        '''
+        nonlocal block_idx, pack, pack_bytes
+        block_name = BLOCK_PREFIX + str(block_idx).zfill(8)
+        task = (block_name, None), (read_files, (pack,), (pack_and_compress, pack, compressor, entry_checksum, claims))
+        task_bytes[block_name] = task_memory(pack_bytes)
+        block_idx += 1
+        pack = []
+        pack_bytes = 0
+        return task
+    
+    # Unchanged files of previous blocks waiting for the other files of their
+    # block: block name -> [(file, entry name, stat)], and blocks that are
+    # recompressed because one of their files changed or was not found
+    waiting = {}
+    broken = set()
+    # Unchanged stored files of the existing archive, unchanged references
+    # that wait for the end of the scan to know whether the content they
+    # refer to is still stored, and the references carried over:
+    # [(entry name, record)]
+    seen = set()
+    held_refs = []
+    carried_refs = []
+    
+    def new_tasks(file, rel_path, stat):
+        '''
+        Tasks that compress a file that is not split, packed with other small
+        files or on its own
+        '''
+        nonlocal queued, pack_bytes
+        queued += 1
+        if pack_size and stat.st_size < pack_threshold:
+            # Small files are grouped and compressed together
+            pack.append((file, rel_path, stat.st_mtime_ns))
+            pack_bytes += stat.st_size
+            if pack_bytes >= pack_size:
+                yield pack_task()
+            return
+        
+        file_compressor, file_typesize = tuned(file, rel_path)
+        task_bytes[rel_path] = task_memory(stat.st_size)
+        yield (rel_path, stat.st_mtime_ns), (read_bytes, (file,), (compress_data, file, file_compressor, entry_checksum, claims, rel_path, file_typesize))
     
-    def compress_bytes(byte_string, compressor):
-        return compressor.encode(byte_string)
+    def copy_block(block):
+        '''
+        Task that copies a previous block whose files are all unchanged
+        '''
+        nonlocal copied
+        offset, length, records = previous_blocks[block]
+        del waiting[block]
+        copied += len(records)
+        task_bytes[block] = length
+        return (block, None), (read_member, (out_zip, offset, length, {'files': {x:dict(y) for x, y in records.items()}}), None)
+    
+    def break_block(block):
+        '''
+        Tasks that recompress the unchanged files of a previous block that
+        can not be copied as it is
+        '''
+        broken.add(block)
+        for file, rel_path, stat in waiting.pop(block, []):
+            yield from new_tasks(file, rel_path, stat)
+    
+    def to_compress():
+        '''
+        Tasks (key, (read, read_args, compute)) for every file, see workers.py
+        '''
+        nonlocal copied, queued
+        while True:
+            # Time spent waiting for the scanner
+            with stage('scan'):
+                found = next(all_files, None)
+            if found is None:
+                break
+            file, rel_path, stat = found
+            if rel_path in done_names:
+                continue
+            
+            if stat.st_size > part_size:
+                if rel_path in previous_split and unchanged(previous_split[rel_path][0], stat.st_size, stat.st_mtime_ns):
+                    copied += 1
+                else:
+                    queued += 1
+                yield from split_tasks(file, rel_path, stat)
+                continue
+            
+            if rel_path in previous and unchanged(previous[rel_path][2], stat.st_size, stat.st_mtime_ns):
+                offset, length, record = previous[rel_path]
+                copied += 1
+                seen.add(rel_path)
+                task_bytes[rel_path] = length
+                yield (rel_path, stat.st_mtime_ns), (read_member, (out_zip, offset, length, record), None)
+                continue
+            
+            if rel_path in previous_refs and unchanged(previous_refs[rel_path], stat.st_size, stat.st_mtime_ns):
+                held_refs.append((file, rel_path, stat))
+                continue
+            
+            block = previous_packed.get(rel_path)
+            if block is not None:
+                if unchanged(previous_blocks[block][2][rel_path], stat.st_size, stat.st_mtime_ns):
+                    seen.add(rel_path)
+                    if block not in broken:
+                        waiting.setdefault(block, []).append((file, rel_path, stat))
+                        if len(waiting[block]) == len(previous_blocks[block][2]):
+                            yield copy_block(block)
+                        continue
+                elif block not in broken:
+                    yield from break_block(block)
+            
+            yield from new_tasks(file, rel_path, stat)
+        
+        # Blocks with files that were deleted (or excluded this time)
+        for block in list(waiting):
+            yield from break_block(block)
+        # References are carried over when the content they refer to is still
+        # stored, the entry that stores it is known once everything is written
+        for file, rel_path, stat in held_refs:
+            if previous_refs[rel_path]['ref'] in seen:
+                copied += 1
+                carried_refs.append((rel_path, previous_refs[rel_path]))
+            else:
+                yield from new_tasks(file, rel_path, stat)
+        
+        if pack:
+            yield pack_task()
     
+    # Only a bounded number of compressed files, using at most budget bytes,
+    # are held in RAM at any time.  Each result is written to the archive on
+    # disk as soon as it completes so peak memory depends on the number of
+    # workers and the budget, not the size of the directory.  While a large
+    # file waits for memory up to max_in_flight later files can pass it.
+    # Workers and Blosc threads are sized together so that the total number
+    # of threads never exceeds cpu
+    shared_pool = pool is not None
+    if not shared_pool:
+        pool, workers = get_executor(executor, cpu=cpu, workers=workers, scheduler=scheduler)
+    if executor == 'distributed' and readers:
+        # Reading on this machine would send every file to the workers
+        if verbose > 0:
+            print('-readers is ignored with the distributed executor, workers read their own files')
+        readers = 0
+    if max_in_flight is None:
+        max_in_flight = 2 * workers
+    if verbose > 1:
+        print(f'Compressing with {workers} {executor} worker(s)')
     
-    def read_and_compress(filename, compressor):
-        bytes_string = read_bytes(filename)
-        return compress_bytes(bytes_string, compressor)
+    manifest = {name:record for name, _, record in done if record is not None and 'part_of' not in record}
+    duplicates = 0
+    def finish_split(name):
+        '''
+        Add a split file to the manifest once all of its parts are written
+        '''
+        split = splits.pop(name)
+        parts = [split['parts'][idx] for idx in range(split['count'])]
+        parts = [{k:v for k, v in x.items() if k not in ('part_of', 'index')} for x in parts]
+        record = {'size': sum(x['size'] for x in parts), 'mtime': split['mtime'], 'parts': parts}
+        codec = codecs.pop(name, None)
+        if codec is not None:
+            record['codec'] = codec
+        manifest[name] = record
+        journal.add_reference(name, record, stream.position)
+        if progress is not None:
+            progress.update(files=1)
     
-    to_compress = []
-    for file in all_files:
-        rel_path = os.path.relpath(file,in_dir)
-        to_process = (
-            rel_path,
-            delayed(read_and_compress)(file, compressor)
-                      )
+    # A live progress line replaces printing each entry, which is slow with
+    # many files.  The total is not known while the scan is streaming.
+    progress = Progress(files=len(manifest)) if verbose > 0 else None
+    run = timed_call if collector is not None else call
+    def item_bytes(key, args):
+        return task_bytes.pop(key[0])
+    if readers:
+        # Separate I/O threads read ahead of the workers, the writer (this
+        # thread) writes each result as soon as it is compressed
+        if read_ahead is None:
+            read_ahead = 2 * readers
         if verbose > 1:
-            print(f'Queueing {rel_path}')
-        to_compress.append(to_process)
-    
-    if verbose == 1:
-        print('Computing compression')
-    to_compress = dask.compute(to_compress)[0]
-    # Writing to zip must be sequential which hits the disk with many small writes
-    # Here we write each file in a file like object in RAM then make 1 contigious 
-    # write to disk.
-    zip_stream = BytesIO()
-    with ZipFile(zip_stream, 'w') as myzip:
-        # Write json metadata the describes compression method
+            print(f'Reading with {readers} I/O thread(s), {read_ahead} files ahead')
+        tasks = pipelined_as_completed(pool, run, to_compress(), readers, read_ahead, max_in_flight, budget, item_bytes,
+                                       max_in_flight, initializer=None if collector is None else collector.attach)
+    else:
+        tasks = bounded_as_completed(pool, run, ((key, (run_task,) + task + (buffer_limit,)) for key, task in to_compress()),
+                                     max_in_flight, budget, item_bytes, max_in_flight)
+    with nullcontext() if shared_pool else pool:
+        hasher = get_hasher(checksum) if checksum else None
         if verbose == 1:
-            print('Writing compressor information')
-        myzip.writestr('compressor.json',json.dumps(compressor_config, indent = 4))
+            print(f'Writing file {out_zip}')
+        
+        if done:
+            # Continue after the last complete entry of the previous run
+            with open(partial_zip, 'r+b') as f:
+                f.truncate(resume_at)
+            if hasher is not None:
+                with open(partial_zip, 'rb') as f:
+                    for block in iter(lambda: f.read(2**24), b''):
+                        hasher.update(block)
+            f = open(partial_zip, 'ab')
+            journal.open(append=True)
+        else:
+            f = open(partial_zip, 'wb')
+            journal.open()
         
-        # As compression completes write results to zip file
-        for result in to_compress:
-            if result[0] is not None:
-                if verbose > 1:
-                    print(f'Writing {result[0]}')
-                myzip.writestr(result[0],result[1])
+        try:
+            stream = StreamWriter(f, hasher)
+            stream.position = resume_at
+            with ZipFile(stream, 'w') as myzip:
+                restore_entries(myzip, done)
+                
+                if 'compressor.json' not in done_names:
+                    # Write json metadata the describes compression method
+                    if verbose == 1:
+                        print('Writing compressor information')
+                    myzip.writestr('compressor.json',json.dumps(compressor_config, indent = 4))
+                    journal.add(myzip.filelist[-1], None, stream.position)
+                
+                if verbose == 1:
+                    print('Computing compression')
+                # As compression completes write results to zip file
+                for (rel_path, mtime), result in tasks:
+                    if collector is not None:
+                        result, timings = result
+                        kind = 'part' if rel_path in parts_of else 'block' if rel_path.startswith(BLOCK_PREFIX) else 'file'
+                        collector.add(timings, kind)
+                    compressed, record = result
+                    if progress is not None:
+                        if 'files' in record:
+                            progress.update(len(record['files']), sum(x['size'] for x in record['files'].values()), len(compressed))
+                        else:
+                            progress.update(0 if rel_path in parts_of else 1, record['size'], 0 if compressed is None else len(compressed))
+                    
+                    if rel_path in parts_of:
+                        # Part of a large file
+                        name, idx = parts_of.pop(rel_path)
+                        record['part_of'] = name
+                        record['index'] = idx
+                        myzip.writestr(rel_path, compressed)
+                        journal.add(myzip.filelist[-1], record, stream.position)
+                        del compressed
+                        split = splits[name]
+                        split['parts'][idx] = record
+                        if len(split['parts']) == split['count']:
+                            finish_split(name)
+                        continue
+                    
+                    if 'files' in record:
+                        # Block of packed small files
+                        myzip.writestr(rel_path, compressed)
+                        journal.add(myzip.filelist[-1], None, stream.position)
+                        for name, file_record in record['files'].items():
+                            if 'ref' in file_record:
+                                duplicates += 1
+                            else:
+                                file_record['block'] = rel_path
+                                add_stored(name, file_record)
+                            manifest[name] = file_record
+                            journal.add_reference(name, file_record, stream.position)
+                        del compressed
+                        continue
+                    
+                    record['mtime'] = mtime
+                    manifest[rel_path] = record
+                    codec = codecs.pop(rel_path, None)
+                    
+                    if dedup and compressed is not None:
+                        owner = stored.get((record['size'], record['digest']))
+                        if owner is not None:
+                            # Duplicate that was compressed by a process worker
+                            record['ref'] = owner
+                            compressed = None
+                    
+                    if compressed is None:
+                        # Duplicate content is only referenced in the manifest
+                        duplicates += 1
+                        journal.add_reference(rel_path, record, stream.position)
+                        continue
+                    
+                    if codec is not None:
+                        record['codec'] = codec
+                    myzip.writestr(rel_path, compressed)
+                    add_stored(rel_path, record)
+                    journal.add(myzip.filelist[-1], record, stream.position)
+                    del compressed
+                
+                # References carried over from the existing archive, to the
+                # entry that now stores their content
+                for name, record in carried_refs:
+                    record = dict(record, ref=stored[(record['size'], record['digest'])])
+                    manifest[name] = record
+                    duplicates += 1
+                    journal.add_reference(name, record, stream.position)
+                    if progress is not None:
+                        progress.update(1, record['size'], 0)
+                
+                # Split files whose parts were all written by a previous run
+                for name in [x for x, split in splits.items() if len(split['parts']) == split['count']]:
+                    finish_split(name)
+                if progress is not None:
+                    progress.close()
                 
-    zip_stream.seek(0)
-    if verbose == 1:
-        print(f'Writing file {out_zip}')
-    with open(out_zip, 'wb') as f:
-        f.write(zip_stream.getvalue())
+                # Size, mtime and (optionally) digest of each file
+                myzip.writestr('manifest.json', json.dumps({'checksum': entry_checksum, 'entries': manifest}))
+        finally:
+            f.close()
+            journal.close()
+        if executor == 'distributed' and update:
+            # Workers that copied entries from the existing archive
+            pool.run(release_file, out_zip)
+        if executor == 'distributed':
+            # Read buffers kept by the worker threads
+            pool.run(release_buffers)
+    release_file(out_zip)
+    # Read buffers kept by the threads of this process (this thread with the
+    # sync executor)
+    release_buffers()
     
+    os.replace(partial_zip, out_zip)
+    journal.remove()
+    # Entry index for opening the archive without zipfile
+    with stage('index'):
+        write_index(out_zip)
+    if tuner is not None:
+        tuner.save()
+    if verbose > 0 and dedup:
+        print(f'{duplicates} duplicate files stored as references')
+    if verbose > 0 and (update or done):
+        print(f'{queued} files compressed, {copied} copied from the existing archive, '
+              f'{len(manifest) - queued - copied} resumed')
     
-    if md5:
-        md5_json = {}
-        # Compute MD5
-        if verbose == 1:
-            print('Computing MD5 Checksum')
-        zip_stream.seek(0)
-        readable_hash = hashlib.md5(zip_stream.getbuffer()).hexdigest()
-        md5_json['md5'] = readable_hash
+    
+    if checksum:
+        checksum_json = {}
+        # The archive digest was computed while the archive was written
+        readable_hash = hasher.hexdigest()
+        checksum_json[checksum] = readable_hash
         if verbose > 1:
             print(readable_hash)
         
-        if md5_verify:
+        if verify:
             if verbose == 1:
-                print('Verifying MD5')
-            # Read file and compute md5
-            with open(out_zip, 'rb') as f:
-                readable_hash_file = hashlib.md5(f.read()).hexdigest()
+                print('Verifying entries')
+            # Decode each entry in parallel and compare with the manifest
+            with stage('verify'), alt_zip(out_zip, cache_bytes=0) as archive:
+                failed = archive.verify(workers=workers)
             
-            # Verify hash against origional file
-            passed = False
-            if readable_hash_file == readable_hash:
-                message = 'MD5 Checksum verification: PASSED'
-                passed = True
-                if verbose == 1:
-                    print(message)
+            passed = len(failed) == 0
+            if passed:
+                message = f'{checksum} Checksum verification: PASSED'
             else:
-                message = 'MD5 Checksum verification: FAILED'
-                if verbose == 1:
-                    print(message)
+                message = f'{checksum} Checksum verification: FAILED ({len(failed)} entries)'
+                checksum_json['failed'] = failed
+            if verbose == 1:
+                print(message)
             
-            md5_json['verification'] = passed
+            checksum_json['verification'] = passed
             
-        # Write md5 json file
-        with open(out_zip + '.md5.json','w') as f:
-            f.write(json.dumps(md5_json, indent = 4))
-
-
-if __name__ == '__main__':
-    start = time.time()
-    # run()
-    compress_dir(in_dir, out_zip, compressor, verbose=verbose, md5=md5, md5_verify=md5_verify)
-    finished = round(time.time()-start,2)
-    print(f'Completed in {finished} seconds')
-
-
-
-
-
-
-
+        # Write checksum json file
+        with open(out_zip + f'.{checksum}.json','w') as f:
+            f.write(json.dumps(checksum_json, indent = 4))
+    
+    if collector is not None:
+        collector.stop()
+        collector.save(metrics, archive=out_zip, files=len(manifest), executor=executor, workers=workers)
 
 
+def batch_outputs(in_dirs, out_dir=None):
+    '''
+    Archive name for each of in_dirs: out_dir/<directory name>.zip, or next
+    to each directory if out_dir is None
+    '''
+    outputs = {}
+    for in_dir in in_dirs:
+        name = os.path.basename(os.path.normpath(in_dir)) + '.zip'
+        outputs[in_dir] = os.path.join(out_dir, name) if out_dir is not None else os.path.normpath(in_dir) + '.zip'
+    names = list(outputs.values())
+    duplicates = sorted({x for x in names if names.count(x) > 1})
+    if duplicates:
+        raise ValueError(f'Several input directories would be written to the same archive: {duplicates}')
+    return outputs
 
 
+def compress_dirs(in_dirs, compressor, out_dir=None, jobs=4, verbose=0, cpu=None, executor='threads', workers=None,
+                  max_memory=None, memory_fraction=DEFAULT_MEMORY_FRACTION, metrics=None, scheduler=None, **kwargs):
+    '''
+    Compress each of in_dirs into its own archive (see batch_outputs) through
+    one shared pool of workers
+    
+    Up to jobs archives are written at the same time, each by its own writer
+    thread running compress_dir, and the tasks of all of them are submitted
+    to the same executor so the workers stay busy while one archive is
+    scanned or finished.  The memory budget is shared equally by the jobs.
+    With metrics, the metrics of each archive are written to
+    <archive>.metrics.json.  Other keyword arguments are passed to
+    compress_dir.
+    
+    Every directory is attempted, a RuntimeError listing those that failed
+    is raised at the end.  Returns {in_dir: archive}.
+    '''
+    # Imported here, like the executors themselves
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    
+    outputs = batch_outputs(in_dirs, out_dir)
+    if out_dir is not None:
+        os.makedirs(out_dir, exist_ok=True)
+    jobs = max(1, min(int(jobs), len(outputs)))
+    budget = memory_budget(max_memory, memory_fraction)
+    job_memory = budget // jobs if budget is not None else None
+    
+    pool, workers = get_executor(executor, cpu=cpu, workers=workers, scheduler=scheduler)
+    if verbose > 0:
+        print(f'Compressing {len(outputs)} directories, {jobs} at a time, with {workers} {executor} worker(s)')
+    
+    def job(in_dir, out_zip):
+        compress_dir(in_dir, out_zip, compressor, verbose=verbose if jobs == 1 else 0, cpu=cpu, executor=executor,
+                     workers=workers, max_memory=job_memory, metrics=out_zip + '.metrics.json' if metrics else None,
+                     pool=pool, **kwargs)
+        return out_zip
+    
+    failed = {}
+    done = 0
+    with pool, ThreadPoolExecutor(max_workers=jobs) as writers:
+        futures = {writers.submit(job, in_dir, out_zip): in_dir for in_dir, out_zip in outputs.items()}
+        for future in as_completed(futures):
+            in_dir = futures[future]
+            done += 1
+            try:
+                future.result()
+            except Exception as e:
+                failed[in_dir] = e
+                print(f'[{done}/{len(outputs)}] {in_dir} FAILED: {e!r}')
+                continue
+            if verbose > 0:
+                print(f'[{done}/{len(outputs)}] Wrote {outputs[in_dir]}')
+    
+    if failed:
+        raise RuntimeError(f'{len(failed)} of {len(outputs)} directories failed: {sorted(failed)}')
+    return outputs
 
 
+def compress_shards(in_dir, out_zip, compressor, shards=4, shard_size=None, verbose=0, cpu=None, executor='threads',
+                    workers=None, max_memory=None, memory_fraction=DEFAULT_MEMORY_FRACTION, metrics=None, scheduler=None,
+                    include=None, exclude=None, hidden=False, scan_threads=DEFAULT_SCAN_THREADS, **kwargs):
+    '''
+    Compress in_dir into a sharded archive: shard ZIP files written in
+    parallel and an index archive out_zip that maps each entry to its shard
+    (see alt_zip.shard_name and SHARD_INDEX_NAME)
+    
+    shards:     number of shards written at the same time, each by its own
+                writer thread running compress_dir, through one shared pool
+                of workers.  Files from the scan go to the shard that has
+                been given the fewest bytes so far.
+    shard_size: optional target number of input bytes per shard.  A shard
+                that reaches it is finished and a new one takes its place, so
+                there can be more than shards shard files.
+    
+    Each shard is a complete compress_dir archive (with its own manifest,
+    checksum and verification).  Files with identical content are only
+    deduplicated within a shard.  The memory budget is shared equally by the
+    shards and with metrics, the metrics of each shard are written to
+    <shard>.metrics.json.  Other keyword arguments are passed to
+    compress_dir.  Returns the list of shard files.
+    '''
+    # Imported here, like the executors themselves
+    import queue
+    from concurrent.futures import ThreadPoolExecutor
+    
+    assert not kwargs.get('update') and not kwargs.get('resume'), 'Sharded archives can not be updated or resumed'
+    directory_to_compress = [x for x in glob.glob(in_dir) if os.path.isdir(x)]
+    assert len(directory_to_compress) == 1, 'Only 1 directory can be compressed at a time'
+    shards = max(1, int(shards))
+    budget = memory_budget(max_memory, memory_fraction)
+    shard_memory = budget // shards if budget is not None else None
+    
+    pool, workers = get_executor(executor, cpu=cpu, workers=workers, scheduler=scheduler)
+    if verbose > 0:
+        print(f'Writing up to {shards} shards at a time with {workers} {executor} worker(s)')
+    
+    def shard_files(files):
+        '''
+        Files given to one shard, until None
+        '''
+        while True:
+            item = files.get()
+            if item is None:
+                return
+            yield item
+    
+    def job(location, files):
+        compress_dir(directory_to_compress[0], location, compressor, verbose=0, cpu=cpu, executor=executor,
+                     workers=workers, max_memory=shard_memory, metrics=location + '.metrics.json' if metrics else None,
+                     pool=pool, files=shard_files(files), **kwargs)
+        if verbose > 0:
+            print(f'Wrote {location}')
+    
+    locations = []
+    # Shard of each entry
+    entries = {}
+    # Shards being given files: [index, queue of files, bytes given]
+    active = []
+    futures = []
+    with pool, ThreadPoolExecutor(max_workers=shards) as writers:
+        try:
+            for path, rel_path, stat in scan_dir(directory_to_compress[0], include, exclude, hidden, scan_threads):
+                if len(active) < shards:
+                    locations.append(shard_name(out_zip, len(locations)))
+                    active.append([len(locations) - 1, queue.Queue(), 0])
+                    futures.append(writers.submit(job, locations[-1], active[-1][1]))
+                shard = min(active, key=lambda x: x[2])
+                shard[1].put((path, rel_path, stat))
+                shard[2] += stat.st_size
+                entries[rel_path] = shard[0]
+                if shard_size is not None and shard[2] >= shard_size:
+                    shard[1].put(None)
+                    active.remove(shard)
+        finally:
+            for shard in active:
+                shard[1].put(None)
+    
+    failed = []
+    for location, future in zip(locations, futures):
+        try:
+            future.result()
+        except Exception as e:
+            failed.append(location)
+            print(f'{location} FAILED: {e!r}')
+    if failed:
+        raise RuntimeError(f'{len(failed)} of {len(locations)} shards failed: {failed}')
+    
+    # The index is written last, so an archive without one is incomplete
+    index = {'shards': [os.path.basename(x) for x in locations], 'entries': entries}
+    with ZipFile(out_zip + '.partial', 'w') as myzip:
+        myzip.writestr('compressor.json', json.dumps(compressor.get_config(), indent = 4))
+        myzip.writestr(SHARD_INDEX_NAME, json.dumps(index))
+    os.replace(out_zip + '.partial', out_zip)
+    return locations
 
 
+def main(argv=None):
+    '''
+    Command line entry point (console script compress_dir)
+    '''
+    args = build_parser().parse_args(argv)
+    
+    # Several directories (or a glob that matches several) are compressed in
+    # batch mode, one archive each
+    in_dirs = []
+    for pattern in args.input_dir:
+        for x in sorted(glob.glob(pattern)):
+            if os.path.isdir(x) and x not in in_dirs:
+                in_dirs.append(x)
+    batch = len(in_dirs) > 1
+    
+    in_dir = args.input_dir[0]
+    out_zip = args.output_zip
+    if out_zip is None:
+        out_zip = in_dir + '.zip'
+    else:
+        out_zip = out_zip[0]
+    jobs = args.jobs
+    if isinstance(jobs, list):
+        jobs = jobs[0]
+    shards = args.shards
+    if isinstance(shards, list):
+        shards = shards[0]
+    shard_size = args.shard_size
+    if shard_size is not None:
+        shard_size = shard_size[0]
+    sharded = shards > 1 or shard_size is not None
+    assert not (batch and sharded), '-shards can not be used with several input directories'
+    scheduler = args.scheduler
+    if scheduler is not None:
+        scheduler = scheduler[0]
+    cpu = args.cpu
+    if isinstance(cpu, list):
+        cpu = cpu[0]
+    executor = args.executor
+    if isinstance(executor, list):
+        executor = executor[0]
+    max_in_flight = args.max_in_flight
+    if max_in_flight is not None:
+        max_in_flight = max_in_flight[0]
 
+    compression = args.compression
+    if isinstance(compression, list):
+        compression = compression[0]
+    clevel = args.clevel
+    if isinstance(clevel, list):
+        clevel = clevel[0]
+    shuffle = args.shuffle
+    if isinstance(shuffle, list):
+        shuffle = shuffle[0]
+    blocksize = args.blocksize
+    if isinstance(blocksize, list):
+        blocksize = blocksize[0]
 
+    from numcodecs import Blosc
+    compressor = Blosc(
+        cname=compression, 
+        clevel=clevel, 
+        shuffle=shuffle, 
+        blocksize=blocksize
+        )
 
+    verbose = args.verbose
+    md5 = args.md5
+    md5_verify = args.md5_verify
+    if md5_verify:
+        md5 = True
+    checksum = args.checksum
+    if checksum is not None:
+        checksum = checksum[0]
+    verify = args.verify
+    update = args.update
+    resume = args.resume
+    dedup = args.dedup
+    typesize = args.typesize
+    if isinstance(typesize, list):
+        typesize = typesize[0]
+    assert typesize in (0,) + TYPESIZES, f'typesize must be 0 (detect) or one of {TYPESIZES}'
+    auto = args.auto
+    objective = args.objective
+    if isinstance(objective, list):
+        objective = objective[0]
+    min_speed = args.min_speed
+    if isinstance(min_speed, list):
+        min_speed = min_speed[0]
+    min_ratio = args.min_ratio
+    if min_ratio is not None:
+        min_ratio = min_ratio[0]
+    auto_cache = args.auto_cache
+    if isinstance(auto_cache, list):
+        auto_cache = auto_cache[0]
+    part_size = args.part_size
+    if part_size is not None:
+        part_size = part_size[0]
+    pack_size = args.pack_size
+    if pack_size is not None:
+        pack_size = pack_size[0]
+    pack_threshold = args.pack_threshold
+    if isinstance(pack_threshold, list):
+        pack_threshold = pack_threshold[0]
+    metrics = args.metrics
+    if metrics is not None:
+        metrics = metrics[0]
+    max_memory = args.max_memory
+    if max_memory is not None:
+        max_memory = max_memory[0]
+    readers = args.readers
+    if isinstance(readers, list):
+        readers = readers[0]
+    read_ahead = args.read_ahead
+    if read_ahead is not None:
+        read_ahead = read_ahead[0]
+    memory_fraction = args.memory_fraction
+    if isinstance(memory_fraction, list):
+        memory_fraction = memory_fraction[0]
+    include = args.include
+    exclude = args.exclude
+    hidden = args.hidden
+    scan_threads = args.scan_threads
+    if isinstance(scan_threads, list):
+        scan_threads = scan_threads[0]
 
+    verbose = args.verbose
 
+    if verbose > 2:
+        print(args)
+    
+    start = time.time()
+    options = dict(md5=md5, md5_verify=md5_verify, max_in_flight=max_in_flight, checksum=checksum, verify=verify,
+                   update=update, resume=resume, dedup=dedup,
+                   pack_size=pack_size, pack_threshold=pack_threshold, typesize=typesize,
+                   auto=auto, objective=objective, min_speed=min_speed, min_ratio=min_ratio, auto_cache=auto_cache,
+                   part_size=part_size, readers=readers, read_ahead=read_ahead, include=include, exclude=exclude,
+                   hidden=hidden, scan_threads=scan_threads)
+    if sharded:
+        compress_shards(in_dir, out_zip, compressor, shards=shards, shard_size=shard_size, verbose=verbose, cpu=cpu,
+                        executor=executor, metrics=metrics, max_memory=max_memory, memory_fraction=memory_fraction,
+                        scheduler=scheduler, **options)
+    elif batch:
+        compress_dirs(in_dirs, compressor, out_dir=args.output_zip[0] if args.output_zip else None, jobs=jobs,
+                      verbose=verbose, cpu=cpu, executor=executor, max_memory=max_memory,
+                      memory_fraction=memory_fraction, metrics=metrics, scheduler=scheduler, **options)
+    else:
+        compress_dir(in_dir, out_zip, compressor, verbose=verbose, cpu=cpu, executor=executor, metrics=metrics,
+                     max_memory=max_memory, memory_fraction=memory_fraction, scheduler=scheduler, **options)
+    finished = round(time.time()-start,2)
+    print(f'Completed in {finished} seconds')
 
 
+if __name__ == '__main__':
+    main()
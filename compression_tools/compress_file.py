@@ -12,303 +12,363 @@ more efficient storage or compatibility with cloud platforms.
 currently only Blosc is implemented and ZSTD, clevel 5, SHUFFLE is default
 """
 
-import dask
-from dask import delayed
-import hashlib
 import json
 import time
-import glob
 import os
-from zipfile import ZipFile
-from numcodecs import Blosc
-from io import BytesIO
 
-import argparse
-import psutil
-psutil.virtual_memory()
-
-parser = argparse.ArgumentParser(description='''
-                                 Recursively combine a directory into a ZIP
-                                 file using configurable compression
-                                 ''')
+from compression_tools.alt_zip import compressor_from_config
+from compression_tools.autotune import DEFAULT_CACHE, OBJECTIVES, AutoTuner
+from compression_tools.memory import DEFAULT_MEMORY_FRACTION, fit_chunk_size, memory_budget, reserve_buffers, task_memory
+from compression_tools.metrics import Metrics, Progress, stage, timed_call
+from compression_tools.parallel import EXECUTORS, bounded_as_completed, call, get_executor, pipelined_as_completed, plan_workers
+from compression_tools.typesize import TYPESIZES, resolve_typesize
+from compression_tools.workers import compress_bytes, read_range, release_buffers, release_file, run_task
 
 positional = [
-    ('input_dir',str,'+','One input directorory.'),
+    ('input_file',str,1,'One input file.'),
     ]
 
 optional = [
     
-    (['-out','--output_zip'],str,1,'OUT',None,'store','Output ZIP file name'),
+    (['-out','--output_dir'],str,1,'OUT',None,'store','Output directory name'),
     (['-cpu'],int,1,'C',os.cpu_count(),'store','Number of cpus which are available'),
+    (['-ex','--executor'],str,1,'EX','threads','store',f'Parallel execution method: {", ".join(EXECUTORS)} (default threads)'),
+    (['-scheduler'],str,1,'ADDR',None,'store','With -ex distributed, address of the dask.distributed scheduler, ie tcp://head-node:8786 (default start a LocalCluster on this machine)'),
+    (['-inflight','--max_in_flight'],int,1,'N',None,'store','Maximum number of chunks being compressed or waiting to be written (default number of workers)'),
+    (['-readers'],int,1,'N',0,'store','I/O threads that read chunks ahead of the compression workers, ie for network filesystems (default 0: workers read their own chunks)'),
+    (['-read_ahead'],int,1,'N',None,'store','With -readers, maximum number of chunks read ahead of compression (default 2x readers)'),
+    (['-hl','--header_length'],int,1,'HL',0,'store','Number of bytes at the start of the file to store separately as a header (default 0)'),
+    (['-ts','--typesize'],int,1,'TS',0,'store','Blosc typesize 1, 2, 4 or 8. 0 detects it from TIFF / npy headers or .raw extension (default 0)'),
+    (['-cs','--chunk_size'],int,1,'CS',None,'store','Number of bytes (pre compression) in each chunk (default 1GB or less to fit the memory budget)'),
+    (['-metrics','--metrics'],str,1,'JSON',None,'store','Write per stage wall / CPU time, bytes and latency histograms to this json file'),
+    (['-mem','--max-memory'],str,1,'BYTES',None,'store','Memory budget for chunks being compressed, ie 8G or 512M (default -mem_fraction of the available RAM)'),
+    (['-mem_fraction','--memory-fraction'],float,1,'F',DEFAULT_MEMORY_FRACTION,'store',f'Fraction of the available RAM to use when -mem is not given (default {DEFAULT_MEMORY_FRACTION})'),
 
     # Compression options
     (['-cmp','--compression'],str,1,'CMP','zstd','store','Compression method from Blosc library (zstd (default),blosclz, lz4, lz4hc, zlib or snappy)'),
     (['-cl','--clevel'],int,1,'CLV',5,'store','Compression level : Integer 0-9 (default 5)'),
     (['-sh','--shuffle'],int,1,'SHF',1,'store','Shuffle option integer: NOSHUFFLE (0), SHUFFLE (1), BITSHUFFLE (2) or AUTOSHUFFLE (-1) (default 1)'),
     (['-bk','--blocksize'],int,1,'BLK',0,'store','The requested size of the compressed blocks. If 0 (default), an automatic blocksize will be used'),
+
+    # Autotune options
+    (['-objective'],str,1,'OBJ','ratio','store',f'With -auto, optimize {" or ".join(OBJECTIVES)}: ratio subject to -min_speed, speed subject to -min_ratio (default ratio)'),
+    (['-min_speed'],float,1,'MBS',100,'store','With -auto -objective ratio, minimum compression MB/s of one worker (default 100)'),
+    (['-min_ratio'],float,1,'R',None,'store','With -auto -objective speed, minimum compression ratio'),
+    (['-auto_cache'],str,1,'JSON',DEFAULT_CACHE,'store',f'File where -auto decisions are cached per file type (default {DEFAULT_CACHE})'),
     ]
 
 switch = [
     (['-v', '--verbose'], 0,'count','Verbose output : additive more v = greater level of verbosity'),
     (['-md5'], False,'store_true','Calculate MD5 checksum of archive and save to txt file'),
     (['-md5_verify'], False,'store_true','After calculating the MD5 checksum, read saved file and verify the match'),
+    (['-auto'], False,'store_true','Choose Blosc settings by compressing a sample of the file with a grid of settings (-cmp/-cl/-sh/-bk are the fallback)'),
     ]
 
-for var,v_type,nargs,v_help in positional:
-    parser.add_argument(var, type=v_type, nargs=nargs,help=v_help)
-
-for var,v_type,nargs,metavar,default,action,v_help in optional:
-    parser.add_argument(*var,type=v_type,nargs=nargs,metavar=metavar,default=default,action=action,help=v_help)
-
-for var,default,action,v_help in switch:
-    parser.add_argument(*var,default=default,action=action,help=v_help)
-
-args = parser.parse_args()
-
-in_dir = args.input_dir[0]
-out_zip = args.output_zip
-if out_zip is None:
-    out_zip = in_dir + '.zip'
-else:
-    out_zip = out_zip[0]
-cpu = args.cpu
-
-compressor = Blosc(
-    cname=args.compression, 
-    clevel=args.clevel, 
-    shuffle=args.shuffle, 
-    blocksize=args.blocksize
-    )
-
-verbose = args.verbose
-md5 = args.md5
-md5_verify = args.md5_verify
-if md5_verify:
-    md5 = True
-
-verbose = args.verbose
-
-if verbose > 2:
-    print(args)
-
-
-
-def compress_file(in_file, out_dir, compressor, header_length=0, chunk_size_bytes=None, verbose=0, md5=False, md5_verify=False):
-
-    compressor = compressor
-    compressor_config = compressor.get_config()
-
-    file_to_compress = in_file
-    dir_to_dump_files = out_dir
 
+def build_parser():
+    '''
+    argparse parser for the compress_file command line
+    '''
+    import argparse
+    parser = argparse.ArgumentParser(description='''
+                                     Compress a single file into a directory of
+                                     independently compressed chunks using
+                                     configurable compression
+                                     ''')
+
+    for var,v_type,nargs,v_help in positional:
+        parser.add_argument(var, type=v_type, nargs=nargs,help=v_help)
+
+    for var,v_type,nargs,metavar,default,action,v_help in optional:
+        parser.add_argument(*var,type=v_type,nargs=nargs,metavar=metavar,default=default,action=action,help=v_help)
+
+    for var,default,action,v_help in switch:
+        parser.add_argument(*var,default=default,action=action,help=v_help)
+
+    return parser
+
+
+def compress_file(in_file, out_dir, compressor, header_length=0, chunk_size_bytes=None, verbose=0, md5=False, md5_verify=False,
+                  cpu=None, executor='threads', workers=None, max_in_flight=None, typesize=0,
+                  auto=False, objective='ratio', min_speed=100, min_ratio=None, auto_cache=DEFAULT_CACHE,
+                  metrics=None, max_memory=None, memory_fraction=DEFAULT_MEMORY_FRACTION, readers=0, read_ahead=None,
+                  scheduler=None):
+    '''
+    Compress in_file into a directory of independently compressed chunks
+
+    typesize:   Blosc typesize (1, 2, 4 or 8) used for the chunks so that
+                shuffle works on multi-byte data.  0 detects it from the file
+                header or extension (see typesize.py).  The header is always
+                compressed with typesize 1.  The typesize used is recorded in
+                metadata.json.
+    auto:       choose Blosc settings by compressing a sample of the file
+                with a grid of settings (see autotune.py and compress_dir).
+                The chosen settings are written to compressor.json.
+    max_memory: memory budget (bytes or a string like 8G) for chunks being
+                read, compressed and written.  None uses memory_fraction of
+                the available RAM (see memory.py).  When chunk_size_bytes is
+                not given the 1GB default is halved until a chunk for every
+                worker fits in the budget.  Chunks read ahead by readers count
+                towards the budget.
+    readers:    number of I/O threads that read chunks ahead of the
+                compression workers (see compress_dir), at most read_ahead
+                chunks (default 2x readers) are read ahead
+    metrics:    json file to write the wall / CPU time and bytes of each
+                stage and a latency histogram of the chunks to (see
+                metrics.py)
+    executor 'distributed' runs the chunks on the dask.distributed scheduler
+    at address scheduler (default a LocalCluster), workers read the chunks
+    they compress (see compress_dir) and readers is ignored.
+    '''
+    if executor == 'distributed':
+        readers = 0
+
+    budget = memory_budget(max_memory, memory_fraction)
+    # The read buffers that the workers keep between chunks are taken from the
+    # budget first
+    slots = plan_workers(cpu, executor, workers)[0]
+    budget, buffer_limit = reserve_buffers(budget, slots)
+    if max_in_flight is None:
+        max_in_flight = slots
+    if readers and read_ahead is None:
+        read_ahead = 2 * readers
     if chunk_size_bytes is None:
         chunk_size_bytes = 1073741824# Byte length to generate 1GB (pre compression)
         # chunk_size_bytes = 2147483646  ## FOR TESTING ONLY
         ## MAX WORKING FOR BLOSC = 2000000000
+        # In flight chunks, those read ahead and the one being written must
+        # fit in the budget
+        chunk_size_bytes = fit_chunk_size(chunk_size_bytes, budget, max_in_flight + 1 + (read_ahead if readers else 0))
     else:
         assert isinstance(chunk_size_bytes,int), 'chunk_size_bytes must be an integer - default is 1GB'
 
+    typesize = resolve_typesize(typesize, in_file)
+    if chunk_size_bytes % typesize != 0:
+        # Chunks must hold whole elements
+        typesize = 1
+    if verbose > 1:
+        print(f'Compressing with typesize {typesize}')
+        if budget is not None:
+            print(f'Memory budget {budget / 2**20:.0f} MB, chunk size {chunk_size_bytes / 2**20:.0f} MB, '
+                  f'read buffers {buffer_limit / 2**20:.0f} MB per worker')
+
+    collector = Metrics() if metrics else None
+    if collector is not None:
+        collector.start()
+
+    if auto:
+        tuner = AutoTuner(objective, min_speed, min_ratio, cache_location=auto_cache, verbose=verbose)
+        with stage('tune'):
+            config = tuner.tune(in_file, typesize)
+        if config is not None:
+            compressor = compressor_from_config(config)
+        tuner.save()
+    compressor_config = compressor.get_config()
+
     # Make output directory
     os.makedirs(out_dir, exist_ok=True)
 
-    def read_bytes(filename, start=None, stop=None, length=None):
-        if start is None:
-            start = 0
-
-        with open(filename, 'rb') as f:
-            f.seek(start)
-
-            if length is not None:
-                return f.read(length)
-
-            if stop is not None:
-                return f.read(stop-start)
-
-            return f.read()
-
-    def compress_bytes(byte_string, compressor):
-        return compressor.encode(byte_string)
-
-    def read_and_compress(filename, compressor, start=None, stop=None, length=None):
-        bytes_string = read_bytes(filename, start, stop, length)
-        print(len(bytes_string))
-        return compress_bytes(bytes_string, compressor)
-
     # Write JSON the describes compression method
     with open(os.path.join(out_dir,'compressor.json'), 'w') as f:
         f.write(json.dumps(compressor_config, indent=4))
-    # ('compressor.json', json.dumps(compressor_config, indent=4))
-
-    if header_length > 0:
-        # Read header
-        header = read_and_compress(in_file, compressor, start=0, stop=None, length=header_length)
-
-        out_file = os.path.join(out_dir, 'header')
 
-        # Write compressed header file
-        with open(out_file, 'wb') as f:
-            f.write(header)
-
-
-    # Begin writing file parts
     # Determine file size
-    with open(in_file, 'rb') as f:
-        f.seek(0, os.SEEK_END)
-        f_size = f.tell()
-
-    file_idx = 0
-    current_location = header_length
-    while current_location <= f_size:
-        stop = current_location + chunk_size_bytes
-        print(f'Reading and compressing chunk {file_idx}')
-        header = read_and_compress(in_file, compressor, start=current_location, stop=stop, length=None)
-
-        # Write compressed file
-        out_file = os.path.join(out_dir,str(file_idx).zfill(5)) #File name
-        print(f'Writing chunk {file_idx}')
-        with open(out_file, 'wb') as f:
-            f.write(header)
-
-        current_location = stop
-        file_idx += 1
-
-
-
-
-
-
-
-
-
-
-
-
-
-def compress_dir(in_dir, out_zip, compressor, verbose=0, md5=False, md5_verify=False):
-    
-    compressor = compressor
-    compressor_config = compressor.get_config()
-    
-    directory_to_compress = glob.glob(in_dir)
-    directory_to_compress = [x for x in directory_to_compress if os.path.isdir(x)]
-    assert len(directory_to_compress) == 1, 'Only 1 directory can be compressed at a time'
-    
-    all_files = glob.glob(directory_to_compress[0] + '/**/*', recursive=True)
-    all_files = [x for x in all_files if os.path.isfile(x)]
-    
-    
-    def read_bytes(filename):
-        with open(filename, 'rb') as f:
-            return f.read()
-    
-    def compress_bytes(byte_string, compressor):
-        return compressor.encode(byte_string)
-    
-    
-    def read_and_compress(filename, compressor):
-        bytes_string = read_bytes(filename)
-        return compress_bytes(bytes_string, compressor)
-    
-    to_compress = []
-    for file in all_files:
-        rel_path = os.path.relpath(file,in_dir)
-        to_process = (
-            rel_path,
-            delayed(read_and_compress)(file, compressor)
-                      )
-        if verbose > 1:
-            print(f'Queueing {rel_path}')
-        to_compress.append(to_process)
-    
-    if verbose == 1:
-        print('Computing compression')
-    to_compress = dask.compute(to_compress)[0]
-    # Writing to zip must be sequential which hits the disk with many small writes
-    # Here we write each file in a file like object in RAM then make 1 contigious 
-    # write to disk.
-    zip_stream = BytesIO()
-    with ZipFile(zip_stream, 'w') as myzip:
-        # Write json metadata the describes compression method
-        if verbose == 1:
-            print('Writing compressor information')
-        myzip.writestr('compressor.json',json.dumps(compressor_config, indent = 4))
-        
-        # As compression completes write results to zip file
-        for result in to_compress:
-            if result[0] is not None:
-                if verbose > 1:
-                    print(f'Writing {result[0]}')
-                myzip.writestr(result[0],result[1])
-                
-    zip_stream.seek(0)
-    if verbose == 1:
-        print(f'Writing file {out_zip}')
-    with open(out_zip, 'wb') as f:
-        f.write(zip_stream.getvalue())
-    
-    
-    if md5:
-        md5_json = {}
-        # Compute MD5
-        if verbose == 1:
-            print('Computing MD5 Checksum')
-        zip_stream.seek(0)
-        readable_hash = hashlib.md5(zip_stream.getbuffer()).hexdigest()
-        md5_json['md5'] = readable_hash
-        if verbose > 1:
-            print(readable_hash)
-        
-        if md5_verify:
-            if verbose == 1:
-                print('Verifying MD5')
-            # Read file and compute md5
-            with open(out_zip, 'rb') as f:
-                readable_hash_file = hashlib.md5(f.read()).hexdigest()
-            
-            # Verify hash against origional file
-            passed = False
-            if readable_hash_file == readable_hash:
-                message = 'MD5 Checksum verification: PASSED'
-                passed = True
-                if verbose == 1:
-                    print(message)
-            else:
-                message = 'MD5 Checksum verification: FAILED'
-                if verbose == 1:
-                    print(message)
-            
-            md5_json['verification'] = passed
-            
-        # Write md5 json file
-        with open(out_zip + '.md5.json','w') as f:
-            f.write(json.dumps(md5_json, indent = 4))
-
+    f_size = os.path.getsize(in_file)
+    # A file shorter than the header is all header
+    header_length = min(header_length, f_size)
+    num_chunks = -(-(f_size - header_length) // chunk_size_bytes)
+
+    # Write JSON that describes the layout of the original file so that it can
+    # be reassembled (decompress_file) or read randomly (ChunkedFile)
+    file_metadata = {
+        'file_name': os.path.basename(in_file),
+        'file_size': f_size,
+        'header_length': header_length,
+        'chunk_size_bytes': chunk_size_bytes,
+        'chunks': num_chunks,
+        'typesize': typesize
+        }
+    with open(os.path.join(out_dir,'metadata.json'), 'w') as f:
+        f.write(json.dumps(file_metadata, indent=4))
+
+    lengths = {}
+    def chunks():
+        '''
+        Yield (output file name, (read, read_args, compute)) tasks (see
+        workers.py) for the header and each chunk of the file.  No zero
+        length chunk is produced when the file size is a multiple of
+        chunk_size_bytes.
+        '''
+        if header_length > 0:
+            lengths['header'] = header_length
+            yield 'header', (read_range, (in_file, 0, header_length), (compress_bytes, compressor, 1))
+
+        file_idx = 0
+        current_location = header_length
+        while current_location < f_size:
+            length = min(chunk_size_bytes, f_size - current_location)
+            name = str(file_idx).zfill(5)
+            lengths[name] = length
+            yield name, (read_range, (in_file, current_location, length), (compress_bytes, compressor, typesize))
+            current_location += length
+            file_idx += 1
+
+    # Chunks are read from one shared file handle with os.pread and compressed
+    # in parallel.  At most max_in_flight chunks, using at most budget bytes,
+    # are being read, compressed or waiting to be written, so peak memory is
+    # about (max_in_flight + 1) x chunk_size_bytes.
+    pool, workers = get_executor(executor, cpu=cpu, workers=workers, scheduler=scheduler)
+    if verbose > 1:
+        print(f'Compressing with {workers} {executor} worker(s)')
+
+    # A live progress line replaces printing each chunk
+    progress = Progress(num_chunks + (header_length > 0)) if verbose > 0 else None
+    run = timed_call if collector is not None else call
+    def item_bytes(name, args):
+        return task_memory(lengths[name])
+    if readers:
+        # I/O threads read chunks ahead of the workers
+        tasks = pipelined_as_completed(pool, run, chunks(), readers, read_ahead, max_in_flight, budget, item_bytes,
+                                       initializer=None if collector is None else collector.attach)
+    else:
+        tasks = bounded_as_completed(pool, run, ((name, (run_task,) + task + (buffer_limit,)) for name, task in chunks()),
+                                     max_in_flight, budget, item_bytes)
+    try:
+        with pool:
+            for name, compressed in tasks:
+                if collector is not None:
+                    compressed, timings = compressed
+                    collector.add(timings, 'chunk')
+                # Write compressed file
+                out_file = os.path.join(out_dir, name)
+                with stage('write') as s, open(out_file, 'wb') as f:
+                    f.write(compressed)
+                    s.add(len(compressed))
+                length = lengths.pop(name)
+                if progress is not None:
+                    progress.update(1, length, len(compressed))
+                del compressed
+            if executor == 'distributed':
+                # Handles and read buffers that the workers read the chunks
+                # with
+                pool.run(release_file, in_file)
+                pool.run(release_buffers)
+        if progress is not None:
+            progress.close()
+    finally:
+        release_file(in_file)
+        release_buffers()
+
+    if collector is not None:
+        collector.stop()
+        collector.save(metrics, file=in_file, chunks=num_chunks, executor=executor, workers=workers)
+
+
+def main(argv=None):
+    '''
+    Command line entry point (console script compress_file)
+    '''
+    args = build_parser().parse_args(argv)
+
+    in_file = args.input_file[0]
+    out_dir = args.output_dir
+    if out_dir is None:
+        out_dir = in_file + '.compressed'
+    else:
+        out_dir = out_dir[0]
+    cpu = args.cpu
+    if isinstance(cpu, list):
+        cpu = cpu[0]
+    executor = args.executor
+    if isinstance(executor, list):
+        executor = executor[0]
+    max_in_flight = args.max_in_flight
+    if max_in_flight is not None:
+        max_in_flight = max_in_flight[0]
+    readers = args.readers
+    if isinstance(readers, list):
+        readers = readers[0]
+    read_ahead = args.read_ahead
+    if read_ahead is not None:
+        read_ahead = read_ahead[0]
+    header_length = args.header_length
+    if isinstance(header_length, list):
+        header_length = header_length[0]
+    typesize = args.typesize
+    if isinstance(typesize, list):
+        typesize = typesize[0]
+    assert typesize in (0,) + TYPESIZES, f'typesize must be 0 (detect) or one of {TYPESIZES}'
+    auto = args.auto
+    objective = args.objective
+    if isinstance(objective, list):
+        objective = objective[0]
+    min_speed = args.min_speed
+    if isinstance(min_speed, list):
+        min_speed = min_speed[0]
+    min_ratio = args.min_ratio
+    if min_ratio is not None:
+        min_ratio = min_ratio[0]
+    auto_cache = args.auto_cache
+    if isinstance(auto_cache, list):
+        auto_cache = auto_cache[0]
+    chunk_size = args.chunk_size
+    if chunk_size is not None:
+        chunk_size = chunk_size[0]
+    metrics = args.metrics
+    if metrics is not None:
+        metrics = metrics[0]
+    max_memory = args.max_memory
+    if max_memory is not None:
+        max_memory = max_memory[0]
+    memory_fraction = args.memory_fraction
+    if isinstance(memory_fraction, list):
+        memory_fraction = memory_fraction[0]
+    scheduler = args.scheduler
+    if scheduler is not None:
+        scheduler = scheduler[0]
+
+    compression = args.compression
+    if isinstance(compression, list):
+        compression = compression[0]
+    clevel = args.clevel
+    if isinstance(clevel, list):
+        clevel = clevel[0]
+    shuffle = args.shuffle
+    if isinstance(shuffle, list):
+        shuffle = shuffle[0]
+    blocksize = args.blocksize
+    if isinstance(blocksize, list):
+        blocksize = blocksize[0]
+
+    from numcodecs import Blosc
+    compressor = Blosc(
+        cname=compression, 
+        clevel=clevel, 
+        shuffle=shuffle, 
+        blocksize=blocksize
+        )
+
+    verbose = args.verbose
+    md5 = args.md5
+    md5_verify = args.md5_verify
+    if md5_verify:
+        md5 = True
+
+    verbose = args.verbose
+
+    if verbose > 2:
+        print(args)
 
-if __name__ == '__main__':
     start = time.time()
-    # run()
-    compress_dir(in_dir, out_zip, compressor, verbose=verbose, md5=md5, md5_verify=md5_verify)
+    compress_file(in_file, out_dir, compressor, header_length=header_length, chunk_size_bytes=chunk_size,
+                  verbose=verbose, md5=md5, md5_verify=md5_verify,
+                  cpu=cpu, executor=executor, max_in_flight=max_in_flight, typesize=typesize,
+                  auto=auto, objective=objective, min_speed=min_speed, min_ratio=min_ratio, auto_cache=auto_cache,
+                  metrics=metrics, max_memory=max_memory, memory_fraction=memory_fraction,
+                  readers=readers, read_ahead=read_ahead, scheduler=scheduler)
     finished = round(time.time()-start,2)
     print(f'Completed in {finished} seconds')
 
 
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+if __name__ == '__main__':
+    main()
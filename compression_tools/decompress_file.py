@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+"""
+Reassemble a file that was compressed with compress_file.
+
+The chunk directory holds compressor.json, metadata.json (file size, header
+length and chunk size), an optional header and numbered chunk files.  The
+output file is preallocated and each chunk is decoded in parallel and written
+directly to its final offset, so no sequential concatenation pass is needed.
+
+Directories written before metadata.json existed are still supported: the
+layout is recovered from the Blosc header of each chunk.
+"""
+
+import json
+import os
+import time
+
+from compression_tools.alt_zip import blosc_nbytes, compressor_from_config
+from compression_tools.parallel import EXECUTORS, bounded_as_completed, get_executor
+from compression_tools.workers import decompress_to_range, release_file
+
+
+def chunk_names(in_dir):
+    '''
+    Sorted names of the numbered chunk files in a compress_file directory
+    '''
+    return sorted(x for x in os.listdir(in_dir) if x.isdigit())
+
+
+def get_layout(in_dir):
+    '''
+    Describe how the files in a compress_file directory map onto the original
+    file
+
+    Returns a dict with:
+        compressor:     compressor json config
+        file_size:      size of the original file in bytes
+        header_length:  length of the header in bytes (0 if no header)
+        chunk_size:     uncompressed size of each chunk (the last may be smaller)
+        segments:       list of (file name, offset, length) in file order
+    '''
+    with open(os.path.join(in_dir, 'compressor.json'), 'r') as f:
+        compressor_config = json.load(f)
+
+    metadata_file = os.path.join(in_dir, 'metadata.json')
+    if os.path.exists(metadata_file):
+        with open(metadata_file, 'r') as f:
+            metadata = json.load(f)
+        file_size = metadata['file_size']
+        header_length = metadata['header_length']
+        chunk_size = metadata['chunk_size_bytes']
+
+        segments = []
+        if header_length > 0:
+            segments.append(('header', 0, header_length))
+        offset = header_length
+        for idx in range(metadata['chunks']):
+            length = min(chunk_size, file_size - offset)
+            segments.append((str(idx).zfill(5), offset, length))
+            offset += length
+
+        missing = [x[0] for x in segments if not os.path.exists(os.path.join(in_dir, x[0]))]
+        if missing:
+            raise FileNotFoundError(f'Chunk files missing from {in_dir}: {missing}')
+
+    else:
+        assert compressor_config['id'] == 'blosc', 'metadata.json is required for non-Blosc chunk directories'
+
+        def nbytes(name):
+            with open(os.path.join(in_dir, name), 'rb') as f:
+                return blosc_nbytes(f.read(16))
+
+        names = chunk_names(in_dir)
+        if os.path.exists(os.path.join(in_dir, 'header')):
+            names = ['header'] + names
+
+        segments = []
+        offset = 0
+        for idx, name in enumerate(names):
+            length = nbytes(name)
+            if length == 0:
+                # Older versions of compress_file could write an empty chunk
+                # at the end of the file, it does not hold any data
+                if idx == len(names) - 1:
+                    break
+                raise ValueError(f'Zero length chunk {name} found before the end of {in_dir}')
+            segments.append((name, offset, length))
+            offset += length
+
+        file_size = offset
+        header_length = segments[0][2] if segments and segments[0][0] == 'header' else 0
+        data_segments = [x for x in segments if x[0] != 'header']
+        chunk_size = data_segments[0][2] if data_segments else 0
+
+    return {
+        'compressor': compressor_config,
+        'file_size': file_size,
+        'header_length': header_length,
+        'chunk_size': chunk_size,
+        'segments': segments
+        }
+
+
+def decompress_file(in_dir, out_file, verbose=0, cpu=None, executor='threads', workers=None, max_in_flight=None,
+                    scheduler=None):
+    '''
+    Reassemble the original file from a compress_file directory
+
+    Chunks are decoded in parallel and each is written straight to its offset
+    in a preallocated output file.  At most max_in_flight chunks are decoded at
+    once (default number of workers).  With executor 'distributed' the
+    chunks are decoded by the workers of the dask.distributed scheduler at
+    address scheduler (default a LocalCluster), which write them to out_file
+    themselves, so it must be on a filesystem that they share.
+    '''
+    layout = get_layout(in_dir)
+    compressor = compressor_from_config(layout['compressor'])
+    file_size = layout['file_size']
+
+    # Preallocate the output file
+    out_dir = os.path.dirname(os.path.abspath(out_file))
+    os.makedirs(out_dir, exist_ok=True)
+    with open(out_file, 'wb') as f:
+        f.truncate(file_size)
+        if hasattr(os, 'posix_fallocate') and file_size > 0:
+            try:
+                os.posix_fallocate(f.fileno(), 0, file_size)
+            except OSError:
+                # Not supported on all filesystems, the file is still sparse
+                # allocated by truncate
+                pass
+
+    def segments():
+        for name, offset, length in layout['segments']:
+            yield name, (os.path.join(in_dir, name), out_file, offset, length, compressor)
+
+    pool, workers = get_executor(executor, cpu=cpu, workers=workers, scheduler=scheduler)
+    if max_in_flight is None:
+        max_in_flight = workers
+    if verbose > 1:
+        print(f'Decompressing with {workers} {executor} worker(s)')
+
+    written = 0
+    try:
+        with pool:
+            for name, length in bounded_as_completed(pool, decompress_to_range, segments(), max_in_flight):
+                written += length
+                if verbose > 0:
+                    print(f'Wrote chunk {name}')
+            if executor == 'distributed':
+                # Handles that the workers wrote the chunks with
+                pool.run(release_file, out_file, 'r+b')
+    finally:
+        release_file(out_file, 'r+b')
+
+    assert written == file_size, f'Wrote {written} bytes, expected {file_size}'
+    return out_file
+
+
+def build_parser():
+    '''
+    argparse parser for the decompress_file command line
+    '''
+    import argparse
+
+    parser = argparse.ArgumentParser(description='''
+                                     Reassemble a file from a directory written
+                                     by compress_file
+                                     ''')
+
+    parser.add_argument('input_dir', type=str, nargs=1, help='One input directory written by compress_file.')
+    parser.add_argument('-out', '--output_file', type=str, nargs=1, metavar='OUT', default=None,
+                        help='Output file name (default: the original file name next to the input directory)')
+    parser.add_argument('-cpu', type=int, nargs=1, metavar='C', default=os.cpu_count(), help='Number of cpus which are available')
+    parser.add_argument('-ex', '--executor', type=str, nargs=1, metavar='EX', default='threads',
+                        help=f'Parallel execution method: {", ".join(EXECUTORS)} (default threads)')
+    parser.add_argument('-scheduler', type=str, nargs=1, metavar='ADDR', default=None,
+                        help='With -ex distributed, address of the dask.distributed scheduler, ie tcp://head-node:8786 (default start a LocalCluster on this machine)')
+    parser.add_argument('-inflight', '--max_in_flight', type=int, nargs=1, metavar='N', default=None,
+                        help='Maximum number of chunks decoded at once (default number of workers)')
+    parser.add_argument('-v', '--verbose', default=0, action='count',
+                        help='Verbose output : additive more v = greater level of verbosity')
+
+    return parser
+
+
+def main(argv=None):
+    '''
+    Command line entry point (console script decompress_file)
+    '''
+    args = build_parser().parse_args(argv)
+
+    in_dir = args.input_dir[0]
+    out_file = args.output_file
+    if out_file is None:
+        metadata_file = os.path.join(in_dir, 'metadata.json')
+        if os.path.exists(metadata_file):
+            with open(metadata_file, 'r') as f:
+                name = json.load(f)['file_name']
+            out_file = os.path.join(os.path.dirname(os.path.abspath(in_dir)), name)
+        else:
+            out_file = in_dir.rstrip('/\\') + '.decompressed'
+        assert not os.path.exists(out_file), f'{out_file} already exists, specify -out'
+    else:
+        out_file = out_file[0]
+    cpu = args.cpu
+    if isinstance(cpu, list):
+        cpu = cpu[0]
+    executor = args.executor
+    if isinstance(executor, list):
+        executor = executor[0]
+    max_in_flight = args.max_in_flight
+    if max_in_flight is not None:
+        max_in_flight = max_in_flight[0]
+    scheduler = args.scheduler
+    if scheduler is not None:
+        scheduler = scheduler[0]
+
+    start = time.time()
+    decompress_file(in_dir, out_file, verbose=args.verbose, cpu=cpu, executor=executor, max_in_flight=max_in_flight,
+                    scheduler=scheduler)
+    finished = round(time.time()-start,2)
+    print(f'Completed in {finished} seconds')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,339 @@
+# -*- coding: utf-8 -*-
+"""
+Binary entry index of compress_dir archives.
+
+Opening a ZIP file with zipfile parses its whole central directory into a
+ZipInfo object per member, and the manifest of a compress_dir archive holds a
+record for every file, so opening an archive with millions of entries takes
+seconds.  compress_dir therefore writes <out_zip>.idx next to the archive:
+
+    header      magic, number of names, archive size and the CRC-32 of the
+                end of the archive (to detect an index that does not belong
+                to the archive any more), slots of the hash table and the
+                position of the manifest settings
+    records     one fixed size record per name (ZIP members and the entries
+                of the manifest), sorted by name: position of the name,
+                CRC-32, offset of the stored data (after the local header),
+                stored size, size, compression and flags of a member, and the
+                position of the entry's manifest record
+    table       open addressing hash table (CRC-32 of the name, linear
+                probing) of record positions + 1, 0 for an empty slot
+    strings     UTF-8 names, manifest records (compact json) and the
+                manifest without its entries (json)
+
+alt_zip memory maps the index, finds names through the hash table (names
+under a prefix by binary search), reads the data of members with pread at the
+recorded offset and decodes the manifest record of an entry only when it is
+used, without opening the archive with zipfile.
+"""
+
+import json
+import mmap
+import os
+import struct
+import zlib
+from collections import namedtuple
+from collections.abc import Sequence
+from itertools import chain
+from zipfile import ZipFile
+
+from compression_tools.manifest import MANIFEST_NAME, member_data_offset
+
+INDEX_SUFFIX = '.idx'
+MAGIC = b'CTIDX\x00\x02\x00'
+# magic, names, archive size, CRC-32 of the archive tail, reserved, slots of
+# the hash table, position and length of the manifest settings
+HEADER = struct.Struct('<8sQQIIQQI')
+# name offset, name length, CRC-32, data offset, stored size, size,
+# compression, flags, kind (MEMBER | ENTRY), manifest record offset, manifest
+# record length
+RECORD = struct.Struct('<QIIQQQHHIQI')
+SLOT = struct.Struct('<Q')
+# Kinds of names: ZIP member, entry of the manifest (or both)
+MEMBER = 1
+ENTRY = 2
+# Bytes at the end of the archive (central directory) covered by the CRC
+TAIL_BYTES = 2**16
+
+# Decoder of the manifest records (json.loads checks the encoding of bytes
+# first, which costs as much as decoding a small record)
+_decode = json.JSONDecoder().decode
+
+IndexRecord = namedtuple('IndexRecord', ['name', 'CRC', 'data_offset', 'compress_size', 'file_size',
+                                         'compress_type', 'flag_bits'])
+
+
+def index_location(archive_location):
+    return archive_location + INDEX_SUFFIX
+
+
+def archive_tail_crc(fileobj, size):
+    '''
+    CRC-32 of the last TAIL_BYTES of an archive of size bytes
+    '''
+    fileobj.seek(max(0, size - TAIL_BYTES))
+    return zlib.crc32(fileobj.read(TAIL_BYTES))
+
+
+def table_slots(count):
+    '''
+    Number of slots of the hash table for count names (a power of 2, at most
+    half full)
+    '''
+    slots = 1
+    while slots < 2 * count:
+        slots *= 2
+    return slots
+
+
+def write_index(archive_location):
+    '''
+    Write the entry index of an archive (replacing an existing one)
+    '''
+    with ZipFile(archive_location, 'r') as myzip, open(archive_location, 'rb') as f:
+        # The last member of a name wins, like ZipFile.getinfo
+        infos = {x.filename:x for x in myzip.infolist()}
+        manifest = {}
+        if MANIFEST_NAME in infos:
+            manifest = json.loads(myzip.read(MANIFEST_NAME))
+        entries = manifest.pop('entries', {})
+        settings = json.dumps(manifest).encode('utf-8') if MANIFEST_NAME in infos else b''
+
+        names = sorted({x.encode('utf-8') for x in chain(infos, entries)})
+        size = os.fstat(f.fileno()).st_size
+        tail_crc = archive_tail_crc(f, size)
+
+        slots = table_slots(len(names))
+        records = bytearray(HEADER.size + RECORD.size * len(names))
+        table = bytearray(SLOT.size * slots)
+        strings = []
+        position = 0
+        def add_string(data):
+            nonlocal position
+            strings.append(data)
+            position += len(data)
+            return position - len(data)
+
+        for idx, name in enumerate(names):
+            text = name.decode('utf-8')
+            name_offset = add_string(name)
+            kind = 0
+            member = (0, 0, 0, 0, 0, 0)
+            zinfo = infos.get(text)
+            if zinfo is not None:
+                kind |= MEMBER
+                member = (zinfo.CRC, member_data_offset(f, zinfo), zinfo.compress_size, zinfo.file_size,
+                          zinfo.compress_type, zinfo.flag_bits)
+            record = (0, 0)
+            if text in entries:
+                kind |= ENTRY
+                data = json.dumps(entries[text], separators=(',', ':')).encode('utf-8')
+                record = (add_string(data), len(data))
+            RECORD.pack_into(records, HEADER.size + RECORD.size * idx, name_offset, len(name), *member,
+                             kind, *record)
+
+            slot = zlib.crc32(name) & (slots - 1)
+            while SLOT.unpack_from(table, SLOT.size * slot)[0]:
+                slot = (slot + 1) & (slots - 1)
+            SLOT.pack_into(table, SLOT.size * slot, idx + 1)
+
+        settings_offset = add_string(settings)
+        HEADER.pack_into(records, 0, MAGIC, len(names), size, tail_crc, 0, slots, settings_offset, len(settings))
+
+    location = index_location(archive_location)
+    with open(location + '.partial', 'wb') as out:
+        out.write(records)
+        out.write(table)
+        out.write(b''.join(strings))
+    os.replace(location + '.partial', location)
+
+
+def load_index(archive_location):
+    '''
+    EntryIndex of an archive, None if it has no index or the index was
+    written for a different version of the archive (or by an older version)
+    '''
+    location = index_location(archive_location)
+    if not os.path.exists(location):
+        return None
+    try:
+        index = EntryIndex(location)
+    except ValueError:
+        return None
+    with open(archive_location, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if index.archive_size != size or index.tail_crc != archive_tail_crc(f, size):
+            index.close()
+            return None
+    return index
+
+
+class EntryIndex:
+    '''
+    Memory mapped entry index: lookups through its hash table without loading
+    the names or the manifest
+
+    settings is the manifest without its entries (ie the checksum algorithm),
+    None if the archive has no manifest.
+    '''
+    def __init__(self, location):
+        with open(location, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._map) < HEADER.size or self._map[:len(MAGIC)] != MAGIC:
+            self._map.close()
+            raise ValueError(f'{location} is not an entry index')
+        _, self.count, self.archive_size, self.tail_crc, _, self.slots, settings_offset, settings_length = \
+            HEADER.unpack_from(self._map, 0)
+        self._table = HEADER.size + RECORD.size * self.count
+        self._strings = self._table + SLOT.size * self.slots
+        self.settings = json.loads(self._string(settings_offset, settings_length)) if settings_length else None
+        # Last name found and last manifest record decoded: a name is usually
+        # looked up several times in a row
+        self._last = (None, -1)
+        self._last_entry = (None, None)
+
+    def __len__(self):
+        return self.count
+
+    def _string(self, offset, length):
+        return self._map[self._strings + offset:self._strings + offset + length]
+
+    def _fields(self, idx):
+        return RECORD.unpack_from(self._map, HEADER.size + RECORD.size * idx)
+
+    def name_bytes(self, idx):
+        offset, length = struct.unpack_from('<QI', self._map, HEADER.size + RECORD.size * idx)
+        return self._string(offset, length)
+
+    def _bisect(self, below):
+        '''
+        First position whose name is not below(name), names are sorted
+        '''
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if below(self.name_bytes(mid)):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def find(self, name):
+        '''
+        Position of name (member or entry), -1 if it is not in the index
+        '''
+        last = self._last
+        if last[0] == name:
+            return last[1]
+        key = name.encode('utf-8')
+        mask = self.slots - 1
+        slot = zlib.crc32(key) & mask
+        while True:
+            idx = SLOT.unpack_from(self._map, self._table + SLOT.size * slot)[0] - 1
+            if idx < 0:
+                return -1
+            if self.name_bytes(idx) == key:
+                self._last = (name, idx)
+                return idx
+            slot = (slot + 1) & mask
+
+    def get(self, name):
+        '''
+        IndexRecord of ZIP member name or None
+        '''
+        idx = self.find(name)
+        if idx < 0:
+            return None
+        offset, length, crc, data_offset, compress_size, file_size, compress_type, flag_bits, kind, _, _ = \
+            self._fields(idx)
+        if not kind & MEMBER:
+            return None
+        return IndexRecord(name, crc, data_offset, compress_size, file_size, compress_type, flag_bits)
+
+    def is_member(self, name):
+        idx = self.find(name)
+        return idx >= 0 and bool(self._fields(idx)[8] & MEMBER)
+
+    def entry(self, name):
+        '''
+        Manifest record of entry name (a dict) or None
+        '''
+        last = self._last_entry
+        if last[0] == name:
+            return last[1]
+        idx = self.find(name)
+        if idx < 0:
+            return None
+        fields = self._fields(idx)
+        if not fields[8] & ENTRY:
+            return None
+        record = _decode(self._string(fields[9], fields[10]).decode('utf-8'))
+        self._last_entry = (name, record)
+        return record
+
+    def entries(self):
+        '''
+        Yield (name, manifest record) of every entry, in name order
+        '''
+        for idx in range(self.count):
+            fields = self._fields(idx)
+            if fields[8] & ENTRY:
+                yield self._string(fields[0], fields[1]).decode('utf-8'), _decode(self._string(fields[9], fields[10]).decode('utf-8'))
+
+    def prefix_range(self, prefix):
+        '''
+        (start, stop) positions of the names that start with prefix
+        '''
+        key = prefix.encode('utf-8')
+        start = self._bisect(lambda x: x < key)
+        stop = self._bisect(lambda x: x[:len(key)] <= key)
+        return start, max(start, stop)
+
+    def names(self, exclude_prefix=None):
+        '''
+        Sequence of names, without those starting with exclude_prefix
+        '''
+        return IndexNames(self, exclude_prefix)
+
+    def close(self):
+        self._map.close()
+
+
+class IndexNames(Sequence):
+    '''
+    Names of an EntryIndex (ZIP members and entries of the manifest) without
+    those under one prefix, decoded on access.  Membership is a hash lookup.
+    '''
+    def __init__(self, index, exclude_prefix=None):
+        self.index = index
+        self.exclude_prefix = exclude_prefix
+        # The excluded names are one run of the sorted names
+        self._gap = index.prefix_range(exclude_prefix) if exclude_prefix else (0, 0)
+
+    def __len__(self):
+        return len(self.index) - (self._gap[1] - self._gap[0])
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[x] for x in range(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError(idx)
+        if idx >= self._gap[0]:
+            idx += self._gap[1] - self._gap[0]
+        return self.index.name_bytes(idx).decode('utf-8')
+
+    def __iter__(self):
+        for idx in chain(range(self._gap[0]), range(self._gap[1], len(self.index))):
+            yield self.index.name_bytes(idx).decode('utf-8')
+
+    def __contains__(self, name):
+        if not isinstance(name, str):
+            return False
+        if self.exclude_prefix and name.startswith(self.exclude_prefix):
+            return False
+        return self.index.find(name) >= 0
+
+    def __repr__(self):
+        return f'IndexNames({len(self)} names)'
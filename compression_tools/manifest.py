@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""
+File manifests and write journals for compress_dir archives.
+
+manifest.json is stored in each archive next to compressor.json and records,
+for every file, its size, mtime and (optionally) a checksum of its contents.
+It allows an existing archive to be updated by recompressing only new or
+changed files.
+
+While an archive is being written it is named <out_zip>.partial and every
+entry that is completely written is appended to <out_zip>.journal.  If the
+run dies, the journal describes the valid part of the partial archive so that
+a later run can continue appending to it instead of starting over.
+"""
+
+import json
+import os
+import struct
+from zipfile import ZipFile, ZipInfo, ZIP_STORED, ZIP64_LIMIT
+
+MANIFEST_NAME = 'manifest.json'
+
+
+def load_manifest(archive_location):
+    '''
+    Return the manifest of an archive or None if it does not have one
+    '''
+    with ZipFile(archive_location, 'r') as myzip:
+        if MANIFEST_NAME not in myzip.NameToInfo:
+            return None
+        with myzip.open(MANIFEST_NAME) as myfile:
+            return json.load(myfile)
+
+
+def member_data_offset(fileobj, zinfo):
+    '''
+    Byte offset of a ZIP member's stored data, read from its local header
+    '''
+    fileobj.seek(zinfo.header_offset)
+    header = fileobj.read(30)
+    name_length, extra_length = struct.unpack('<HH', header[26:30])
+    return zinfo.header_offset + 30 + name_length + extra_length
+
+
+def unchanged(record, size, mtime):
+    '''
+    True if a manifest record matches a file's current size and mtime
+    '''
+    return record is not None and record.get('size') == size and record.get('mtime') == mtime
+
+
+class Journal:
+    '''
+    Append only record of the entries written to a partial archive
+
+    The first line holds the settings used to write the archive, each
+    following line describes one completely written ZIP member, its manifest
+    record and the position in the archive where it ends.
+    '''
+
+    def __init__(self, journal_location, settings=None):
+        self.journal_location = journal_location
+        self._file = None
+        self.settings = settings
+
+    def open(self, append=False):
+        self._file = open(self.journal_location, 'a' if append else 'w', buffering=1)
+        if not append:
+            self._file.write(json.dumps(self.settings) + '\n')
+
+    def add_reference(self, name, record, end):
+        '''
+        Record an entry that is not stored as a member (ie a duplicate)
+        '''
+        self._file.write(json.dumps({'name': name, 'end': end, 'record': record}) + '\n')
+
+    def add(self, zinfo, record, end):
+        self._file.write(json.dumps({
+            'name': zinfo.filename,
+            'date_time': zinfo.date_time,
+            'flag_bits': zinfo.flag_bits,
+            'external_attr': zinfo.external_attr,
+            'extract_version': zinfo.extract_version,
+            'create_version': zinfo.create_version,
+            'CRC': zinfo.CRC,
+            'compress_size': zinfo.compress_size,
+            'file_size': zinfo.file_size,
+            'header_offset': zinfo.header_offset,
+            'end': end,
+            'record': record
+            }) + '\n')
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def remove(self):
+        self.close()
+        if os.path.exists(self.journal_location):
+            os.remove(self.journal_location)
+
+    def load(self, archive_size):
+        '''
+        Read the journal of a previous run
+
+        Returns (settings, [(name, ZipInfo, record)], end) for entries that are
+        completely contained in the first archive_size bytes of the partial
+        archive.  end is the position after the last of those entries.
+        ZipInfo is None for entries that are not stored as members.
+        '''
+        entries = []
+        end = 0
+        with open(self.journal_location, 'r') as f:
+            lines = f.read().splitlines()
+        settings = json.loads(lines[0])
+        for line in lines[1:]:
+            try:
+                item = json.loads(line)
+            except ValueError:
+                # Partially written final line
+                break
+            if item['end'] > archive_size:
+                break
+            end = item['end']
+            if 'header_offset' not in item:
+                entries.append((item['name'], None, item['record']))
+                continue
+            zinfo = ZipInfo(item['name'], tuple(item['date_time']))
+            zinfo.compress_type = ZIP_STORED
+            zinfo.flag_bits = item['flag_bits']
+            zinfo.external_attr = item['external_attr']
+            zinfo.extract_version = item['extract_version']
+            zinfo.create_version = item['create_version']
+            zinfo.CRC = item['CRC']
+            zinfo.compress_size = item['compress_size']
+            zinfo.file_size = item['file_size']
+            zinfo.header_offset = item['header_offset']
+            entries.append((item['name'], zinfo, item['record']))
+        return settings, entries, end
+
+
+def restore_entries(myzip, entries):
+    '''
+    Register members that are already present in the partial file (from the
+    journal) with a ZipFile opened for writing so that they are included in
+    the central directory when the archive is closed.
+    '''
+    for _, zinfo, _ in entries:
+        if zinfo is None:
+            continue
+        if zinfo.file_size > ZIP64_LIMIT or zinfo.compress_size > ZIP64_LIMIT:
+            zinfo.extract_version = max(zinfo.extract_version, 45)
+        myzip.filelist.append(zinfo)
+        myzip.NameToInfo[zinfo.filename] = zinfo
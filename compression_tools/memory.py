@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+Memory budget for compression work.
+
+Work is admitted by the number of bytes it needs rather than by the number of
+tasks (see parallel.bounded_as_completed).  The budget is either given
+explicitly or is a fraction of the RAM that is available when the run starts
+(psutil), so the tools can run next to other jobs on a shared node.
+
+A task that compresses n bytes holds the data it read and the compressed
+result, about MEMORY_PER_BYTE x n bytes, until it is written.  Worker threads
+also keep the buffer they read into between tasks (workers.thread_buffer),
+that memory is taken from the budget first (reserve_buffers).
+"""
+
+from compression_tools import workers
+
+# Bytes of memory needed per byte of input being compressed (input buffer +
+# compressed output, which can be slightly larger than the input)
+MEMORY_PER_BYTE = 2
+
+DEFAULT_MEMORY_FRACTION = 0.5
+
+# Chunks / parts are not shrunk below this
+MIN_CHUNK_SIZE = 2**22
+
+# Fraction of the budget that worker threads may keep as read buffers between
+# tasks
+BUFFER_FRACTION = 0.25
+
+_UNITS = {'': 1, 'K': 2**10, 'M': 2**20, 'G': 2**30, 'T': 2**40}
+
+
+def parse_bytes(value):
+    '''
+    Number of bytes from an int or a string like 512M, 16G, 1.5T
+    '''
+    if value is None or isinstance(value, int):
+        return value
+    value = value.strip().upper().rstrip('B')
+    unit = value[-1] if value and value[-1] in _UNITS else ''
+    number = value[:-1] if unit else value
+    return int(float(number) * _UNITS[unit])
+
+
+def memory_budget(max_memory=None, fraction=DEFAULT_MEMORY_FRACTION):
+    '''
+    Bytes of memory that work may use: max_memory if given, otherwise
+    fraction of the currently available RAM.  None (no limit) if psutil is not
+    installed.
+    '''
+    if max_memory is not None:
+        return parse_bytes(max_memory)
+    try:
+        import psutil
+    except ImportError:
+        return None
+    return int(psutil.virtual_memory().available * fraction)
+
+
+def task_memory(nbytes):
+    '''
+    Memory needed to compress nbytes
+    '''
+    return MEMORY_PER_BYTE * nbytes
+
+
+def fit_chunk_size(chunk_size, budget, slots, minimum=MIN_CHUNK_SIZE):
+    '''
+    Halve chunk_size until slots chunks being compressed at the same time fit
+    in budget, but not below minimum.  Halving keeps a power of 2 chunk size a
+    multiple of every Blosc typesize.
+    '''
+    if budget is None:
+        return chunk_size
+    while task_memory(chunk_size) * slots > budget and chunk_size // 2 >= minimum:
+        chunk_size //= 2
+    return chunk_size
+
+
+def buffer_limit(budget, slots):
+    '''
+    Largest read buffer that each of slots worker threads keeps between tasks:
+    workers.REUSE_LIMIT, or less so that all of them fit in BUFFER_FRACTION of
+    budget
+    '''
+    if budget is None:
+        return workers.REUSE_LIMIT
+    return min(workers.REUSE_LIMIT, int(budget * BUFFER_FRACTION) // max(slots, 1))
+
+
+def reserve_buffers(budget, slots):
+    '''
+    Take the read buffers kept by slots worker threads from budget.  Returns
+    (budget left for the data being compressed, buffer_limit), the budget is
+    unchanged when buffers are not reused (COMPRESSION_TOOLS_ZERO_COPY=0).
+    '''
+    if not workers.ZERO_COPY:
+        return budget, 0
+    limit = buffer_limit(budget, slots)
+    if budget is None:
+        return budget, limit
+    return budget - slots * limit, limit
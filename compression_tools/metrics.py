@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+"""
+Per-stage timing, byte counts, latency histograms and a live progress line.
+
+Code on the hot path marks its stages with
+
+    with stage('compress') as s:
+        compressed = compressor.encode(data)
+        s.add(len(data), len(compressed))
+
+stage() only measures when the calling thread is collecting (inside
+timed_call, or between Metrics.start and Metrics.stop) and is otherwise a
+cheap no-op.  Tasks run on an executor are wrapped with timed_call which
+returns the timings of the task with its result, so the same code works with
+thread, process and sync executors.  The writer merges them into one Metrics.
+
+Each stage accumulates wall time, CPU time of the calling thread, number of
+calls and bytes in / out.  Stages run by different workers overlap, so stage
+wall times can add up to more than the elapsed time.
+"""
+
+import json
+import sys
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+_local = threading.local()
+
+
+class _Stage:
+    __slots__ = ('bytes_in', 'bytes_out')
+
+    def __init__(self):
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def add(self, bytes_in=0, bytes_out=0):
+        self.bytes_in += bytes_in
+        self.bytes_out += bytes_out
+
+
+class _NullStage:
+    __slots__ = ()
+
+    def add(self, bytes_in=0, bytes_out=0):
+        pass
+
+_NULL_STAGE = _NullStage()
+
+
+def _merge(stages, name, wall, cpu, count, bytes_in, bytes_out):
+    current = stages.get(name)
+    if current is None:
+        stages[name] = [wall, cpu, count, bytes_in, bytes_out]
+    else:
+        current[0] += wall
+        current[1] += cpu
+        current[2] += count
+        current[3] += bytes_in
+        current[4] += bytes_out
+
+
+@contextmanager
+def stage(name):
+    '''
+    Time a stage of work in the calling thread.  Yields an object whose
+    add(bytes_in, bytes_out) records the bytes the stage handled.
+    '''
+    stages = getattr(_local, 'stages', None)
+    if stages is None:
+        yield _NULL_STAGE
+        return
+    counter = _Stage()
+    wall = time.perf_counter()
+    cpu = time.thread_time()
+    try:
+        yield counter
+    finally:
+        _merge(stages, name, time.perf_counter() - wall, time.thread_time() - cpu, 1, counter.bytes_in, counter.bytes_out)
+
+
+def timed_call(fn, *args):
+    '''
+    Call fn(*args) collecting its stage timings.  Returns (result, timings)
+    where timings is (stages, wall seconds of the call).  Has the same
+    signature as parallel.call so it can replace it in bounded_as_completed.
+    '''
+    previous = getattr(_local, 'stages', None)
+    _local.stages = stages = {}
+    start = time.perf_counter()
+    try:
+        result = fn(*args)
+    finally:
+        _local.stages = previous
+    return result, (stages, time.perf_counter() - start)
+
+
+class Histogram:
+    '''
+    Latency histogram with power of 2 millisecond buckets (0.0625ms - 65s)
+
+    Percentiles are the upper bound of the bucket that holds them.
+    '''
+    BOUNDS = tuple(2.0**x for x in range(-4, 17))
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, seconds):
+        ms = seconds * 1000
+        self.counts[bisect_left(self.BOUNDS, ms)] += 1
+        self.count += 1
+        self.total += ms
+        self.min = ms if self.min is None else min(self.min, ms)
+        self.max = ms if self.max is None else max(self.max, ms)
+
+    def percentile(self, p):
+        if self.count == 0:
+            return None
+        target = p / 100 * self.count
+        seen = 0
+        for idx, count in enumerate(self.counts):
+            seen += count
+            if seen >= target and count:
+                return self.BOUNDS[idx] if idx < len(self.BOUNDS) else self.max
+        return self.max
+
+    def to_dict(self):
+        buckets = {}
+        for idx, count in enumerate(self.counts):
+            if count:
+                label = f'<={self.BOUNDS[idx]:g}ms' if idx < len(self.BOUNDS) else f'>{self.BOUNDS[-1]:g}ms'
+                buckets[label] = count
+        return {
+            'count': self.count,
+            'mean_ms': self.total / self.count if self.count else None,
+            'min_ms': self.min,
+            'max_ms': self.max,
+            'p50_ms': self.percentile(50),
+            'p90_ms': self.percentile(90),
+            'p99_ms': self.percentile(99),
+            'buckets': buckets
+            }
+
+
+class Metrics:
+    '''
+    Stage timings and per task latency histograms of one run
+
+    start() makes stage() calls in the calling thread (the writer) record
+    into this object, add() merges the timings returned by timed_call.  add()
+    is only called from the writer thread.  Other threads that run stages
+    outside of tasks (ie I/O threads) record their own stages after attach().
+    '''
+
+    def __init__(self):
+        self.stages = {}
+        self.latency = {}
+        self._threads = []
+        self._lock = threading.Lock()
+        self._previous = None
+        self._start = time.perf_counter()
+        self._cpu_start = time.process_time()
+
+    def start(self):
+        self._previous = getattr(_local, 'stages', None)
+        _local.stages = self.stages
+
+    def stop(self):
+        _local.stages = self._previous
+        self._previous = None
+
+    def attach(self):
+        '''
+        Record stage() calls of the calling thread, used as the initializer
+        of I/O threads
+        '''
+        stages = {}
+        with self._lock:
+            self._threads.append(stages)
+        _local.stages = stages
+
+    def add(self, timings, kind='file'):
+        '''
+        Merge timings (from timed_call) of one task of kind
+        '''
+        stages, seconds = timings
+        for name, values in stages.items():
+            _merge(self.stages, name, *values)
+        if kind not in self.latency:
+            self.latency[kind] = Histogram()
+        self.latency[kind].add(seconds)
+
+    def to_dict(self):
+        merged = {name: list(values) for name, values in self.stages.items()}
+        with self._lock:
+            for thread_stages in self._threads:
+                for name, values in thread_stages.items():
+                    _merge(merged, name, *values)
+        stages = {}
+        for name, (wall, cpu, count, bytes_in, bytes_out) in merged.items():
+            stages[name] = {
+                'wall_seconds': wall,
+                'cpu_seconds': cpu,
+                'count': count,
+                'bytes_in': bytes_in,
+                'bytes_out': bytes_out,
+                'MB_per_second': bytes_in / 2**20 / wall if wall > 0 and bytes_in else None
+                }
+        return {
+            'elapsed_seconds': time.perf_counter() - self._start,
+            # CPU time of this process, process workers are only counted in
+            # their stages
+            'cpu_seconds': time.process_time() - self._cpu_start,
+            'stages': stages,
+            'latency': {kind: x.to_dict() for kind, x in self.latency.items()}
+            }
+
+    def save(self, location, **info):
+        '''
+        Write the metrics (and any extra info) to a json file
+        '''
+        with open(location, 'w') as f:
+            f.write(json.dumps(dict(info, **self.to_dict()), indent=4))
+
+
+def _format_bytes(n):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if n < 1024:
+            return f'{n:.1f} {unit}'
+        n /= 1024
+    return f'{n:.1f} TB'
+
+
+class Progress:
+    '''
+    One live line of files / bytes done and throughput
+
+    On a terminal the line is redrawn in place at most every interval
+    seconds, otherwise (ie output to a log file) a new line is written every
+    log_interval seconds.
+    '''
+
+    def __init__(self, total_files=None, files=0, interval=0.5, log_interval=10, stream=None):
+        self.total_files = total_files
+        self.files = files
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.stream = sys.stdout if stream is None else stream
+        self.tty = hasattr(self.stream, 'isatty') and self.stream.isatty()
+        self.interval = interval if self.tty else log_interval
+        self._start = time.perf_counter()
+        self._last = self._start
+
+    def line(self):
+        seconds = time.perf_counter() - self._start
+        files = f'{self.files}/{self.total_files}' if self.total_files is not None else f'{self.files}'
+        ratio = f' ({self.bytes_in / self.bytes_out:.2f}x)' if self.bytes_out else ''
+        speed = self.bytes_in / 2**20 / seconds if seconds > 0 else 0
+        return (f'{files} files  {_format_bytes(self.bytes_in)} -> {_format_bytes(self.bytes_out)}{ratio}  '
+                f'{speed:.1f} MB/s  {int(seconds // 60):02d}:{int(seconds % 60):02d}')
+
+    def _draw(self):
+        if self.tty:
+            self.stream.write('\r' + self.line() + '\033[K')
+        else:
+            self.stream.write(self.line() + '\n')
+        self.stream.flush()
+
+    def update(self, files=0, bytes_in=0, bytes_out=0):
+        self.files += files
+        self.bytes_in += bytes_in
+        self.bytes_out += bytes_out
+        now = time.perf_counter()
+        if now - self._last >= self.interval:
+            self._last = now
+            self._draw()
+
+    def close(self):
+        self._draw()
+        if self.tty:
+            self.stream.write('\n')
+            self.stream.flush()
@@ -0,0 +1,357 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers for running compression work in parallel while keeping memory bounded.
+
+Work is submitted to a concurrent.futures style executor, but only a limited
+number of tasks are allowed to be in flight at any time.  Results are yielded
+in the order that they complete so that they can be written to disk and
+released immediately.
+
+The executor is selected by name ('threads', 'processes', 'sync' or
+'distributed') and sized from a cpu budget.  Blosc can start its own internal threads for each encode /
+decode call, so the number of Blosc threads is set at the same time to keep
+workers x blosc threads within the budget.
+"""
+
+import os
+import threading
+from collections import deque
+from concurrent.futures import (
+    Executor, Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+    )
+
+EXECUTORS = ('threads', 'processes', 'sync', 'distributed')
+
+
+class SyncExecutor(Executor):
+    '''
+    Executor that runs each task immediately in the calling thread.
+
+    Useful for debugging and profiling, and when Blosc should be allowed to
+    use all available cores for a single encode / decode call.
+    '''
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+        return future
+
+
+class DistributedExecutor(Executor):
+    '''
+    Executor that runs tasks on a dask.distributed cluster: the scheduler at
+    address (ie tcp://head-node:8786), or a LocalCluster of workers single
+    threaded worker processes started on this machine.
+
+    Tasks are submitted through client.get_executor() so they can be used
+    with bounded_as_completed.  A task reads its own data on the worker that
+    runs it and only its result (ie compressed bytes) is sent back to the
+    client, so input files must be visible at the same path on every worker
+    (a shared filesystem) and compression_tools must be installed there.
+    Shutting the executor down closes the client and the LocalCluster.
+    '''
+
+    def __init__(self, address=None, workers=1):
+        # Imported here, distributed is optional and slow to import
+        from distributed import Client, LocalCluster
+        self.cluster = None
+        if address is None:
+            self.cluster = LocalCluster(n_workers=workers, threads_per_worker=1, processes=True)
+            address = self.cluster
+        self.client = Client(address)
+        # Tasks are never identical, skip hashing their arguments
+        self.executor = self.client.get_executor(pure=False)
+        self.workers = max(1, sum(self.client.nthreads().values()))
+
+    def submit(self, fn, *args, **kwargs):
+        return self.executor.submit(fn, *args, **kwargs)
+
+    def run(self, fn, *args):
+        '''
+        Call fn(*args) in every worker process, ie to close the file handles
+        that tasks left open there (see workers.release_file)
+        '''
+        self.client.run(fn, *args)
+
+    def shutdown(self, wait=True, **kwargs):
+        self.executor.shutdown(wait=wait)
+        self.client.close()
+        if self.cluster is not None:
+            self.cluster.close()
+
+
+def set_blosc_threads(nthreads):
+    '''
+    Set the number of internal threads used by Blosc in this process.
+
+    Blosc only uses its internal thread pool when it is called from the main
+    thread of a process, calls from other threads always use 1 thread.  When
+    nthreads is 1 the global Blosc context is bypassed entirely which avoids
+    a process wide lock around every call.
+    '''
+    from numcodecs import blosc
+    nthreads = max(1, int(nthreads))
+    blosc.set_nthreads(nthreads)
+    blosc.use_threads = nthreads > 1
+    return nthreads
+
+
+def plan_workers(cpu=None, executor='threads', workers=None):
+    '''
+    Split a cpu budget between parallel workers and Blosc internal threads
+
+    Returns (workers, blosc_threads) such that workers * blosc_threads <= cpu.
+
+    threads:    Blosc always uses 1 thread when called from a worker thread so
+                all of the budget goes to workers
+    processes:  each process can use cpu // workers Blosc threads
+    sync:       1 worker, Blosc uses the whole budget
+    distributed: one single threaded worker process per cpu of a
+                LocalCluster.  The workers of a remote scheduler are counted
+                when it is connected (see get_executor).
+    '''
+    assert executor in EXECUTORS, f'executor must be one of {EXECUTORS}'
+    if cpu is None:
+        cpu = os.cpu_count() or 1
+    cpu = max(1, int(cpu))
+
+    if executor == 'sync':
+        return 1, cpu
+
+    if workers is None:
+        workers = cpu
+    workers = max(1, min(int(workers), cpu))
+
+    if executor in ('threads', 'distributed'):
+        return workers, 1
+    return workers, max(1, cpu // workers)
+
+
+def get_executor(executor='threads', cpu=None, workers=None, scheduler=None):
+    '''
+    Build an executor sized from a cpu budget and configure Blosc threads
+
+    Returns (executor, workers).  The executor should be used as a context
+    manager so that its workers are shut down when the work is finished.
+    scheduler is the address of the dask.distributed scheduler used by the
+    distributed executor (default start a LocalCluster), workers is then the
+    number of threads of all of its workers.
+    '''
+    workers, blosc_threads = plan_workers(cpu=cpu, executor=executor, workers=workers)
+
+    if executor == 'distributed':
+        pool = DistributedExecutor(scheduler, workers)
+        return pool, pool.workers
+
+    if executor == 'threads':
+        set_blosc_threads(1)
+        return ThreadPoolExecutor(max_workers=workers), workers
+
+    if executor == 'processes':
+        set_blosc_threads(1)
+        # Imported here, multiprocessing is slow to import and rarely used
+        from concurrent.futures import ProcessPoolExecutor
+        return ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=set_blosc_threads,
+            initargs=(blosc_threads,)
+            ), workers
+
+    set_blosc_threads(blosc_threads)
+    return SyncExecutor(), workers
+
+
+def call(fn, *args):
+    '''
+    Call fn(*args).  Used with bounded_as_completed when each item runs a
+    different function: items are (key, (fn, arg1, arg2, ...))
+    '''
+    return fn(*args)
+
+
+class _Admission:
+    '''
+    Items waiting to be submitted to bounded_as_completed or
+    pipelined_as_completed, see bounded_as_completed for max_bytes and
+    lookahead
+    '''
+
+    def __init__(self, items, max_bytes=None, item_bytes=None, lookahead=1):
+        assert lookahead >= 1, 'lookahead must be at least 1'
+        if max_bytes is not None:
+            assert item_bytes is not None, 'item_bytes is required when max_bytes is set'
+        self.items = iter(items)
+        self.max_bytes = max_bytes
+        self.item_bytes = item_bytes
+        self.lookahead = lookahead
+        self.pending_bytes = 0
+        self.waiting = deque()
+        # Number of times the oldest waiting item has been passed
+        self.passed = 0
+        self.exhausted = False
+
+    def next(self, pending):
+        '''
+        Returns the next (key, args, size) to submit, or None if there are no
+        more items or none fits.  pending is True if any item is in flight.
+        '''
+        while not self.exhausted and len(self.waiting) < self.lookahead:
+            try:
+                key, args = next(self.items)
+            except StopIteration:
+                self.exhausted = True
+                break
+            size = self.item_bytes(key, args) if self.max_bytes is not None else 0
+            self.waiting.append((key, args, size))
+
+        # First waiting item that fits in max_bytes
+        candidates = 1 if self.passed >= self.lookahead else len(self.waiting)
+        for idx in range(min(candidates, len(self.waiting))):
+            if self.max_bytes is None or not pending or self.pending_bytes + self.waiting[idx][2] <= self.max_bytes:
+                break
+        else:
+            return None
+
+        item = self.waiting[idx]
+        del self.waiting[idx]
+        self.passed = self.passed + 1 if idx > 0 else 0
+        self.pending_bytes += item[2]
+        return item
+
+    def release(self, size):
+        self.pending_bytes -= size
+
+
+def bounded_as_completed(executor, fn, items, max_in_flight, max_bytes=None, item_bytes=None, lookahead=1):
+    '''
+    Apply fn to many items using executor and yield results as they complete
+
+    items:          iterable of (key, args) tuples.  fn(*args) is submitted
+                    for each item
+    max_in_flight:  maximum number of submitted tasks whose results have not
+                    yet been yielded
+    max_bytes:      optional limit on the total size of in-flight items, the
+                    size of each item is given by item_bytes(key, args).  An
+                    item larger than max_bytes is submitted on its own.
+    lookahead:      number of items that may wait for max_bytes at the same
+                    time.  A later item that fits is submitted ahead of an
+                    earlier one that does not, so small items keep flowing
+                    while a large one waits.  The oldest waiting item is
+                    passed at most lookahead times, after that nothing else is
+                    submitted until it fits.  1 submits items strictly in
+                    order.
+
+    Yields (key, result) tuples in completion order.  Items are consumed
+    lazily so items may be a generator.
+    '''
+    assert max_in_flight >= 1, 'max_in_flight must be at least 1'
+    admission = _Admission(items, max_bytes, item_bytes, lookahead)
+    pending = {}
+
+    while True:
+        # Top up the pool of in-flight tasks
+        while len(pending) < max_in_flight:
+            item = admission.next(bool(pending))
+            if item is None:
+                break
+            key, args, size = item
+            pending[executor.submit(fn, *args)] = (key, size)
+
+        if not pending:
+            return
+
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            key, size = pending.pop(future)
+            admission.release(size)
+            yield key, future.result()
+
+
+def _identity(data):
+    return data
+
+
+def _read_stage(read, read_args, compute, fn, executor, slots, cancelled):
+    '''
+    Runs on an I/O thread: read the data of an item, wait for a compute slot
+    and submit the compute step.  Returns the compute future.
+    '''
+    data = read(*read_args)
+    slots.acquire()
+    if cancelled.is_set():
+        return None
+    if compute is None:
+        # Nothing to compute (ie stored bytes that are copied)
+        future = Future()
+        future.set_result(fn(_identity, data))
+        return future
+    try:
+        return executor.submit(fn, compute[0], data, *compute[1:])
+    except BaseException:
+        slots.release()
+        raise
+
+
+def pipelined_as_completed(executor, fn, items, readers, read_ahead, max_in_flight,
+                           max_bytes=None, item_bytes=None, lookahead=1, initializer=None):
+    '''
+    Like bounded_as_completed, but each item is read by a pool of I/O threads
+    before it is computed on executor, so reading, computing and writing (by
+    the consumer of the results) overlap.  Storage latency (ie a network
+    filesystem) is hidden behind computation.
+
+    items:          iterable of (key, (read, read_args, compute)).  The data
+                    returned by read(*read_args) is computed with
+                    fn(compute[0], data, *compute[1:]) on executor, ie fn is
+                    call.  compute None yields the data as fn(identity, data).
+    readers:        number of I/O threads
+    read_ahead:     maximum number of items being read or read and waiting
+                    for a compute slot
+    max_in_flight:  maximum number of items being computed or waiting to be
+                    yielded
+    max_bytes, item_bytes and lookahead apply to the items in all stages (see
+    bounded_as_completed).  initializer is called by each I/O thread when it
+    starts.
+    '''
+    assert max_in_flight >= 1 and read_ahead >= 1, 'queue depths must be at least 1'
+    admission = _Admission(items, max_bytes, item_bytes, lookahead)
+    slots = threading.Semaphore(max_in_flight)
+    cancelled = threading.Event()
+    reading = {}
+    computing = {}
+
+    with ThreadPoolExecutor(max_workers=readers, initializer=initializer) as io_pool:
+        try:
+            while True:
+                while len(reading) < read_ahead:
+                    item = admission.next(bool(reading or computing))
+                    if item is None:
+                        break
+                    key, (read, read_args, compute), size = item
+                    future = io_pool.submit(_read_stage, read, read_args, compute, fn, executor, slots, cancelled)
+                    reading[future] = (key, size)
+
+                if not reading and not computing:
+                    return
+
+                done, _ = wait(list(reading) + list(computing), return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future in reading:
+                        # Read and handed to the compute stage
+                        computing[future.result()] = reading.pop(future)
+                        continue
+                    key, size = computing.pop(future)
+                    slots.release()
+                    admission.release(size)
+                    yield key, future.result()
+        finally:
+            # Let I/O threads that wait for a compute slot finish without
+            # submitting more work
+            cancelled.set()
+            for _ in range(len(reading)):
+                slots.release()
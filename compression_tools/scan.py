@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming directory scanner.
+
+Directories are listed with os.scandir on a pool of threads (listing a
+directory releases the GIL, and on network filesystems each listing waits on
+the server) and files are yielded as soon as their directory has been listed,
+so compression can start before the whole tree is known.  The stat of each
+file comes from its DirEntry: on Windows it is cached from the listing, on
+other platforms it is one stat call instead of the separate isfile / stat
+calls of glob.
+
+Patterns are matched with fnmatch against the path relative to the scanned
+directory (with / separators) and against the name of the file or directory.
+A directory that matches an exclude pattern is not listed at all.  Names
+starting with . are skipped unless hidden is True, like glob('**/*').
+"""
+
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from fnmatch import fnmatch
+
+from compression_tools.parallel import SyncExecutor
+
+DEFAULT_SCAN_THREADS = 8
+
+
+def matches(rel_path, name, patterns):
+    '''
+    True if rel_path (with / separators) or name matches any of patterns
+    '''
+    return any(fnmatch(rel_path, x) or fnmatch(name, x) for x in patterns)
+
+
+def _list_dir(directory, rel_dir, include, exclude, hidden):
+    '''
+    List one directory.  Returns (files, subdirectories) where files are
+    (path, relative path, stat) and subdirectories (path, relative path).
+    Directories that can not be listed are skipped, like glob.
+    '''
+    files = []
+    subdirectories = []
+    try:
+        with os.scandir(directory) as it:
+            entries = sorted(it, key=lambda x: x.name)
+    except OSError:
+        return files, subdirectories
+
+    for entry in entries:
+        if not hidden and entry.name.startswith('.'):
+            continue
+        rel_path = os.path.join(rel_dir, entry.name) if rel_dir else entry.name
+        match_path = rel_path.replace(os.sep, '/')
+        if exclude and matches(match_path, entry.name, exclude):
+            continue
+        try:
+            if entry.is_dir():
+                subdirectories.append((entry.path, rel_path))
+            elif entry.is_file():
+                if include and not matches(match_path, entry.name, include):
+                    continue
+                files.append((entry.path, rel_path, entry.stat()))
+        except OSError:
+            # Removed or broken symlink
+            continue
+    return files, subdirectories
+
+
+def scan_dir(directory, include=None, exclude=None, hidden=False, threads=DEFAULT_SCAN_THREADS):
+    '''
+    Yield (path, relative path, os.stat_result) for every file under
+    directory, following symbolic links like glob
+
+    include:    patterns, only files that match one are yielded (default all)
+    exclude:    patterns of files and directories to skip
+    hidden:     include files and directories whose name starts with .
+    threads:    number of directories listed at the same time.  1 lists them
+                in the calling thread and files are yielded in a fixed order.
+
+    Files are yielded directory by directory as the listings complete.  At
+    most 4x threads directories are listed ahead of the consumer.
+    '''
+    include = tuple(include or ())
+    exclude = tuple(exclude or ())
+    threads = max(1, int(threads))
+    # One directory at a time when scanning in the calling thread, so the
+    # order is fixed
+    max_pending = 4 * threads if threads > 1 else 1
+    waiting = deque([(directory, '')])
+    pending = set()
+
+    pool = ThreadPoolExecutor(max_workers=threads) if threads > 1 else SyncExecutor()
+    with pool:
+        try:
+            while waiting or pending:
+                while waiting and len(pending) < max_pending:
+                    path, rel_dir = waiting.popleft()
+                    pending.add(pool.submit(_list_dir, path, rel_dir, include, exclude, hidden))
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    files, subdirectories = future.result()
+                    waiting.extend(subdirectories)
+                    yield from files
+        finally:
+            for future in pending:
+                future.cancel()
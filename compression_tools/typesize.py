@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+Blosc typesize selection.
+
+Blosc shuffles bytes (SHUFFLE) or bits (BITSHUFFLE) across elements of
+typesize bytes.  When a plain bytes object is encoded the typesize is 1 and
+shuffling does nothing, so uint16 / float32 image data compresses much worse
+than it could.  Data is instead passed to Blosc as a numpy view with the
+element size of the original data.
+
+The element size is read from the file header (TIFF BitsPerSample, .npy dtype)
+or, for headerless .raw files, assumed to be RAW_TYPESIZE.  Blosc records the
+typesize in each frame so decoding does not depend on it.
+"""
+
+import os
+import struct
+
+TYPESIZES = (1, 2, 4, 8)
+
+# Headerless raw microscopy data is almost always uint16
+RAW_TYPESIZE = 2
+
+TIFF_EXTENSIONS = ('.tif', '.tiff', '.btf', '.tf8')
+NPY_EXTENSIONS = ('.npy',)
+RAW_EXTENSIONS = ('.raw',)
+
+
+def _tiff_typesize(f):
+    '''
+    Bytes per sample from the first IFD of a (Big)TIFF file
+    '''
+    header = f.read(16)
+    if header[:2] == b'II':
+        endian = '<'
+    elif header[:2] == b'MM':
+        endian = '>'
+    else:
+        return None
+    version = struct.unpack(endian + 'H', header[2:4])[0]
+    if version == 42:
+        ifd_offset = struct.unpack(endian + 'I', header[4:8])[0]
+        count_format, entry_format, entry_size = 'H', 'HHI4s', 12
+    elif version == 43:
+        ifd_offset = struct.unpack(endian + 'Q', header[8:16])[0]
+        count_format, entry_format, entry_size = 'Q', 'HHQ8s', 20
+    else:
+        return None
+
+    f.seek(ifd_offset)
+    count_size = struct.calcsize(count_format)
+    count = struct.unpack(endian + count_format, f.read(count_size))[0]
+    entries = f.read(count * entry_size)
+    for idx in range(count):
+        tag, value_type, value_count, value = struct.unpack_from(endian + entry_format, entries, idx * entry_size)
+        if tag != 258:
+            continue
+        # BitsPerSample is SHORT and all samples share one size in practice.
+        # The first value is stored inline when it fits.
+        bits = struct.unpack_from(endian + 'H', value)[0]
+        if value_count * 2 > len(value):
+            f.seek(struct.unpack_from(endian + ('I' if version == 42 else 'Q'), value)[0])
+            bits = struct.unpack(endian + 'H', f.read(2))[0]
+        return bits // 8
+    # BitsPerSample defaults to 1 bit
+    return 1
+
+
+def _npy_typesize(f):
+    import numpy as np
+    version = np.lib.format.read_magic(f)
+    if version == (1, 0):
+        dtype = np.lib.format.read_array_header_1_0(f)[2]
+    else:
+        dtype = np.lib.format.read_array_header_2_0(f)[2]
+    return dtype.itemsize
+
+
+def detect_typesize(filename):
+    '''
+    Element size in bytes of the data in filename, or None if it can not be
+    determined from the header or extension
+    '''
+    extension = os.path.splitext(filename)[1].lower()
+    try:
+        if extension in TIFF_EXTENSIONS:
+            with open(filename, 'rb') as f:
+                typesize = _tiff_typesize(f)
+        elif extension in NPY_EXTENSIONS:
+            with open(filename, 'rb') as f:
+                typesize = _npy_typesize(f)
+        elif extension in RAW_EXTENSIONS:
+            typesize = RAW_TYPESIZE
+        else:
+            return None
+    except (OSError, ValueError, struct.error):
+        # Truncated or malformed header
+        return None
+    return typesize if typesize in TYPESIZES else None
+
+
+def resolve_typesize(typesize, filename=None):
+    '''
+    typesize to use for a file: typesize if given (>0), otherwise detected
+    from filename, otherwise 1
+    '''
+    if typesize:
+        return typesize
+    if filename is not None:
+        return detect_typesize(filename) or 1
+    return 1
+
+
+def typed_view(data, typesize):
+    '''
+    Returns (view of data with elements of typesize bytes, typesize used)
+
+    Data that is not a whole number of elements is left as bytes (typesize 1)
+    '''
+    if typesize > 1 and len(data) % typesize == 0:
+        import numpy as np
+        return np.frombuffer(data, dtype=f'u{typesize}'), typesize
+    return data, 1
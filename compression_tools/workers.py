@@ -0,0 +1,439 @@
+# -*- coding: utf-8 -*-
+"""
+Functions that are executed by parallel workers.
+
+These live at module level in a library module (rather than inside the CLI
+scripts) so that they can be pickled and sent to process based executors.
+
+Compression tasks are made of a read step (read_bytes, read_part,
+read_files, read_member) and a compute step that takes the data read as its
+first argument (compress_data, compress_part, pack_and_compress).  The steps
+run in one worker (run_task) or in separate I/O and compute stages
+(parallel.pipelined_as_completed).
+
+When both steps run in one worker the data is read with readinto into a
+buffer that the worker thread reuses for every task, rather than into a new
+bytes object per file or part, and decoded data is written straight into a
+memory map of the output file.  Set the environment variable
+COMPRESSION_TOOLS_ZERO_COPY=0 to read and decode through intermediate bytes
+objects instead (ie to compare the two, see benchmarks/bench_zero_copy.py).
+"""
+
+import mmap
+import os
+import struct
+import threading
+import weakref
+from contextlib import contextmanager
+
+from compression_tools.checksum import hash_bytes
+from compression_tools.metrics import stage
+from compression_tools.typesize import resolve_typesize, typed_view
+
+
+def advise(fd, offset=0, length=0):
+    '''
+    Tell the kernel that length bytes (0 to the end of the file) of fd from
+    offset will be read sequentially and soon, so it reads ahead.  This hides
+    much of the latency of network filesystems.
+    '''
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    try:
+        os.posix_fadvise(fd, offset, length, os.POSIX_FADV_SEQUENTIAL)
+        os.posix_fadvise(fd, offset, length, os.POSIX_FADV_WILLNEED)
+    except OSError:
+        # Not supported by the filesystem
+        pass
+
+ZERO_COPY = os.environ.get('COMPRESSION_TOOLS_ZERO_COPY', '1') != '0'
+
+# Buffers larger than this are allocated for each task rather than being kept
+# by the worker thread.  Runs with a memory budget pass a lower limit (see
+# memory.reserve_buffers).
+REUSE_LIMIT = 2**27
+
+class _Buffer:
+    '''
+    Reusable buffer of one thread
+    '''
+    __slots__ = ('data', '__weakref__')
+
+    def __init__(self):
+        self.data = None
+
+_buffers = threading.local()
+# Buffers of the live threads of this process, so that release_buffers can
+# drop them from any thread (a buffer is freed with its thread)
+_all_buffers = weakref.WeakSet()
+_all_buffers_lock = threading.Lock()
+
+def thread_buffer(nbytes, reuse_limit=REUSE_LIMIT):
+    '''
+    Writable memoryview of nbytes from a buffer that is reused by the calling
+    thread.  The view is only valid until the next call in the same thread so
+    it must not leave the task that asked for it.  The thread keeps at most
+    reuse_limit bytes between calls.
+    '''
+    if nbytes > reuse_limit:
+        return memoryview(bytearray(nbytes))
+    holder = getattr(_buffers, 'holder', None)
+    if holder is None:
+        holder = _buffers.holder = _Buffer()
+        with _all_buffers_lock:
+            _all_buffers.add(holder)
+    buffer = holder.data
+    if buffer is None or len(buffer) < nbytes:
+        # Grow in powers of 2 so a run of slightly larger files does not
+        # reallocate every time
+        buffer = holder.data = bytearray(min(1 << max(nbytes - 1, 0).bit_length(), reuse_limit))
+    return memoryview(buffer)[:nbytes]
+
+def release_buffers():
+    '''
+    Drop the reusable buffers of every thread of this process, ie when a run
+    is finished.  Views that are still in use stay valid.
+    '''
+    with _all_buffers_lock:
+        for holder in list(_all_buffers):
+            holder.data = None
+
+def _fill(f, view, offset=None):
+    '''
+    Read from f into view until it is full or the file ends, at offset with
+    os.preadv (without moving the file position) if offset is given.  Returns
+    the number of bytes read.
+    '''
+    filled = 0
+    while filled < len(view):
+        if offset is None:
+            n = f.readinto(view[filled:])
+        else:
+            n = os.preadv(f.fileno(), [view[filled:]], offset + filled)
+        if not n:
+            break
+        filled += n
+    return filled
+
+def read_bytes(filename):
+    with stage('read') as s, open(filename, 'rb') as f:
+        advise(f.fileno())
+        data = f.read()
+        s.add(len(data))
+    return data
+
+def read_bytes_into(filename, reuse_limit=REUSE_LIMIT):
+    '''
+    read_bytes into the buffer of the calling thread (see thread_buffer)
+    '''
+    with stage('read') as s, open(filename, 'rb', buffering=0) as f:
+        advise(f.fileno())
+        view = thread_buffer(os.fstat(f.fileno()).st_size, reuse_limit)
+        size = _fill(f, view)
+        rest = f.read()
+        if rest:
+            # The file grew since it was opened
+            data = bytes(view[:size]) + rest
+        else:
+            data = view[:size]
+        s.add(len(data))
+    return data
+
+def run_task(read, read_args, compute=None, reuse_limit=REUSE_LIMIT):
+    '''
+    Run both steps of a task in one worker: the result of read(*read_args) is
+    passed to compute (fn, arg1, ...) as fn(data, arg1, ...).  Without
+    compute the result of read is returned.
+
+    The data is only used by compute so it is read into the reusable buffer
+    of the worker thread where the read step has such a variant, the thread
+    keeps at most reuse_limit bytes (see thread_buffer).
+    '''
+    if compute is not None and ZERO_COPY and read in _READ_INTO:
+        data = _READ_INTO[read](*read_args, reuse_limit=reuse_limit)
+    else:
+        data = read(*read_args)
+    if compute is None:
+        return data
+    return compute[0](data, *compute[1:])
+
+def digest(byte_string, checksum):
+    with stage('hash') as s:
+        s.add(len(byte_string))
+        return hash_bytes(byte_string, checksum)
+
+def encode(data, compressor, size):
+    '''
+    Compress data (bytes or a typed view of size bytes)
+    '''
+    with stage('compress') as s:
+        compressed = compressor.encode(data)
+        s.add(size, len(compressed))
+    return compressed
+
+def compress_bytes(byte_string, compressor, typesize=1):
+    '''
+    Compress byte_string as elements of typesize bytes (see typesize.py)
+    '''
+    return encode(typed_view(byte_string, typesize)[0], compressor, len(byte_string))
+
+class DedupClaims:
+    '''
+    Shared record of which entry owns each unique file content
+
+    Used by thread workers so that only the first file with a given content
+    is compressed.  Not shared between processes: with process executors
+    duplicates are compressed, but are still only stored once by the writer.
+    '''
+    def __init__(self):
+        self._owners = {}
+        self._lock = threading.Lock()
+    
+    def claim(self, key, name):
+        '''
+        Returns the name of the entry that owns key, name if it is the first
+        '''
+        with self._lock:
+            return self._owners.setdefault(key, name)
+
+def compress_data(bytes_string, filename, compressor, checksum=None, claims=None, name=None, typesize=0):
+    '''
+    Compress bytes_string read from filename (by read_bytes)
+    
+    Returns (compressed bytes, record) where record holds the size, the Blosc
+    typesize used and (if checksum is an algorithm name) the digest of the
+    original file
+
+    typesize 0 detects the element size from the file (see typesize.py).
+
+    If claims (DedupClaims) is given and another entry already holds the same
+    content, the file is not compressed and (None, record) is returned with
+    record['ref'] set to the name of that entry.
+    '''
+    record = {'size': len(bytes_string)}
+    if checksum is not None:
+        record['digest'] = digest(bytes_string, checksum)
+    if claims is not None:
+        owner = claims.claim((record['size'], record['digest']), name)
+        if owner != name:
+            record['ref'] = owner
+            return None, record
+    data, record['typesize'] = typed_view(bytes_string, resolve_typesize(typesize, filename))
+    return encode(data, compressor, len(bytes_string)), record
+
+
+# Open file handles shared by all threads in a process.  Byte ranges are read
+# with os.pread which does not move the file position so many threads can read
+# from one handle at the same time.
+_file_handles = {}
+_file_handles_lock = threading.Lock()
+
+def _get_handle(filename, mode='rb'):
+    with _file_handles_lock:
+        f = _file_handles.get((filename, mode))
+        if f is None:
+            f = _file_handles[(filename, mode)] = open(filename, mode, buffering=0)
+        return f
+
+@contextmanager
+def output_range(filename, offset, length):
+    '''
+    Writable memoryview of length bytes at offset of filename (which must
+    already exist with its final size) through a memory map of only that
+    range, so the pages written do not stay mapped once it is closed
+    '''
+    f = _get_handle(filename, 'r+b')
+    start = offset - offset % mmap.ALLOCATIONGRANULARITY
+    mapped = mmap.mmap(f.fileno(), offset - start + length, offset=start)
+    try:
+        with memoryview(mapped) as view, view[offset - start:] as target:
+            yield target
+    finally:
+        mapped.close()
+
+def release_file(filename, mode='rb'):
+    '''
+    Close the shared handle for filename in this process (if open)
+    '''
+    with _file_handles_lock:
+        f = _file_handles.pop((filename, mode), None)
+    if f is not None:
+        f.close()
+
+def read_range(filename, offset, length):
+    '''
+    Read length bytes starting at offset from filename using a shared handle
+    '''
+    with stage('read') as s:
+        data = _pread(filename, offset, length)
+        s.add(len(data))
+    return data
+
+def _pread(filename, offset, length):
+    f = _get_handle(filename)
+    if not hasattr(os, 'pread'):
+        # Windows: fall back to seek + read under a lock
+        with _file_handles_lock:
+            f.seek(offset)
+            return f.read(length)
+
+    data = os.pread(f.fileno(), length, offset)
+    if len(data) == length or len(data) == 0:
+        return data
+    # Very large reads can be returned in pieces
+    pieces = [data]
+    read = len(data)
+    while read < length:
+        piece = os.pread(f.fileno(), length - read, offset + read)
+        if not piece:
+            break
+        pieces.append(piece)
+        read += len(piece)
+    return b''.join(pieces)
+
+def read_range_into(filename, offset, length, reuse_limit=REUSE_LIMIT):
+    '''
+    read_range into the buffer of the calling thread (see thread_buffer)
+    '''
+    if not hasattr(os, 'preadv'):
+        return read_range(filename, offset, length)
+    with stage('read') as s:
+        view = thread_buffer(length, reuse_limit)
+        view = view[:_fill(_get_handle(filename), view, offset)]
+        s.add(len(view))
+    return view
+
+def read_files(files):
+    '''
+    Contents of each of files (list of (filename, entry name, mtime))
+    '''
+    return [read_bytes(filename) for filename, _, _ in files]
+
+def pack_and_compress(contents, files, compressor, checksum=None, claims=None):
+    '''
+    Concatenate the contents of many small files (by read_files) into one
+    block and compress it
+
+    files:  list of (filename, entry name, mtime)
+
+    Returns (compressed block, {'files': {entry name: record}}) where each
+    record holds the offset and size of the file within the block.  Files
+    whose content is claimed by another entry (see compress_data) are not
+    added to the block and their record holds 'ref' instead.
+
+    Blocks are compressed with typesize 1: files of different types are
+    mixed and their offsets are not aligned to elements.
+    '''
+    block = bytearray()
+    records = {}
+    for bytes_string, (filename, name, mtime) in zip(contents, files):
+        record = {'size': len(bytes_string), 'mtime': mtime}
+        if checksum is not None:
+            record['digest'] = digest(bytes_string, checksum)
+        records[name] = record
+        if claims is not None:
+            owner = claims.claim((record['size'], record['digest']), name)
+            if owner != name:
+                record['ref'] = owner
+                continue
+        record['offset'] = len(block)
+        block += bytes_string
+    return compress_bytes(block, compressor), {'files': records}
+
+def read_part(filename, offset, length):
+    '''
+    Read one part of a large file with its own handle, so that no handle is
+    left open once all parts of the file are done
+    '''
+    with stage('read') as s, open(filename, 'rb') as f:
+        advise(f.fileno(), offset, length)
+        f.seek(offset)
+        bytes_string = f.read(length)
+        s.add(len(bytes_string))
+    return bytes_string
+
+def read_part_into(filename, offset, length, reuse_limit=REUSE_LIMIT):
+    '''
+    read_part into the buffer of the calling thread (see thread_buffer)
+    '''
+    with stage('read') as s, open(filename, 'rb', buffering=0) as f:
+        advise(f.fileno(), offset, length)
+        f.seek(offset)
+        view = thread_buffer(length, reuse_limit)
+        view = view[:_fill(f, view)]
+        s.add(len(view))
+    return view
+
+def compress_part(bytes_string, compressor, checksum=None, typesize=1):
+    '''
+    Compress one part of a large file (read by read_part)
+
+    Returns (compressed bytes, record) like compress_data, record describes
+    only this part.
+    '''
+    record = {'size': len(bytes_string)}
+    if checksum is not None:
+        record['digest'] = digest(bytes_string, checksum)
+    data, record['typesize'] = typed_view(bytes_string, typesize)
+    return encode(data, compressor, len(bytes_string)), record
+
+def write_range(filename, offset, data):
+    '''
+    Write data to filename starting at offset using a shared handle.  The file
+    must already exist.
+    '''
+    f = _get_handle(filename, 'r+b')
+    if not hasattr(os, 'pwrite'):
+        with _file_handles_lock:
+            f.seek(offset)
+            f.write(data)
+        return len(data)
+
+    view = memoryview(data)
+    written = 0
+    while written < len(view):
+        written += os.pwrite(f.fileno(), view[written:], offset + written)
+    return written
+
+def decode_to_range(data, compressor, out_file, offset, length):
+    '''
+    Decode Blosc data straight into its final offset in out_file (see
+    output_range).  Returns the number of bytes written.
+    '''
+    nbytes = struct.unpack_from('<I', data, 4)[0]
+    if nbytes != length:
+        raise ValueError(f'Data decodes to {nbytes} bytes, expected {length}')
+    with output_range(out_file, offset, length) as target:
+        compressor.decode(data, out=target)
+    return length
+
+def decompress_to_range(chunk_file, out_file, offset, length, compressor):
+    '''
+    Decode a compressed chunk file and write it to its final offset in
+    out_file.  Returns the number of bytes written.
+    '''
+    if ZERO_COPY and compressor.codec_id == 'blosc' and length:
+        data = read_bytes_into(chunk_file)
+        if len(data) < 16:
+            raise ValueError(f'{chunk_file} is too small to be a Blosc frame')
+        return decode_to_range(data, compressor, out_file, offset, length)
+    decoded = compressor.decode(read_bytes(chunk_file))
+    if len(decoded) != length:
+        raise ValueError(f'{chunk_file} decoded to {len(decoded)} bytes, expected {length}')
+    return write_range(out_file, offset, decoded)
+
+def read_member(archive, offset, length, record):
+    '''
+    Read the stored (already compressed) bytes of an archive member so that
+    they can be copied into a new archive without recompressing.  Returns
+    (stored bytes, record) like compress_data.
+    '''
+    return read_range(archive, offset, length), record
+
+
+# Read steps that have a variant reading into the buffer of the worker thread
+_READ_INTO = {
+    read_bytes: read_bytes_into,
+    read_part: read_part_into,
+    read_range: read_range_into
+    }
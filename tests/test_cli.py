@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the command line entry points
+"""
+
+import json
+import os
+
+from compression_tools import compress_dir, compress_file
+from compression_tools.alt_zip import alt_zip
+
+
+def test_compress_dir_compressor_options(tmp_path):
+    directory = tmp_path / 'src'
+    directory.mkdir()
+    (directory / 'a.txt').write_bytes(b'compression_tools ' * 1000)
+    out_zip = str(tmp_path / 'out.zip')
+
+    compress_dir.main([str(directory), '-out', out_zip, '-cmp', 'lz4', '-cl', '9', '-sh', '2', '-bk', '0'])
+    archive = alt_zip(out_zip)
+    config = archive.compressor_json
+    assert (config['cname'], config['clevel'], config['shuffle'], config['blocksize']) == ('lz4', 9, 2, 0)
+    assert archive['a.txt'] == b'compression_tools ' * 1000
+    archive.close()
+
+
+def test_compress_file_compressor_options(tmp_path):
+    in_file = tmp_path / 'a.bin'
+    in_file.write_bytes(os.urandom(1000) * 100)
+    out_dir = str(tmp_path / 'out')
+
+    compress_file.main([str(in_file), '-out', out_dir, '-cmp', 'lz4', '-cl', '9', '-sh', '0', '-bk', '0'])
+    with open(os.path.join(out_dir, 'compressor.json')) as f:
+        config = json.load(f)
+    assert (config['cname'], config['clevel'], config['shuffle']) == ('lz4', 9, 0)
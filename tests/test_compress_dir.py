@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of compress_dir: resuming an interrupted run
+"""
+
+import os
+
+import pytest
+from numcodecs import Blosc
+
+import compression_tools.compress_dir as compress_dir_module
+from compression_tools.alt_zip import alt_zip
+from compression_tools.compress_dir import compress_dir
+
+
+def make_files(directory):
+    '''
+    A file that is split into parts and small files (with duplicates) that
+    are packed.  Returns (path, entry name, stat) in the order to compress.
+    '''
+    os.makedirs(directory)
+    with open(os.path.join(directory, 'big.bin'), 'wb') as f:
+        f.write(os.urandom(700000))
+    for idx in range(40):
+        with open(os.path.join(directory, f's{idx:02d}.txt'), 'w') as f:
+            f.write(f'{idx % 5} ' * 200)
+    names = ['big.bin'] + sorted(x for x in os.listdir(directory) if x != 'big.bin')
+    return [(os.path.join(directory, x), x, os.stat(os.path.join(directory, x))) for x in names]
+
+
+def test_resume_with_dedup_and_split(tmp_path, monkeypatch):
+    directory = str(tmp_path / 'src')
+    out_zip = str(tmp_path / 'out.zip')
+    files = make_files(directory)
+    # One task at a time in this thread so that the split file is finished
+    # (and journaled) before the run is interrupted
+    kwargs = dict(checksum='blake2b', dedup=True, pack_size=2000, pack_threshold=1000, part_size=300000,
+                  executor='sync', max_in_flight=1, files=files)
+
+    pack_and_compress = compress_dir_module.pack_and_compress
+    calls = []
+    def interrupted(*args, **kw):
+        calls.append(None)
+        if len(calls) == 3:
+            raise RuntimeError('interrupted')
+        return pack_and_compress(*args, **kw)
+    monkeypatch.setattr(compress_dir_module, 'pack_and_compress', interrupted)
+    with pytest.raises(RuntimeError, match='interrupted'):
+        compress_dir(directory, out_zip, Blosc(cname='lz4', clevel=1), **kwargs)
+    assert os.path.exists(out_zip + '.partial')
+
+    monkeypatch.setattr(compress_dir_module, 'pack_and_compress', pack_and_compress)
+    compress_dir(directory, out_zip, Blosc(cname='lz4', clevel=1), resume=True, verify=True, **kwargs)
+    archive = alt_zip(out_zip)
+    for path, name, _ in files:
+        with open(path, 'rb') as f:
+            assert archive[name] == f.read()
+    archive.close()